@@ -14,10 +14,10 @@ logging.basicConfig(filename=logfilepath, level=logging.INFO)
 
 class CenterNet(nn.Module):
 
-    def __init__(self, base=18, input_frame_number=1, heads=OrderedDict(), head_conv_channel=64, pretrained=True):
+    def __init__(self, base=18, input_frame_number=1, heads=OrderedDict(), head_conv_channel=64, pretrained=True, checkpoint_stages=0):
         super(CenterNet, self).__init__()
 
-        self._base_network = get_upconv_resnet(base=base, pretrained=pretrained, input_frame_number=input_frame_number)
+        self._base_network = get_upconv_resnet(base=base, pretrained=pretrained, input_frame_number=input_frame_number, checkpoint_stages=checkpoint_stages)
         _, in_channels, _, _ = self._base_network(torch.rand(1, input_frame_number*3, 512, 512)).shape
 
         heatmap = []
@@ -76,7 +76,8 @@ class CenterNet(nn.Module):
         wh = self._wh(feature)
         landmark = self._landmark(feature)
 
-        heatmap = torch.sigmoid(heatmap)
+        # autocast(fp16, bf16) 에서도 sigmoid 는 fp32 로 - 낮은 정밀도에서는 1 근처가 일찍 1 로 포화되어 HeatmapFocalLoss 의 log(1 - pred) gradient 가 커진다.
+        heatmap = torch.sigmoid(heatmap.float())
         return heatmap, offset, wh, landmark
 
 
@@ -1,5 +1,8 @@
+import logging
+
 import mlflow as ml
 import torch
+import torch.distributed as dist
 import yaml
 
 import test
@@ -54,8 +57,14 @@ epoch = parser["epoch"]
 batch_size = parser["batch_size"]
 batch_log = parser["batch_log"]
 subdivision = parser["subdivision"]
+precision = parser["precision"]
+channels_last = parser["channels_last"]
+checkpoint_stages = parser["checkpoint_stages"]
 data_augmentation = parser["data_augmentation"]
 num_workers = parser["num_workers"]
+prefetch_factor = parser["prefetch_factor"]
+target_on_device = parser["target_on_device"]
+max_objects = parser["max_objects"]
 optimizer = parser["optimizer"]
 lambda_off = parser["lambda_off"]
 lambda_size = parser["lambda_size"]
@@ -69,6 +78,10 @@ decay_step = parser["decay_step"]
 # gpu vs cpu
 parser = stream['context']
 using_cuda = parser["using_cuda"]
+distributed = parser["distributed"]
+world_size = parser["world_size"]
+backend = parser["backend"]
+init_method = parser["init_method"]
 
 parser = stream['validation']
 valid_size = parser["valid_size"]
@@ -86,6 +99,31 @@ if torch.cuda.device_count() > 0 and using_cuda:
 else:
     GPU_COUNT = 0
 
+
+def distributed_run(rank, world_size, backend, init_method, run_id, kwargs):
+
+    '''
+    distributed 모드에서 torch.multiprocessing.spawn 이 process 마다 부르는 함수 - rank 는 spawn 이 0 부터 넘겨준다.
+    process group 을 만들고 train.run 을 부르면, train.run 은 DataParallel 대신 DistributedDataParallel 로 학습한다.
+    '''
+    dist.init_process_group(backend=backend, init_method=init_method, world_size=world_size, rank=rank)
+    if rank == 0:
+        if run_id is not None:
+            # spawn 된 process 에는 active run 이 없으므로, 부모 process 가 만든 run 에 이어서 기록한다.
+            ml.set_tracking_uri("./mlruns")
+            ml.start_run(run_id=run_id)
+    else:
+        # 같은 log 가 process 수 만큼 찍히지 않게 rank 0 만 info 를 남긴다.
+        logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        train.run(**kwargs)
+    finally:
+        if rank == 0 and run_id is not None:
+            ml.end_run()
+        dist.destroy_process_group()
+
+
 # window 운영체제에서 freeze support 안나오게 하려면, 아래와 같이 __name__ == "__main__" 에 해줘야함.
 if __name__ == "__main__":
 
@@ -110,9 +148,15 @@ if __name__ == "__main__":
             ml.log_param("test dataset path", test_dataset_path)
             ml.log_param("epoch", epoch)
             ml.log_param("batch size", batch_size)
+            ml.log_param("precision", precision)
+            ml.log_param("channels_last", channels_last)
+            ml.log_param("checkpoint_stages", checkpoint_stages)
             ml.log_param("data augmentation", data_augmentation)
             ml.log_param("optimizer", optimizer)
             ml.log_param("num_workers", num_workers)
+            ml.log_param("prefetch_factor", prefetch_factor)
+            ml.log_param("target_on_device", target_on_device)
+            ml.log_param("max_objects", max_objects)
 
             ml.log_param("lambda_off", lambda_off)
             ml.log_param("lambda_size", lambda_size)
@@ -122,6 +166,10 @@ if __name__ == "__main__":
             ml.log_param("decay lr", decay_lr)
             ml.log_param("decay step", decay_step)
             ml.log_param("using_cuda", using_cuda)
+            ml.log_param("distributed", distributed)
+            if distributed:
+                ml.log_param("world_size", world_size)
+                ml.log_param("backend", backend)
 
             ml.log_param("save_period", save_period)
             ml.log_param("topk", topk)
@@ -133,46 +181,63 @@ if __name__ == "__main__":
 
         torch.backends.cudnn.deterministic = False
         torch.backends.cudnn.benchmark = True # 그래프가 변하는 경우 학습 속도 느려질수 있음.
-        train.run(mean=image_mean,
-                  std=image_std,
-                  epoch=epoch,
-                  input_size=input_size,
-                  input_frame_number=input_frame_number,
-                  batch_size=batch_size,
-                  batch_log=batch_log,
-                  subdivision=subdivision,
-                  train_dataset_path=train_dataset_path,
-                  valid_dataset_path=valid_dataset_path,
-                  data_augmentation=data_augmentation,
-                  num_workers=num_workers,
-                  optimizer=optimizer,
-                  lambda_off=lambda_off,
-                  lambda_size=lambda_size,
-                  lambda_landmark=lambda_landmark,
-                  save_period=save_period,
-                  load_period=load_period,
-                  learning_rate=learning_rate,
-                  weight_decay=weight_decay,
-                  decay_lr=decay_lr,
-                  decay_step=decay_step,
-                  GPU_COUNT=GPU_COUNT,
-                  base=base,
-                  pretrained_base=pretrained_base,
-
-                  valid_size=valid_size,
-                  eval_period=eval_period,
-                  tensorboard=tensorboard,
-                  valid_graph_path=valid_graph_path,
-                  valid_html_auto_open=valid_html_auto_open,
-                  using_mlflow=using_mlflow,
-
-                  # valid dataset 그리기
-                  topk=topk,
-                  nms=nms,
-                  except_class_thresh = except_class_thresh,
-                  nms_thresh = nms_thresh,
-                  iou_thresh=iou_thresh,
-                  plot_class_thresh=plot_class_thresh)
+        train_kwargs = dict(mean=image_mean,
+                            std=image_std,
+                            epoch=epoch,
+                            input_size=input_size,
+                            input_frame_number=input_frame_number,
+                            batch_size=batch_size,
+                            batch_log=batch_log,
+                            subdivision=subdivision,
+                            precision=precision,
+                            channels_last=channels_last,
+                            checkpoint_stages=checkpoint_stages,
+                            train_dataset_path=train_dataset_path,
+                            valid_dataset_path=valid_dataset_path,
+                            data_augmentation=data_augmentation,
+                            num_workers=num_workers,
+                            prefetch_factor=prefetch_factor,
+                            target_on_device=target_on_device,
+                            max_objects=max_objects,
+                            optimizer=optimizer,
+                            lambda_off=lambda_off,
+                            lambda_size=lambda_size,
+                            lambda_landmark=lambda_landmark,
+                            save_period=save_period,
+                            load_period=load_period,
+                            learning_rate=learning_rate,
+                            weight_decay=weight_decay,
+                            decay_lr=decay_lr,
+                            decay_step=decay_step,
+                            GPU_COUNT=GPU_COUNT,
+                            base=base,
+                            pretrained_base=pretrained_base,
+
+                            valid_size=valid_size,
+                            eval_period=eval_period,
+                            tensorboard=tensorboard,
+                            valid_graph_path=valid_graph_path,
+                            valid_html_auto_open=valid_html_auto_open,
+                            using_mlflow=using_mlflow,
+
+                            # valid dataset 그리기
+                            topk=topk,
+                            nms=nms,
+                            except_class_thresh = except_class_thresh,
+                            nms_thresh = nms_thresh,
+                            iou_thresh=iou_thresh,
+                            plot_class_thresh=plot_class_thresh)
+
+        if distributed:
+            # process 마다 model 하나씩 - checkpoint / tensorboard / mlflow 는 rank 0 만 쓴다.
+            torch.multiprocessing.spawn(distributed_run,
+                                        args=(world_size, backend, init_method,
+                                              ml.active_run().info.run_id if using_mlflow else None,
+                                              train_kwargs),
+                                        nprocs=world_size,
+                                        join=True)
+        else:
+            train.run(**train_kwargs)
 
         if using_mlflow:
             ml.end_run()
@@ -184,7 +249,7 @@ if __name__ == "__main__":
                  std=image_std,
                  load_name=load_name, load_period=load_period, GPU_COUNT=GPU_COUNT,
                  test_weight_path=test_weight_path,
-                 test_dataset_path=test_dataset_path, num_workers=num_workers,
+                 test_dataset_path=test_dataset_path, num_workers=num_workers, prefetch_factor=prefetch_factor,
                  test_save_path=test_save_path,
                  test_graph_path=test_graph_path,
                  test_html_auto_open=test_html_auto_open,
@@ -1,3 +1,4 @@
+import functools
 import glob
 import logging
 import os
@@ -6,11 +7,12 @@ import time
 from collections import OrderedDict
 
 import cv2
-import mlflow as ml
 import numpy as np
 import torch
+import torch.distributed as dist
 import torchvision
 from torch.nn import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import Adam, RMSprop, SGD, lr_scheduler
 from torch.utils.tensorboard import SummaryWriter
 from torchsummary import summary as modelsummary
@@ -19,8 +21,9 @@ from tqdm import tqdm
 from core import CenterNet
 from core import HeatmapFocalLoss, NormedL1Loss
 from core import Prediction
+from core import TargetGenerator
 from core import Voc_2007_AP
-from core import plot_bbox, PrePostNet
+from core import plot_bbox, PrePostNet, AsyncLogger, AsyncCheckpointer, all_reduce_mean, gradient_sync, amp_dtype, autocast, grad_scaler
 from core import traindataloader, validdataloader
 
 logfilepath = ""
@@ -40,10 +43,14 @@ def run(mean=[0.485, 0.456, 0.406],
         batch_size=16,
         batch_log=100,
         subdivision=4,
+        precision="fp32",
+        channels_last=False,
+        checkpoint_stages=0,
         train_dataset_path="Dataset/train",
         valid_dataset_path="Dataset/valid",
         data_augmentation=True,
         num_workers=4,
+        prefetch_factor=2,
         optimizer="ADAM",
         lambda_off=1,
         lambda_size=0.1,
@@ -66,9 +73,24 @@ def run(mean=[0.485, 0.456, 0.406],
         nms=False,
         except_class_thresh=0.01,
         nms_thresh=0.5,
-        plot_class_thresh=0.5):
+        plot_class_thresh=0.5,
+        target_on_device=False,
+        max_objects=1024):
+    # main.py 의 distributed 모드 - process 마다 불리고, process group 은 main.py 에서 만든다.
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    world_size = dist.get_world_size() if distributed else 1
+    # checkpoint / tensorboard / mlflow / valid graph 는 rank 0 만 쓴다.
+    main_process = rank == 0
+    tensorboard = tensorboard and main_process
+    using_mlflow = using_mlflow and main_process
+
     if GPU_COUNT == 0:
         device = torch.device("cpu")
+    elif distributed:
+        # process 마다 gpu 하나
+        device = torch.device(f"cuda:{rank % GPU_COUNT}")
+        torch.cuda.set_device(device)
     elif GPU_COUNT == 1:
         device = torch.device("cuda")
     else:
@@ -97,7 +119,7 @@ def run(mean=[0.485, 0.456, 0.406],
             logging.info(f'{torch.cuda.get_device_name(d)}')
             logging.info(f'Running on {d} / free memory : {free_memory}GB / total memory {total_memory}GB')
     else:
-        if GPU_COUNT == 1:
+        if device.type == "cuda":
             total_memory = torch.cuda.get_device_properties(device).total_memory
             free_memory = total_memory - torch.cuda.max_memory_allocated(device)
             free_memory = round(free_memory / (1024 ** 3), 2)
@@ -107,10 +129,16 @@ def run(mean=[0.485, 0.456, 0.406],
         else:
             logging.info(f'Running on {device}')
 
-    if GPU_COUNT > 0 and batch_size < GPU_COUNT:
+    if not distributed and GPU_COUNT > 0 and batch_size < GPU_COUNT:
         logging.info("batch size must be greater than gpu number")
         exit(0)
 
+    if batch_size % world_size != 0:
+        logging.info("batch size must be divisible by world size")
+        exit(0)
+    # batch_size 는 모든 process 를 합친 batch 이고, process 하나는 local_batch_size 씩 올린다. (distributed 가 아니면 같다.)
+    local_batch_size = batch_size // world_size
+
     if data_augmentation:
         logging.info("Using Data Augmentation")
 
@@ -124,11 +152,16 @@ def run(mean=[0.485, 0.456, 0.406],
                                                       path=train_dataset_path,
                                                       input_size=input_size,
                                                       input_frame_number=input_frame_number,
-                                                      batch_size=batch_size,
+                                                      batch_size=local_batch_size,
                                                       pin_memory=True,
                                                       num_workers=num_workers,
+                                                      prefetch_factor=prefetch_factor,
                                                       shuffle=True, mean=mean, std=std, scale_factor=scale_factor,
-                                                      make_target=True)
+                                                      make_target=True,
+                                                      target_on_device=target_on_device,
+                                                      max_objects=max_objects,
+                                                      distributed=distributed,
+                                                      channels_last=channels_last)
 
     train_update_number_per_epoch = len(train_dataloader)
     if train_update_number_per_epoch < 1:
@@ -142,9 +175,14 @@ def run(mean=[0.485, 0.456, 0.406],
                                                           input_frame_number=input_frame_number,
                                                           batch_size=valid_size,
                                                           num_workers=num_workers,
+                                                          prefetch_factor=prefetch_factor,
                                                           pin_memory=True,
                                                           shuffle=True, mean=mean, std=std, scale_factor=scale_factor,
-                                                          make_target=True)
+                                                          make_target=True,
+                                                          target_on_device=target_on_device,
+                                                          max_objects=max_objects,
+                                                          distributed=distributed,
+                                                          channels_last=channels_last)
         valid_update_number_per_epoch = len(valid_dataloader)
         if valid_update_number_per_epoch < 1:
             logging.warning("valid batch size가 데이터 수보다 큼")
@@ -165,27 +203,32 @@ def run(mean=[0.485, 0.456, 0.406],
     param_path = os.path.join(weight_path, f'{model}-{load_period:04d}.pt')
 
     start_epoch = 0
-    net = CenterNet(base=base,
-                    input_frame_number=input_frame_number,
-                    heads=OrderedDict([
-                        ('heatmap', {'num_output': num_classes, 'bias': -2.19}),
-                        ('offset', {'num_output': 2}),
-                        ('wh', {'num_output': 2}),
-                        ('landmark', {'num_output': landmark_number})
-                    ]),
-                    head_conv_channel=64,
-                    pretrained=pretrained_base)
+    build_net = functools.partial(CenterNet, base=base,
+                                  input_frame_number=input_frame_number,
+                                  heads=OrderedDict([
+                                      ('heatmap', {'num_output': num_classes, 'bias': -2.19}),
+                                      ('offset', {'num_output': 2}),
+                                      ('wh', {'num_output': 2}),
+                                      ('landmark', {'num_output': landmark_number})
+                                  ]),
+                                  head_conv_channel=64,
+                                  pretrained=pretrained_base,
+                                  checkpoint_stages=checkpoint_stages)
+    net = build_net()
 
     # https://github.com/sksq96/pytorch-summary
-    if GPU_COUNT == 0:
+    if main_process and GPU_COUNT == 0:
         modelsummary(net.to(context), input_shape[1:], device="cpu")
-    elif GPU_COUNT > 0:
+    elif main_process and GPU_COUNT > 0:
         modelsummary(net.to(context), input_shape[1:], device="cuda")
 
     if tensorboard:
         summary = SummaryWriter(log_dir=os.path.join("torchboard", model), max_queue=10, flush_secs=10)
         summary.add_graph(net.to(context), input_to_model=torch.ones(input_shape, device=context), verbose=False)
 
+    # tensorboard / mlflow 기록은 background thread 에서 - 학습 loop 를 기다리게 하지 않는다.
+    logger = AsyncLogger(summary=summary if tensorboard else None, using_mlflow=using_mlflow)
+
     if os.path.exists(param_path):
         start_epoch = load_period
         checkpoint = torch.load(param_path)
@@ -202,6 +245,10 @@ def run(mean=[0.485, 0.456, 0.406],
         exit(0)
 
     net.to(context)
+    # channels_last 이면 conv weight 와 input 을 NHWC 순서로 둔다. - cudnn / oneDNN 이 layout 을 바꾸는 복사 없이 계산한다.
+    memory_format = torch.channels_last if channels_last else torch.preserve_format
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
 
     if optimizer.upper() == "ADAM":
         trainer = Adam(net.parameters(), lr=learning_rate, betas=(0.9, 0.999), weight_decay=weight_decay)
@@ -224,8 +271,14 @@ def run(mean=[0.485, 0.456, 0.406],
             else:
                 logging.info(f"loading optimizer_state_dict")
 
-    if isinstance(device, (list, tuple)):
+    if distributed:
+        # gloo 로 cpu 에서 돌릴 때는 device_ids 없이
+        net = DistributedDataParallel(net, device_ids=[context] if context.type == "cuda" else None)
+    elif isinstance(device, (list, tuple)):
         net = DataParallel(net, device_ids=device, output_device=context, dim=0)
+    module = net.module if isinstance(net, (DataParallel, DistributedDataParallel)) else net
+    # 검증은 process 마다 자기 몫만 - DistributedDataParallel 의 forward 는 buffer 를 broadcast 하므로 rank 0 만 부르면 멈춘다.
+    valid_net = module if distributed else net
 
     # optimizer
     # https://pytorch.org/docs/master/optim.html?highlight=lr%20sche#torch.optim.lr_scheduler.CosineAnnealingLR
@@ -233,22 +286,39 @@ def run(mean=[0.485, 0.456, 0.406],
     step = unit * decay_step
     lr_sch = lr_scheduler.StepLR(trainer, step, gamma=decay_lr, last_epoch=-1)
 
+    # precision 이 fp16 / bf16 이면 forward 와 loss 를 autocast 로 감싼다. - fp16 은 GradScaler 로 loss 를 키워서 backward 한다.
+    amp = amp_dtype(precision, context)
+    scaler = grad_scaler(amp)
+    if amp is not None:
+        logging.info(f"mixed precision : {amp}")
+
     heatmapfocalloss = HeatmapFocalLoss(from_sigmoid=True, alpha=2, beta=4)
     normedl1loss = NormedL1Loss()
+
+    # target_on_device 이면 dataloader 는 box 만 넘기고, target 은 여기서 context 위에서 만든다.
+    targetgenerator = TargetGenerator(num_classes=num_classes, max_objects=max_objects, on_device=True)
+    output_width, output_height = input_size[1] // scale_factor, input_size[0] // scale_factor
+
     prediction = Prediction(unique_ids=name_classes, topk=topk, scale=scale_factor, nms=nms,
                             except_class_thresh=except_class_thresh, nms_thresh=nms_thresh)
     precision_recall = Voc_2007_AP(iou_thresh=iou_thresh, class_names=name_classes)
 
     # torch split이 numpy, mxnet split과 달라서 아래와 같은 작업을 하는 것
-    if batch_size % subdivision == 0:
-        chunk = int(batch_size) // int(subdivision)
+    if local_batch_size % subdivision == 0:
+        chunk = int(local_batch_size) // int(subdivision)
     else:
         logging.info(f"batch_size / subdivision 이 나누어 떨어지지 않습니다.")
         logging.info(f"subdivision 을 다시 설정하고 학습 진행하세요.")
         exit(0)
 
+    # save_period 마다의 .pt / .jit 저장은 background process 에서 - 학습은 disk 쓰기, script 변환을 기다리지 않는다.
+    if main_process:
+        checkpointer = AsyncCheckpointer(build_net=functools.partial(build_net, pretrained=False),
+                                         build_prepostnet=functools.partial(PrePostNet, auxnet=prediction, input_frame_number=input_frame_number))
+
     start_time = time.time()
-    for i in tqdm(range(start_epoch + 1, epoch + 1, 1), initial=start_epoch + 1, total=epoch):
+    for i in tqdm(range(start_epoch + 1, epoch + 1, 1), initial=start_epoch + 1, total=epoch,
+                  disable=not main_process):
 
         heatmap_loss_sum = 0
         offset_loss_sum = 0
@@ -257,13 +327,24 @@ def run(mean=[0.485, 0.456, 0.406],
         net.train()
         time_stamp = time.time()
 
+        if distributed:
+            # process 마다 epoch 별로 다른 순서로 나눠 본다.
+            train_dataloader.sampler.set_epoch(i)
+
         # multiscale을 하게되면 여기서 train_dataloader을 다시 만드는 것이 좋겠군..
-        for batch_count, (
-                image, _, heatmap_target, offset_target, wh_target, landmark_target, mask_target, landmarks_mask_target, _) in enumerate(train_dataloader, start=1):
+        for batch_count, batch in enumerate(train_dataloader, start=1):
 
             trainer.zero_grad()
 
-            image = image.to(context)
+            if target_on_device:
+                image, label, _ = batch
+                label = label.to(context)
+                heatmap_target, offset_target, wh_target, landmark_target, mask_target, index_target = targetgenerator(label[:, :, :4], label[:, :, 4:5], label[:, :, 5:],
+                                                                                                                       output_width, output_height, context)
+            else:
+                image, _, heatmap_target, offset_target, wh_target, landmark_target, mask_target, index_target, _ = batch
+
+            image = image.to(context, memory_format=memory_format)
 
             '''
             이렇게 하는 이유?
@@ -276,7 +357,7 @@ def run(mean=[0.485, 0.456, 0.406],
             wh_target = wh_target.to(context)
             landmark_target = landmark_target.to(context)
             mask_target = mask_target.to(context)
-            landmarks_mask_target = landmarks_mask_target.to(context)
+            index_target = index_target.to(context)
 
             image_split = torch.split(image, chunk, dim=0)
             heatmap_target_split = torch.split(heatmap_target, chunk, dim=0)
@@ -284,51 +365,57 @@ def run(mean=[0.485, 0.456, 0.406],
             wh_target_split = torch.split(wh_target, chunk, dim=0)
             landmark_target_split = torch.split(landmark_target, chunk, dim=0)
             mask_target_split = torch.split(mask_target, chunk, dim=0)
-            landmarks_mask_target_split = torch.split(landmarks_mask_target, chunk, dim=0)
+            index_target_split = torch.split(index_target, chunk, dim=0)
 
             heatmap_losses = []
             offset_losses = []
             wh_losses = []
             landmark_losses = []
-            total_loss = 0.0
 
-            for image_part, heatmap_target_part, offset_target_part, wh_target_part, landmark_target_part, mask_target_part, landmarks_mask_target_part in zip(
+            for j, (image_part, heatmap_target_part, offset_target_part, wh_target_part, landmark_target_part, mask_target_part, index_target_part) in enumerate(zip(
                     image_split,
                     heatmap_target_split,
                     offset_target_split,
                     wh_target_split,
                     landmark_target_split,
                     mask_target_split,
-                    landmarks_mask_target_split):
-                heatmap_pred, offset_pred, wh_pred, landmark_pred = net(image)
-                '''
-                pytorch는 trainer.step()에서 batch_size 인자가 없다.
-                Loss 구현시 고려해야 한다.(mean 모드) 
-                '''
-                heatmap_loss = torch.div(heatmapfocalloss(heatmap_pred, heatmap_target_part), subdivision)
-                offset_loss = torch.div(normedl1loss(offset_pred, offset_target_part, mask_target_part) * lambda_off,
-                                        subdivision)
-                wh_loss = torch.div(normedl1loss(wh_pred, wh_target_part, mask_target_part) * lambda_size, subdivision)
-                landmark_loss = torch.div(normedl1loss(landmark_pred, landmark_target_part, landmarks_mask_target_part) * lambda_landmark,
-                                          subdivision)
-
-                heatmap_losses.append(heatmap_loss.item())
-                offset_losses.append(offset_loss.item())
-                wh_losses.append(wh_loss.item())
-                landmark_losses.append(landmark_loss.item())
-
-                total_loss = total_loss + (heatmap_loss + offset_loss + wh_loss + landmark_loss)
-
-            total_loss.backward()
-            trainer.step()
+                    index_target_split)):
+                # distributed 이면 마지막 chunk 의 backward 에서만 gradient 를 all-reduce 한다.
+                with gradient_sync(net, sync=j == len(image_split) - 1):
+                    with autocast(context, amp):
+                        heatmap_pred, offset_pred, wh_pred, landmark_pred = net(image)
+                        '''
+                        pytorch는 trainer.step()에서 batch_size 인자가 없다.
+                        Loss 구현시 고려해야 한다.(mean 모드) 
+                        '''
+                        heatmap_loss = torch.div(heatmapfocalloss(heatmap_pred, heatmap_target_part), subdivision)
+                        offset_loss = torch.div(normedl1loss(offset_pred, offset_target_part, mask_target_part, index_target_part) * lambda_off,
+                                                subdivision)
+                        wh_loss = torch.div(normedl1loss(wh_pred, wh_target_part, mask_target_part, index_target_part) * lambda_size, subdivision)
+                        landmark_loss = torch.div(normedl1loss(landmark_pred, landmark_target_part, mask_target_part, index_target_part) * lambda_landmark,
+                                                  subdivision)
+
+                    heatmap_losses.append(heatmap_loss.detach())
+                    offset_losses.append(offset_loss.detach())
+                    wh_losses.append(wh_loss.detach())
+                    landmark_losses.append(landmark_loss.detach())
+
+                    # chunk 마다 backward - 이 chunk 의 graph 는 여기서 풀리고 gradient 는 parameter 의 .grad 에 누적된다.
+                    # 모든 chunk 의 graph 를 들고 있다가 한번에 backward 하면 subdivision 으로 activation memory 가 줄지 않는다.
+                    scaler.scale(heatmap_loss + offset_loss + wh_loss + landmark_loss).backward()
+
+            scaler.step(trainer)
+            scaler.update()
             lr_sch.step()
 
+            # loss 는 device 에 쌓아두고 batch_log 마다 한번만 가져온다. - chunk / batch 마다 .item() 으로 기다리지 않는다.
             heatmap_loss_sum += sum(heatmap_losses)
             offset_loss_sum += sum(offset_losses)
             wh_loss_sum += sum(wh_losses)
             landmark_loss_sum += sum(landmark_losses)
 
             if batch_count % batch_log == 0:
+                heatmap_losses, offset_losses, wh_losses, landmark_losses = torch.stack([torch.stack(heatmap_losses), torch.stack(offset_losses), torch.stack(wh_losses), torch.stack(landmark_losses)]).tolist()
                 logging.info(f'[Epoch {i}][Batch {batch_count}/{train_update_number_per_epoch}]'
                              f'[Speed {image.shape[0] / (time.time() - time_stamp):.3f} samples/sec]'
                              f'[Lr = {lr_sch.get_last_lr()}]'
@@ -338,6 +425,9 @@ def run(mean=[0.485, 0.456, 0.406],
                              f'[landmark loss = {sum(landmark_losses):.3f}]')
             time_stamp = time.time()
 
+        # process 마다 다른 data 를 봤으므로 process 평균 (distributed 가 아니면 그대로)
+        heatmap_loss_sum, offset_loss_sum, wh_loss_sum, landmark_loss_sum = all_reduce_mean([heatmap_loss_sum, offset_loss_sum, wh_loss_sum, landmark_loss_sum])
+
         train_heatmap_loss_mean = np.divide(heatmap_loss_sum, train_update_number_per_epoch)
         train_offset_loss_mean = np.divide(offset_loss_sum, train_update_number_per_epoch)
         train_wh_loss_mean = np.divide(wh_loss_sum, train_update_number_per_epoch)
@@ -351,39 +441,16 @@ def run(mean=[0.485, 0.456, 0.406],
             f"train landmark loss : {train_landmark_loss_mean} / "
             f"train total loss : {train_total_loss_mean}")
 
-        if i % save_period == 0:
+        if i % save_period == 0 and main_process:
 
             if not os.path.exists(weight_path):
                 os.makedirs(weight_path)
 
-            module = net.module if isinstance(device, (list, tuple)) else net
-            auxnet = Prediction(unique_ids=name_classes, topk=topk, scale=scale_factor, nms=nms,
-                                except_class_thresh=except_class_thresh,
-                                nms_thresh=nms_thresh)
-            prepostnet = PrePostNet(net=module, auxnet=auxnet, input_frame_number=input_frame_number)  # 새로운 객체가 생성
-
-            try:
-                torch.save({
-                    'model_state_dict': net.state_dict(),
-                    'optimizer_state_dict': trainer.state_dict()}, os.path.join(weight_path, f'{model}-{i:04d}.pt'))
-
-                # torch.jit.trace() 보다는 control-flow 연산 적용이 가능한 torch.jit.script() 을 사용하자
-                # torch.jit.script
-                script = torch.jit.script(module)
-                script.save(os.path.join(weight_path, f'{model}-{i:04d}.jit'))
-
-                script = torch.jit.script(prepostnet)
-                script.save(os.path.join(weight_path, f'{model}-prepost-{i:04d}.jit'))
-
-                # # torch.jit.trace - 안 써짐
-                # 오류 : Expected object of device type cuda but got device type cpu for argument #2 'other' in call to _th_fmod
-                # trace = torch.jit.trace(prepostnet, torch.rand(input_shape[0], input_shape[1], input_shape[2], input_shape[3], device=context))
-                # trace.save(os.path.join(weight_path, f'{model}-{i:04d}.jit'))
-
-            except Exception as E:
-                logging.error(f"pt, jit export 예외 발생 : {E}")
-            else:
-                logging.info("pt, jit export 성공")
+            # state_dict 를 cpu 로 복사해서 넘기기만 한다. - .pt 저장, torch.jit.script export 는 checkpointer 의 process 에서 (결과는 logging 으로)
+            checkpointer.save(module.state_dict(), trainer.state_dict(),
+                              pt_path=os.path.join(weight_path, f'{model}-{i:04d}.pt'),
+                              jit_path=os.path.join(weight_path, f'{model}-{i:04d}.jit'),
+                              prepost_path=os.path.join(weight_path, f'{model}-prepost-{i:04d}.jit'))
 
         if i % eval_period == 0 and valid_list:
 
@@ -395,9 +462,16 @@ def run(mean=[0.485, 0.456, 0.406],
             net.eval()
 
             # loss 구하기
-            for image, label, heatmap_target, offset_target, wh_target, landmark_target, mask_target, landmarks_mask_target, _ in valid_dataloader:
-                image = image.to(context)
+            for batch in valid_dataloader:
+                if target_on_device:
+                    image, label, _ = batch
+                else:
+                    image, label, heatmap_target, offset_target, wh_target, landmark_target, mask_target, index_target, _ = batch
+                image = image.to(context, memory_format=memory_format)
                 label = label.to(context)
+                if target_on_device:
+                    heatmap_target, offset_target, wh_target, landmark_target, mask_target, index_target = targetgenerator(label[:, :, :4], label[:, :, 4:5], label[:, :, 5:],
+                                                                                                                           output_width, output_height, context)
                 gt_box = label[:, :, :4]
                 gt_id = label[:, :, 4:5]
 
@@ -406,10 +480,10 @@ def run(mean=[0.485, 0.456, 0.406],
                 wh_target = wh_target.to(context)
                 landmark_target = landmark_target.to(context)
                 mask_target = mask_target.to(context)
-                landmarks_mask_target = landmarks_mask_target.to(context)
+                index_target = index_target.to(context)
 
                 with torch.no_grad():
-                    heatmap_pred, offset_pred, wh_pred, landmark_pred = net(image)
+                    heatmap_pred, offset_pred, wh_pred, landmark_pred = valid_net(image)
                     id, score, bbox, _ = prediction(heatmap_pred, offset_pred, wh_pred, landmark_pred)
 
                     precision_recall.update(pred_bboxes=bbox,
@@ -419,15 +493,17 @@ def run(mean=[0.485, 0.456, 0.406],
                                             gt_labels=gt_id)
 
                     heatmap_loss = heatmapfocalloss(heatmap_pred, heatmap_target)
-                    offset_loss = normedl1loss(offset_pred, offset_target, mask_target) * lambda_off
-                    wh_loss = normedl1loss(wh_pred, wh_target, mask_target) * lambda_size
-                    landmark_loss = normedl1loss(landmark_pred, landmark_target, landmarks_mask_target) * lambda_landmark
+                    offset_loss = normedl1loss(offset_pred, offset_target, mask_target, index_target) * lambda_off
+                    wh_loss = normedl1loss(wh_pred, wh_target, mask_target, index_target) * lambda_size
+                    landmark_loss = normedl1loss(landmark_pred, landmark_target, mask_target, index_target) * lambda_landmark
 
                     heatmap_loss_sum += heatmap_loss.item()
                     offset_loss_sum += offset_loss.item()
                     wh_loss_sum += wh_loss.item()
                     landmark_loss_sum += landmark_loss.item()
 
+            # process 마다 나눠 본 valid data 의 평균 (distributed 가 아니면 그대로)
+            heatmap_loss_sum, offset_loss_sum, wh_loss_sum, landmark_loss_sum = all_reduce_mean([heatmap_loss_sum, offset_loss_sum, wh_loss_sum, landmark_loss_sum], device=context)
             valid_heatmap_loss_mean = np.divide(heatmap_loss_sum, valid_update_number_per_epoch)
             valid_offset_loss_mean = np.divide(offset_loss_sum, valid_update_number_per_epoch)
             valid_wh_loss_mean = np.divide(wh_loss_sum, valid_update_number_per_epoch)
@@ -443,6 +519,8 @@ def run(mean=[0.485, 0.456, 0.406],
 
             AP_appender = []
             round_position = 2
+            # process 마다 나눠 본 valid data 의 결과를 모은다.
+            precision_recall.synchronize()
             class_name, precision, recall, true_positive, false_positive, threshold = precision_recall.get_PR_list()
             for j, c, p, r in zip(range(len(recall)), class_name, precision, recall):
                 name, AP = precision_recall.get_AP(c, p, r)
@@ -453,12 +531,13 @@ def run(mean=[0.485, 0.456, 0.406],
             mAP_result = np.mean(AP_appender)
 
             logging.info(f"mAP : {round(mAP_result * 100, round_position)}%")
-            precision_recall.get_PR_curve(name=class_name,
-                                          precision=precision,
-                                          recall=recall,
-                                          threshold=threshold,
-                                          AP=AP_appender, mAP=mAP_result, folder_name=valid_graph_path, epoch=i,
-                                          auto_open=valid_html_auto_open)
+            if main_process:
+                precision_recall.get_PR_curve(name=class_name,
+                                              precision=precision,
+                                              recall=recall,
+                                              threshold=threshold,
+                                              AP=AP_appender, mAP=mAP_result, folder_name=valid_graph_path, epoch=i,
+                                              auto_open=valid_html_auto_open)
             precision_recall.reset()
 
             if tensorboard:
@@ -469,16 +548,16 @@ def run(mean=[0.485, 0.456, 0.406],
                     ground_truth_colors[k] = (0, 1, 0)  # RGB
 
                 dataloader_iter = iter(valid_dataloader)
-                image, label, _, _, _, _, _, _, _ = next(dataloader_iter)
+                image, label = next(dataloader_iter)[0:2]
 
-                image = image.to(context)
+                image = image.to(context, memory_format=memory_format)
                 label = label.to(context)
                 gt_boxes = label[:, :, :4]
                 gt_ids = label[:, :, 4:5]
                 gt_landmarks = label[:, :, 5:]
 
                 with torch.no_grad():
-                    heatmap_pred, offset_pred, wh_pred, landmark_pred = net(image)
+                    heatmap_pred, offset_pred, wh_pred, landmark_pred = valid_net(image)
                     ids, scores, bboxes, landmarks = prediction(heatmap_pred, offset_pred, wh_pred, landmark_pred)
 
                 for img, gt_id, gt_box, gt_landmark, heatmap, id, score, bbox, landmark in zip(image, gt_ids, gt_boxes, gt_landmarks, heatmap_pred, ids,
@@ -531,46 +610,48 @@ def run(mean=[0.485, 0.456, 0.406],
                     batch_image.append(hconcat_images)  # (batch, channel, height, width)
 
                 img_grid = torchvision.utils.make_grid(torch.as_tensor(batch_image), nrow=1)
-                summary.add_image(tag="valid_result", img_tensor=img_grid, global_step=i)
-
-                summary.add_scalar(tag="heatmap_loss/train_heatmap_loss_mean",
-                                   scalar_value=train_heatmap_loss_mean,
-                                   global_step=i)
-                summary.add_scalar(tag="heatmap_loss/valid_heatmap_loss_mean",
-                                   scalar_value=valid_heatmap_loss_mean,
-                                   global_step=i)
-
-                summary.add_scalar(tag="offset_loss/train_offset_loss_mean",
-                                   scalar_value=train_offset_loss_mean,
-                                   global_step=i)
-                summary.add_scalar(tag="offset_loss/valid_offset_loss_mean",
-                                   scalar_value=valid_offset_loss_mean,
-                                   global_step=i)
-
-                summary.add_scalar(tag="wh_loss/train_wh_loss_mean",
-                                   scalar_value=train_wh_loss_mean,
-                                   global_step=i)
-                summary.add_scalar(tag="wh_loss/valid_wh_loss_mean",
-                                   scalar_value=valid_wh_loss_mean,
-                                   global_step=i)
-
-                summary.add_scalar(tag="total_loss/train_total_loss",
-                                   scalar_value=train_total_loss_mean,
-                                   global_step=i)
-                summary.add_scalar(tag="total_loss/valid_total_loss",
-                                   scalar_value=valid_total_loss_mean,
-                                   global_step=i)
-
-                for name, param in net.named_parameters():
-                    summary.add_histogram(tag=name, values=param, global_step=i)
+                logger.add_image(tag="valid_result", img_tensor=img_grid, global_step=i)
+
+                logger.add_scalar(tag="heatmap_loss/train_heatmap_loss_mean",
+                                  scalar_value=train_heatmap_loss_mean,
+                                  global_step=i)
+                logger.add_scalar(tag="heatmap_loss/valid_heatmap_loss_mean",
+                                  scalar_value=valid_heatmap_loss_mean,
+                                  global_step=i)
+
+                logger.add_scalar(tag="offset_loss/train_offset_loss_mean",
+                                  scalar_value=train_offset_loss_mean,
+                                  global_step=i)
+                logger.add_scalar(tag="offset_loss/valid_offset_loss_mean",
+                                  scalar_value=valid_offset_loss_mean,
+                                  global_step=i)
+
+                logger.add_scalar(tag="wh_loss/train_wh_loss_mean",
+                                  scalar_value=train_wh_loss_mean,
+                                  global_step=i)
+                logger.add_scalar(tag="wh_loss/valid_wh_loss_mean",
+                                  scalar_value=valid_wh_loss_mean,
+                                  global_step=i)
+
+                logger.add_scalar(tag="total_loss/train_total_loss",
+                                  scalar_value=train_total_loss_mean,
+                                  global_step=i)
+                logger.add_scalar(tag="total_loss/valid_total_loss",
+                                  scalar_value=valid_total_loss_mean,
+                                  global_step=i)
+
+                for name, param in module.named_parameters():
+                    logger.add_histogram(tag=name, values=param, global_step=i)
 
     end_time = time.time()
     learning_time = end_time - start_time
     logging.info(f"learning time : 약, {learning_time / 3600:0.2f}H")
     logging.info("optimization completed")
 
-    if using_mlflow:
-        ml.log_metric("learning time", round(learning_time / 3600, 2))
+    logger.log_metric("learning time", round(learning_time / 3600, 2))
+    if main_process:
+        checkpointer.close()
+    logger.close()
 
 
 if __name__ == "__main__":
@@ -582,10 +663,14 @@ if __name__ == "__main__":
         batch_size=16,
         batch_log=100,
         subdivision=4,
+        precision="fp32",
+        channels_last=False,
+        checkpoint_stages=0,
         train_dataset_path="Dataset/train",
         valid_dataset_path="Dataset/valid",
         data_augmentation=True,
         num_workers=4,
+        prefetch_factor=2,
         optimizer="ADAM",
         lambda_off=1,
         lambda_size=0.1,
@@ -1,7 +1,58 @@
 import torch
+from torch.autograd import Function
 from torch.nn import Module
 
 
+def _to_float(tensor):
+    # autocast(fp16, bf16) 의 출력만 fp32 로 올린다. - fp32, fp64 는 그대로
+    return tensor.float() if tensor.dtype in (torch.float16, torch.bfloat16) else tensor
+
+
+class _HeatmapFocalLossFunction(Function):
+
+    '''
+    HeatmapFocalLoss 의 forward / backward 를 직접 구현 - autograd 가 pow, log, 곱 같은 heatmap 크기의 중간 결과를 저장하지 않는다.
+    backward 에서는 pred, label 만 가지고 gradient 를 다시 계산한다.
+    label == 1 인 위치(object 중심)는 몇개 되지 않으므로 그 위치만 따로 계산해서 덮어쓴다.
+    '''
+    @staticmethod
+    def forward(ctx, pred, label, alpha, beta):
+
+        condition = label == 1
+        positive = pred[condition]
+
+        # torch.where(condition, 양성, 음성) 과 같은 값
+        loss = torch.pow(1 - label, beta).mul_(torch.pow(pred, alpha)).mul_(torch.log((1 - pred) + 1e-7))
+        loss[condition] = torch.pow(1 - positive, alpha) * torch.log(positive + 1e-7)
+        loss = -torch.sum(loss, dim=[1,2,3]).mean()
+        norm = torch.sum(condition).to(label.dtype).clamp(1, 1e30)
+
+        ctx.save_for_backward(pred, label)
+        ctx.alpha, ctx.beta, ctx.norm = alpha, beta, norm
+        return torch.true_divide(loss, norm)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+
+        pred, label = ctx.saved_tensors
+        alpha, beta = ctx.alpha, ctx.beta
+        condition = label == 1
+        positive = pred[condition]
+
+        # 음성 : d/dp (1 - y)^beta * p^alpha * log(1 - p)
+        one_minus = 1 - pred
+        grad = torch.log(one_minus + 1e-7).mul_(alpha).mul_(torch.pow(pred, alpha - 1))
+        grad.sub_(torch.pow(pred, alpha).div_(one_minus.add_(1e-7)))
+        grad.mul_(torch.pow(1 - label, beta))
+
+        # 양성 : d/dp (1 - p)^alpha * log(p)
+        grad[condition] = torch.pow(1 - positive, alpha) / (positive + 1e-7) - \
+                          alpha * torch.pow(1 - positive, alpha - 1) * torch.log(positive + 1e-7)
+
+        grad.mul_(-grad_output / (pred.shape[0] * ctx.norm))
+        return grad, None, None, None
+
+
 class HeatmapFocalLoss(Module):
 
     def __init__(self, from_sigmoid=True, alpha=2, beta=4):
@@ -11,27 +62,87 @@ class HeatmapFocalLoss(Module):
         self._beta = beta
 
     def forward(self, pred, label):
+        # autocast(fp16, bf16) 로 학습해도 loss 는 fp32 로 구한다. - fp16 에서는 (1 - pred) + 1e-7 의 1e-7 이 사라져서 log(0) 이 된다.
+        pred = _to_float(pred)
+        label = _to_float(label)
         if not self._from_sigmoid:
             pred = torch.sigmoid(pred)
 
         # a penalty-reduced pixelwise logistic regression with focal loss
-        condition = label == 1
-        loss = torch.where(condition, torch.pow(1 - pred, self._alpha) * torch.log(pred + 1e-7), torch.pow(1 - label, self._beta) * torch.pow(pred, self._alpha) * torch.log((1 - pred) + 1e-7))
-        loss = -torch.sum(loss, dim=[1,2,3]).mean()
-        norm = torch.sum(condition).to(label.dtype).clamp(1, 1e30)
-        return torch.true_divide(loss, norm)
+        return _HeatmapFocalLossFunction.apply(pred, label, self._alpha, self._beta)
 
 
 class NormedL1Loss(Module):
 
+    '''
+    object 중심에서만 L1 loss 를 구한다. - dense 한 target 대신 TargetGenerator 의 sparse target 을 받는다.
+    pred : (batch, channel, height, width)
+    label : (batch, max_objects, channel)
+    mask : (batch, max_objects)
+    index : (batch, max_objects) - object 중심의 flatten 위치
+    '''
     def __init__(self):
         super(NormedL1Loss, self).__init__()
 
-    def forward(self, pred, label, mask):
+    def forward(self, pred, label, mask, index):
+
+        # pred 에서 object 중심의 값만 모으기 -> (batch, max_objects, channel)
+        batch, channel = pred.shape[0:2]
+        pred = torch.gather(pred.reshape(batch, channel, -1), 2, index.unsqueeze(1).expand(-1, channel, -1)).permute(0, 2, 1)
+        pred = _to_float(pred)  # autocast 로 학습해도 loss 는 fp32 로
+        mask = mask.unsqueeze(-1).expand_as(label)
 
         # HeatmapFocalLoss 의 condition 은 mask와 같다.
         loss = torch.abs(label * mask - pred * mask)
-        loss = torch.sum(loss, dim=[1,2,3]).mean()
+        loss = torch.sum(loss, dim=[1,2]).mean()
 
         norm = torch.sum(mask).to(label.dtype).clamp(1, 1e30)
         return torch.true_divide(loss, norm)
+
+
+# test
+if __name__ == "__main__":
+
+    # torch.where 로 두 식을 모두 계산하던 방식과 loss, gradient 가 같은지, autograd 가 저장하는 메모리가 얼마나 줄었는지
+    def where_focal_loss(pred, label, alpha=2, beta=4):
+        condition = label == 1
+        loss = torch.where(condition, torch.pow(1 - pred, alpha) * torch.log(pred + 1e-7), torch.pow(1 - label, beta) * torch.pow(pred, alpha) * torch.log((1 - pred) + 1e-7))
+        loss = -torch.sum(loss, dim=[1,2,3]).mean()
+        norm = torch.sum(condition).to(label.dtype).clamp(1, 1e30)
+        return torch.true_divide(loss, norm)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    logit = torch.randn(8, 80, 128, 128, device=device)
+    label = torch.rand(8, 80, 128, 128, device=device)
+    label[label > 0.999] = 1
+
+    heatmapfocalloss = HeatmapFocalLoss(from_sigmoid=False)
+    for name, loss_function in [("where", lambda pred, label: where_focal_loss(torch.sigmoid(pred), label)), ("fused", heatmapfocalloss)]:
+        pred = logit.clone().requires_grad_(True)
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+            base_memory = torch.cuda.memory_allocated(device)
+        loss = loss_function(pred, label)
+        if device.type == "cuda":
+            print(f"{name} memory kept for backward : {(torch.cuda.memory_allocated(device) - base_memory) / 1024 ** 2:0.1f}MB, "
+                  f"peak : {(torch.cuda.max_memory_allocated(device) - base_memory) / 1024 ** 2:0.1f}MB")
+        loss.backward()
+        if name == "where":
+            where_loss, where_grad = loss.item(), pred.grad
+        else:
+            print(f"loss : {where_loss} / {loss.item()}, same loss : {where_loss == loss.item()}")
+            print(f"max gradient difference : {torch.max(torch.abs(where_grad - pred.grad)).item()}")
+
+    # precision: bf16 - cpu autocast 로 forward 해도 loss 가 fp32 와 가깝고 gradient 가 유한한지
+    if hasattr(torch, "autocast"):
+        torch.manual_seed(0)
+        conv = torch.nn.Conv2d(16, 80, kernel_size=1)
+        feature = torch.randn(2, 16, 128, 128)
+        label = label[:2].cpu()
+        for dtype in [torch.float32, torch.bfloat16]:
+            conv.zero_grad()
+            with torch.autocast(device_type="cpu", dtype=dtype, enabled=dtype != torch.float32):
+                pred = torch.sigmoid(conv(feature).float())  # Center.py 처럼 sigmoid 는 fp32 로
+                loss = HeatmapFocalLoss(from_sigmoid=True)(pred, label)
+            loss.backward()
+            print(f"{dtype} loss : {loss.item():0.6f}, loss dtype : {loss.dtype}, finite gradient : {torch.isfinite(conv.weight.grad).all().item()}")
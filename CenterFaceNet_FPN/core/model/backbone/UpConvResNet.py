@@ -19,10 +19,11 @@ class UpConvResNet(nn.Module):
                  input_frame_number = 2,
                  deconv_channels=(256, 128, 64),
                  deconv_kernels=(4, 4, 4),
-                 pretrained=True):
+                 pretrained=True,
+                 checkpoint_stages=0):
 
         super(UpConvResNet, self).__init__()
-        self._resnet = get_resnet(base, pretrained=pretrained, input_frame_number=input_frame_number)
+        self._resnet = get_resnet(base, pretrained=pretrained, input_frame_number=input_frame_number, checkpoint_stages=checkpoint_stages)
 
         in_channels_list = []
         for layer in self._resnet(torch.rand(1, input_frame_number*3, 512, 512)):
@@ -167,12 +168,13 @@ class UpConvResNet(nn.Module):
         return result
 
 
-def get_upconv_resnet(base=18, pretrained=False, input_frame_number=2):
+def get_upconv_resnet(base=18, pretrained=False, input_frame_number=2, checkpoint_stages=0):
     net = UpConvResNet(base=base,
                        input_frame_number=input_frame_number,
                        deconv_channels=(256, 128, 64),
                        deconv_kernels=(4, 4, 4),
-                       pretrained=pretrained)
+                       pretrained=pretrained,
+                       checkpoint_stages=checkpoint_stages)
     return net
 
 
@@ -189,3 +191,66 @@ if __name__ == "__main__":
     < input size(height, width) : (512, 512) >
     < output shape : torch.Size([1, 64, 128, 128]) >
     '''
+
+    # channels_last - cpu(oneDNN) 에서 memory format 별 처리량 비교 (batch 4, 5 번 평균)
+    import time
+    for base in [18, 50]:
+        net = get_upconv_resnet(base=base, pretrained=False, input_frame_number=1)
+        for memory_format in [torch.contiguous_format, torch.channels_last]:
+            net = net.to(memory_format=memory_format)
+            x = torch.rand(4, 3, input_size[0], input_size[1]).contiguous(memory_format=memory_format)
+            net.eval()
+            with torch.no_grad():
+                net(x)  # warm up
+                start = time.time()
+                for _ in range(5):
+                    net(x)
+                inference = 4 * 5 / (time.time() - start)
+            net.train()
+            net(x).mean().backward()  # warm up
+            start = time.time()
+            for _ in range(5):
+                net(x).mean().backward()
+            train = 4 * 5 / (time.time() - start)
+            print(f"< resnet{base} {str(memory_format):24s} : inference {inference:0.2f} / train {train:0.2f} images/sec >")
+
+    # activation checkpointing - configs/detector.yaml 의 크기에서 checkpoint_stages 별 backward 를 위해 저장되는 activation 크기, 학습 처리량 비교
+    # activation 크기는 saved_tensors_hooks 로 재므로 torch 1.10 이상에서만 나오고, 그보다 낮으면 학습 처리량만 잰다.
+    # 저장되는 activation 은 batch 에 비례하므로 batch 1 로 재고 batch_size 를 곱한다. (backward 때는 다시 계산하는 stage 하나 만큼이 잠깐 더 필요하다.)
+    import contextlib
+    import time
+    input_size, batch_size = (512, 512), 32
+    x = torch.rand(1, 3, input_size[0], input_size[1])
+    for checkpoint_stages in range(5):
+        net = get_upconv_resnet(base=18, pretrained=False, input_frame_number=1, checkpoint_stages=checkpoint_stages)
+        net.train()
+        parameters = {parameter.data_ptr() for parameter in net.parameters()}
+        saved = {}
+        def pack(tensor):
+            # torch 2.0 부터 storage() 대신 untyped_storage(), nbytes() 는 torch 1.13 부터
+            storage = tensor.untyped_storage() if hasattr(tensor, "untyped_storage") else tensor.storage()
+            if storage.data_ptr() not in parameters:
+                saved[storage.data_ptr()] = storage.nbytes() if hasattr(storage, "nbytes") else storage.size() * storage.element_size()
+            return tensor
+        measurable = hasattr(torch.autograd, "graph") and hasattr(torch.autograd.graph, "saved_tensors_hooks")
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor) if measurable else contextlib.nullcontext():
+            loss = net(x).mean()
+        loss.backward()  # warm up
+        start = time.time()
+        for _ in range(3):
+            loss = net(x).mean()
+            loss.backward()
+        train = 3 / (time.time() - start)
+        memory = sum(saved.values()) / 1024 ** 2
+        if measurable:
+            print(f"< UpConvResNet18 {input_size} checkpoint_stages {checkpoint_stages} : saved activation {memory:0.1f}MB x batch {batch_size} = {memory * batch_size:0.1f}MB / train {train:0.2f} images/sec >")
+        else:
+            print(f"< UpConvResNet18 {input_size} checkpoint_stages {checkpoint_stages} : train {train:0.2f} images/sec >")
+    '''
+    cpu 1 core 에서 측정
+    < UpConvResNet18 (512, 512) checkpoint_stages 0 : saved activation 148.1MB x batch 32 = 4738.9MB / train 1.17 images/sec >
+    < UpConvResNet18 (512, 512) checkpoint_stages 1 : saved activation 120.1MB x batch 32 = 3842.8MB / train 1.09 images/sec >
+    < UpConvResNet18 (512, 512) checkpoint_stages 2 : saved activation 104.1MB x batch 32 = 3330.5MB / train 1.00 images/sec >
+    < UpConvResNet18 (512, 512) checkpoint_stages 3 : saved activation 96.1MB x batch 32 = 3073.8MB / train 1.03 images/sec >
+    < UpConvResNet18 (512, 512) checkpoint_stages 4 : saved activation 92.0MB x batch 32 = 2944.6MB / train 0.98 images/sec >
+    '''
@@ -1,6 +1,9 @@
+import random
+
 import numpy as np
 import torch
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 from core.utils.dataprocessing.dataset import DetectionDataset
 from core.utils.dataprocessing.transformer import CenterTrainTransform, CenterValidTransform
@@ -76,8 +79,17 @@ class Pad(object):
 
 class Stack(object):
 
+    '''
+    channels_last=True 이면 (C, H, W) image 들을 (H, W, C) 로 보고 쌓아서, channels_last 인 (N, C, H, W) 를 돌려준다.
+    쌓을 때 한번만 복사하므로 쌓은 뒤에 memory format 을 바꾸는 것보다 복사가 한번 적다.
+    '''
+    def __init__(self, channels_last=False):
+        self._channels_last = channels_last
+
     def __call__(self, batch):
         if isinstance(batch[0], torch.Tensor):
+            if self._channels_last and batch[0].dim() == 3:
+                return torch.stack([ele.permute(1, 2, 0) for ele in batch], dim=0).permute(0, 3, 1, 2)
             return torch.stack(batch, dim=0)
         elif isinstance(batch[0], str):  # str
             return batch
@@ -86,71 +98,111 @@ class Stack(object):
             return torch.as_tensor(out)
 
 
-def traindataloader(augmentation=True, path="Dataset/train",
-                    input_size=(512, 512), input_frame_number=2, batch_size=8, pin_memory=True, num_workers=4, shuffle=True,
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], scale_factor=4, make_target=True):
+def _worker_init_fn(worker_id):
+
+    '''
+    worker 마다 numpy / random 의 seed 를 다르게 설정
+    설정하지 않으면 fork 된 worker 들이 같은 numpy 상태를 물려받아, 같은 augmentation 을 만들게 된다.
+    torch.initial_seed() 는 worker 마다 (base_seed + worker_id) 이고, base_seed 는 iterator 를 만들 때마다 바뀐다.
+    '''
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
 
-    num_workers = 0 if pin_memory else num_workers
+def _worker_options(num_workers, prefetch_factor, persistent_workers):
+
+    # num_workers=0 일 때는 prefetch_factor, persistent_workers 를 넘기면 안된다.
+    if num_workers > 0:
+        return dict(worker_init_fn=_worker_init_fn,
+                    prefetch_factor=prefetch_factor,
+                    persistent_workers=persistent_workers)
+    else:
+        return dict()
+
+
+def traindataloader(augmentation=True, path="Dataset/train",
+                    input_size=(512, 512), input_frame_number=2, batch_size=8, pin_memory=True, num_workers=4, prefetch_factor=2, persistent_workers=True, shuffle=True,
+                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], scale_factor=4, make_target=True, max_objects=1024, target_on_device=False, distributed=False, channels_last=False):
 
     transform = CenterTrainTransform(input_size, input_frame_number=input_frame_number, mean=mean, std=std, scale_factor=scale_factor,
-                                     augmentation=augmentation, make_target=make_target,
-                                     num_classes=DetectionDataset(path=path).num_class)
-    dataset = DetectionDataset(path=path, transform=transform, sequence_number=input_frame_number)
+                                     augmentation=augmentation, make_target=make_target and not target_on_device,
+                                     num_classes=DetectionDataset(path=path).num_class, max_objects=max_objects)
+    dataset = DetectionDataset(path=path, transform=transform, sequence_number=input_frame_number,
+                               keep_origin=not target_on_device)
+
+    if target_on_device:
+        # target 은 학습 device 에서 TargetGenerator(on_device=True) 로 만든다. - worker 는 image, box, 이름만 넘긴다.
+        collate_fn = Tuple(Stack(channels_last=channels_last), Pad(pad_val=-1), Stack())
+    else:
+        collate_fn = Tuple(Stack(channels_last=channels_last),
+                           Pad(pad_val=-1),
+                           Stack(),
+                           Stack(),
+                           Stack(),
+                           Stack(),
+                           Stack(),
+                           Stack(),
+                           Stack())
+
+    # distributed 이면 process 마다 dataset 을 나눠서 본다. - shuffle 은 sampler 가 한다.(epoch 마다 set_epoch)
+    sampler = DistributedSampler(dataset, shuffle=shuffle) if distributed else None
 
     dataloader = DataLoader(
         dataset,
         batch_size=batch_size,
-        shuffle=shuffle,
-        collate_fn=Tuple(Stack(),
-                         Pad(pad_val=-1),
-                         Stack(),
-                         Stack(),
-                         Stack(),
-                         Stack(),
-                         Stack(),
-                         Stack(),
-                         Stack()),
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
+        collate_fn=collate_fn,
         pin_memory=pin_memory,
         drop_last=False,
-        num_workers=num_workers)
+        num_workers=num_workers,
+        **_worker_options(num_workers, prefetch_factor, persistent_workers))
 
     return dataloader, dataset
 
 
 def validdataloader(path="Dataset/valid", input_size=(512, 512), input_frame_number=1,
-                    batch_size=1, pin_memory=True, num_workers=4, shuffle=True, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225],
-                    scale_factor=4, make_target=True):
-
-    num_workers = 0 if pin_memory else num_workers
-
-    transform = CenterValidTransform(input_size, input_frame_number=input_frame_number, mean=mean, std=std, scale_factor=scale_factor, make_target=make_target,
-                                     num_classes=DetectionDataset(path=path).num_class)
-    dataset = DetectionDataset(path=path, transform=transform, sequence_number=input_frame_number)
+                    batch_size=1, pin_memory=True, num_workers=4, prefetch_factor=2, persistent_workers=True, shuffle=True, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225],
+                    scale_factor=4, make_target=True, max_objects=1024, target_on_device=False, distributed=False, channels_last=False):
+
+    transform = CenterValidTransform(input_size, input_frame_number=input_frame_number, mean=mean, std=std, scale_factor=scale_factor, make_target=make_target and not target_on_device,
+                                     num_classes=DetectionDataset(path=path).num_class, max_objects=max_objects)
+    dataset = DetectionDataset(path=path, transform=transform, sequence_number=input_frame_number,
+                               keep_origin=not target_on_device)
+
+    if target_on_device:
+        # target 은 학습 device 에서 TargetGenerator(on_device=True) 로 만든다. - worker 는 image, box, 이름만 넘긴다.
+        collate_fn = Tuple(Stack(channels_last=channels_last), Pad(pad_val=-1), Stack())
+    else:
+        collate_fn = Tuple(Stack(channels_last=channels_last),
+                           Pad(pad_val=-1),
+                           Stack(),
+                           Stack(),
+                           Stack(),
+                           Stack(),
+                           Stack(),
+                           Stack(),
+                           Stack())
+
+    sampler = DistributedSampler(dataset, shuffle=shuffle) if distributed else None
 
     dataloader = DataLoader(
         dataset,
         batch_size=batch_size,
-        shuffle=shuffle,
-        collate_fn=Tuple(Stack(),
-                         Pad(pad_val=-1),
-                         Stack(),
-                         Stack(),
-                         Stack(),
-                         Stack(),
-                         Stack(),
-                         Stack(),
-                         Stack()),
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
+        collate_fn=collate_fn,
         drop_last=False,
         pin_memory=pin_memory,
-        num_workers=num_workers)
+        num_workers=num_workers,
+        **_worker_options(num_workers, prefetch_factor, persistent_workers))
 
     return dataloader, dataset
 
 
 def testdataloader(path="Dataset/test", input_size=(512, 512), input_frame_number=2, pin_memory=True,
-                   num_workers=4, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], scale_factor=4):
-
-    num_workers = 0 if pin_memory else num_workers
+                   num_workers=4, prefetch_factor=2, persistent_workers=True, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], scale_factor=4):
 
     transform = CenterValidTransform(input_size, input_frame_number=input_frame_number, mean=mean, std=std, scale_factor=scale_factor, make_target=False)
     dataset = DetectionDataset(path=path, transform=transform, sequence_number=input_frame_number)
@@ -164,7 +216,8 @@ def testdataloader(path="Dataset/test", input_size=(512, 512), input_frame_numbe
                          Stack(),
                          Pad(pad_val=-1)),
         pin_memory=pin_memory,
-        num_workers=num_workers)
+        num_workers=num_workers,
+        **_worker_options(num_workers, prefetch_factor, persistent_workers))
     return dataloader, dataset
 
 # test
@@ -13,6 +13,26 @@ if os.path.isfile(logfilepath):
 logging.basicConfig(filename=logfilepath, level=logging.INFO)
 
 
+class _StringTable(object):
+
+    '''
+    문자열 list 를 하나의 utf-8 byte 배열 + offset 배열로 보관
+    python list 의 str 객체는 fork 된 worker 에서 읽기만 해도 refcount 가 바뀌어 page 가 복사(copy-on-write)되지만,
+    numpy 배열은 refcount 를 건드리지 않으므로 worker 메모리가 epoch 동안 늘어나지 않는다.
+    '''
+    def __init__(self, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+        self._offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=self._offsets[1:])
+        self._buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    def __getitem__(self, idx):
+        return self._buffer[self._offsets[idx]:self._offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
 class DetectionDataset(Dataset):
     """
     Parameters
@@ -20,10 +40,12 @@ class DetectionDataset(Dataset):
     path : str(jpg)
         Path to input image directory.
     transform : object
+    keep_origin : bool
+        transform 이 target 을 만들지 않을 때(결과가 3개), 원본 image / label 도 같이 돌려줄지 - 학습 device 에서 target 을 만들면 필요 없다.
     """
     CLASSES = ['faces']
 
-    def __init__(self, path='Dataset/train', transform=None, sequence_number=1):
+    def __init__(self, path='Dataset/train', transform=None, sequence_number=1, keep_origin=True):
         super(DetectionDataset, self).__init__()
         if sequence_number < 1 and isinstance(sequence_number, float):
             logging.error(f"{sequence_number} Must be greater than 0")
@@ -36,8 +58,7 @@ class DetectionDataset(Dataset):
         self._label_txt = os.path.join(self._image_path.replace("images", "labels"), "label.txt")
 
         self._transform = transform
-        self._items = []
-        self._itemname = []
+        self._keep_origin = keep_origin
 
         self.landmark_number = 10
 
@@ -68,39 +89,42 @@ class DetectionDataset(Dataset):
                         line = line.strip("\n")
                         label_dict[count].append(line)
 
-            for i, image_path in enumerate(image_path_list):
-                self._items.append(([image_path], label_dict[i]))
-
-                # 이름 저장
-                base_image = os.path.basename(image_path)
-                #name = os.path.splitext(base_image)[0]
-                self._itemname.append(base_image)
+            # label 은 한번만 parsing 해서 CSR 형태로 보관 - i 번째 image 의 label 은 labels[offsets[i]:offsets[i+1]]
+            labels = [self._parsing(label_dict[i]) for i in range(len(image_path_list))]
         else:
+            image_path_list = []
+            labels = []
             logging.info("The dataset does not exist")
 
+        self._offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+        np.cumsum([len(label) for label in labels], out=self._offsets[1:])
+        self._labels = np.concatenate(labels, axis=0) if labels else np.zeros((0, 15), dtype=np.float32)
+
+        # worker 에서 copy-on-write 가 일어나지 않도록 python list 대신 numpy 배열로 보관
+        self._image_path_List = _StringTable(image_path_list)
+
     def __getitem__(self, idx):
 
-        images = []
-        image_sequence_path, label_string = self._items[idx]
-        for image_path in image_sequence_path:
-            image = cv2.imread(image_path, flags=-1)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            images.append(image)
-        images = np.concatenate(images, axis=-1)
-        origin_images = images.copy()
+        image = cv2.imread(self._image_path_List[idx], flags=-1)
+        images = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        origin_images = images.copy() if self._keep_origin else None
 
-        label = self._parsing(label_string)
-        origin_label = label.copy()
+        # transform 에서 값을 바꿀 수 있으므로 복사
+        label = self._labels[self._offsets[idx]:self._offsets[idx + 1]].copy()
+        origin_label = label.copy() if self._keep_origin else None
+        name = os.path.basename(self._image_path_List[idx])
 
         if self._transform:
-            result = self._transform(images, label, self._itemname[idx])
+            result = self._transform(images, label, name)
             if len(result) == 3:
+                if not self._keep_origin:
+                    return result[0], result[1], result[2]
                 return result[0], result[1], result[2], torch.as_tensor(origin_images), torch.as_tensor(origin_label)
             else:
                 return result[0], result[1], result[2], result[3], result[4], result[5], result[
                     6], result[7], result[8]
         else:
-            return images, label, self._itemname[idx]
+            return images, label, name
 
     def _parsing(self, label_string):
 
@@ -141,7 +165,7 @@ class DetectionDataset(Dataset):
         return self._name + " " + "dataset"
 
     def __len__(self):
-        return len(self._items)
+        return len(self._image_path_List)
 
 
 # test
@@ -170,3 +194,17 @@ if __name__ == "__main__":
     images length: 1499
     sequence image shape: (720, 1280, 9)
     '''
+
+    # worker 별 private RSS(MB) - copy-on-write 로 복사된 page 가 여기에 잡히므로, epoch 동안 늘어나지 않아야 한다. (linux)
+    from torch.utils.data import DataLoader, get_worker_info
+
+    def worker_rss(batch):
+        with open("/proc/self/statm") as f:
+            _, resident, shared = [int(page) for page in f.read().split()[:3]]
+        return get_worker_info().id, (resident - shared) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+    rss = {}
+    for worker_id, memory in DataLoader(dataset, batch_size=8, shuffle=True, collate_fn=worker_rss, num_workers=4):
+        rss.setdefault(worker_id, []).append(memory)
+    for worker_id, memory in sorted(rss.items()):
+        print(f"worker {worker_id} RSS : start {memory[0]:0.1f}MB, middle {memory[len(memory) // 2]:0.1f}MB, end {memory[-1]:0.1f}MB")
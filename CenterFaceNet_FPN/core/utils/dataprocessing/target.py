@@ -1,3 +1,6 @@
+import logging
+from functools import lru_cache
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -6,11 +9,15 @@ import torch.nn as nn
 # object size-adaptive standard deviation 구하기
 # https://en.wikipedia.org/wiki/Gaussian_function
 def gaussian_radius(height=512, width=512, min_overlap=0.7):
+
+    '''
+    height, width 가 배열이면 box 마다의 radius 를 한번에 구한다.
+    '''
     a1 = 1
     b1 = (height + width)
     c1 = width * height * (1 - min_overlap) / (1 + min_overlap)
 
-    temp = max(0, b1 ** 2 - 4 * a1 * c1)
+    temp = np.maximum(0, b1 ** 2 - 4 * a1 * c1)
     sq1 = np.sqrt(temp)
     r1 = (b1 + sq1) / 2
 
@@ -18,7 +25,7 @@ def gaussian_radius(height=512, width=512, min_overlap=0.7):
     b2 = 2 * (height + width)
     c2 = (1 - min_overlap) * width * height
 
-    temp = max(0, b2 ** 2 - 4 * a2 * c2)
+    temp = np.maximum(0, b2 ** 2 - 4 * a2 * c2)
     sq2 = np.sqrt(temp)
     r2 = (b2 + sq2) / 2
 
@@ -26,11 +33,12 @@ def gaussian_radius(height=512, width=512, min_overlap=0.7):
     b3 = -2 * min_overlap * (height + width)
     c3 = (min_overlap - 1) * width * height
 
-    temp = max(0, b3 ** 2 - 4 * a3 * c3)
+    temp = np.maximum(0, b3 ** 2 - 4 * a3 * c3)
     sq3 = np.sqrt(temp)
     r3 = (b3 + sq3) / 2
 
-    return max(0, int(min(r1, r2, r3)))
+    radius = np.maximum(0, np.minimum(np.minimum(r1, r2), r3).astype(np.int64))
+    return int(radius) if np.ndim(radius) == 0 else radius
 
 
 def gaussian_2d(shape=(10, 10), sigma=1):
@@ -40,9 +48,17 @@ def gaussian_2d(shape=(10, 10), sigma=1):
     return h
 
 
-def draw_gaussian(heatmap, center_x, center_y, radius, k=1):
+# radius 별 gaussian kernel - 같은 radius 는 한번만 만든다. (읽기 전용)
+@lru_cache(maxsize=1024)
+def gaussian_kernel(radius):
     diameter = 2 * radius + 1  # 홀수
-    gaussian = gaussian_2d(shape=(diameter, diameter), sigma=diameter / 6)
+    kernel = gaussian_2d(shape=(diameter, diameter), sigma=diameter / 6)
+    kernel.setflags(write=False)
+    return kernel
+
+
+def draw_gaussian(heatmap, center_x, center_y, radius, k=1):
+    gaussian = gaussian_kernel(radius)
 
     # 경계선에서 어떻게 처리 할지
     height, width = heatmap.shape[0:2]
@@ -63,15 +79,172 @@ def draw_gaussian(heatmap, center_x, center_y, radius, k=1):
     np.maximum(masked_heatmap, masked_gaussian * k, out=masked_heatmap)
 
 
+def draw_gaussians(heatmap, batch, ids, center_x, center_y, radius):
+
+    '''
+    (batch, class, height, width) heatmap 에 여러 box 의 gaussian 을 한번에 그리기 - box 마다 draw_gaussian 을 부른 것과 같은 결과
+    같은 radius 의 box 끼리 묶어서 kernel 이 덮는 pixel 의 위치와 값을 한번에 만들고, 여러 box 가 겹치는 pixel 은 최댓값만 쓴다.
+    heatmap 은 contiguous 해야 한다.(np.zeros 로 만든 배열)
+    '''
+    _, num_classes, height, width = heatmap.shape
+    plane = (batch.astype(np.int64) * num_classes + ids.astype(np.int64)) * height
+
+    indices = []
+    values = []
+    for r in np.unique(radius):
+        select = radius == r
+        offset = np.arange(-r, r + 1)
+        y = center_y[select, None, None] + offset[None, :, None]
+        x = center_x[select, None, None] + offset[None, None, :]
+        valid = (y >= 0) & (y < height) & (x >= 0) & (x < width)
+        index = (plane[select, None, None] + y) * width + x
+        indices.append(index[valid])
+        values.append(np.broadcast_to(gaussian_kernel(int(r)), valid.shape)[valid])
+
+    if not indices:
+        return
+    index = np.concatenate(indices)
+    value = np.concatenate(values)
+
+    # pixel 별 최댓값 - index 순, 같은 index 안에서는 value 순으로 정렬하고 마지막 것만 남긴다.
+    order = np.lexsort((value, index))
+    index, value = index[order], value[order]
+    last = np.append(index[1:] != index[:-1], True)
+    index, value = index[last], value[last]
+
+    flat = heatmap.reshape(-1)
+    flat[index] = np.maximum(flat[index], value)
+
+
+def _last_unique(batch, center_x, center_y, output_width, output_height):
+    # 같은 위치에 중심이 여러개면 box 순서상 마지막 것이 남도록(box 마다 차례로 쓰던 것과 같게) 위치마다 마지막 box 만 고른다.
+    # np.unique 는 위치 순으로 정렬된 index 를 주므로, box 순서로 되돌린다.
+    key = (batch * output_height + center_y) * output_width + center_x
+    _, index = np.unique(key[::-1], return_index=True)
+    return np.sort(len(key) - 1 - index)
+
+
+# 아래는 위의 numpy 함수들과 같은 값을 만드는 torch 버전 - 학습 device 에서 batch 단위로 target 을 만들 때 쓴다.
+def gaussian_radius_tensor(height, width, min_overlap=0.7):
+
+    '''
+    gaussian_radius 와 연산 순서가 같아서 같은 radius 가 나온다. (box 마다의 (N,) tensor)
+    '''
+    a1 = 1
+    b1 = (height + width)
+    c1 = width * height * (1 - min_overlap) / (1 + min_overlap)
+
+    temp = torch.clamp(b1 ** 2 - 4 * a1 * c1, min=0)
+    sq1 = torch.sqrt(temp)
+    r1 = (b1 + sq1) / 2
+
+    a2 = 4
+    b2 = 2 * (height + width)
+    c2 = (1 - min_overlap) * width * height
+
+    temp = torch.clamp(b2 ** 2 - 4 * a2 * c2, min=0)
+    sq2 = torch.sqrt(temp)
+    r2 = (b2 + sq2) / 2
+
+    a3 = 4 * min_overlap
+    b3 = -2 * min_overlap * (height + width)
+    c3 = (min_overlap - 1) * width * height
+
+    temp = torch.clamp(b3 ** 2 - 4 * a3 * c3, min=0)
+    sq3 = torch.sqrt(temp)
+    r3 = (b3 + sq3) / 2
+
+    return torch.clamp(torch.min(torch.min(r1, r2), r3).long(), min=0)
+
+
+# gaussian_kernel 을 device 에 올려둔 것 - numpy kernel 을 그대로 복사하므로 값이 같다. (읽기 전용)
+@lru_cache(maxsize=1024)
+def device_gaussian_kernel(radius, device):
+    return torch.tensor(gaussian_kernel(radius), device=device)
+
+
+def draw_gaussians_tensor(heatmap, batch, ids, center_x, center_y, radius):
+
+    '''
+    draw_gaussians 의 torch 버전 - heatmap 이 있는 device 에서 그린다.
+    pytorch 1.7 에는 max 로 모으는 scatter 가 없어서, 겹치는 pixel 의 최댓값은 정렬로 구한다.
+    '''
+    _, num_classes, height, width = heatmap.shape
+    device = heatmap.device
+    plane = (batch * num_classes + ids) * height
+
+    indices = []
+    values = []
+    for r in torch.unique(radius).tolist():
+        select = radius == r
+        offset = torch.arange(-r, r + 1, device=device)
+        y = center_y[select].reshape(-1, 1, 1) + offset.reshape(1, -1, 1)
+        x = center_x[select].reshape(-1, 1, 1) + offset.reshape(1, 1, -1)
+        valid = (y >= 0) & (y < height) & (x >= 0) & (x < width)
+        index = (plane[select].reshape(-1, 1, 1) + y) * width + x
+        indices.append(index[valid])
+        values.append(device_gaussian_kernel(r, device).expand(valid.shape)[valid])
+
+    if not indices:
+        return
+    index = torch.cat(indices)
+    value = torch.cat(values)
+
+    # pixel 별 최댓값 - value 의 순위를 섞은 key(모두 다르다.)로 정렬하면 같은 index 안에서 마지막 것이 최댓값
+    number = index.shape[0]
+    rank = torch.empty_like(index)
+    rank[torch.argsort(value)] = torch.arange(number, device=device)
+    order = torch.argsort(index * number + rank)
+    index, value = index[order], value[order]
+    last = torch.ones_like(index, dtype=torch.bool)
+    last[:-1] = index[1:] != index[:-1]
+    index, value = index[last], value[last]
+
+    flat = heatmap.view(-1)
+    flat[index] = torch.max(flat[index].double(), value).float()
+
+
+def _last_unique_tensor(batch, center_x, center_y, output_width, output_height):
+    # _last_unique 의 torch 버전 - torch 1.7 의 sort 는 stable 하지 않으므로 box 순서를 key 에 섞어서 정렬한다.
+    key = (batch * output_height + center_y) * output_width + center_x
+    number = key.shape[0]
+    order = torch.argsort(key * number + torch.arange(number, device=key.device))
+    key = key[order]
+    last = torch.ones_like(key, dtype=torch.bool)
+    last[:-1] = key[1:] != key[:-1]
+    # 위치 순으로 정렬되어 있으므로 box 순서로 되돌린다.
+    return torch.sort(order[last])[0]
+
+
+def _warn_dropped(number, max_objects):
+    # 잘린 object 는 heatmap 에는 그려지지만 wh / offset 학습에서는 빠진다.
+    logging.warning(f"{number} object(s) exceed max_objects({max_objects}) - only their heatmap is trained, increase max_objects")
+
+
 # https://github.com/xingyizhou/CenterNet/blob/master/src/lib/utils/image.py
 class TargetGenerator(nn.Module):
 
-    def __init__(self, num_classes=3):
+    '''
+    heatmap 만 dense (batch, class, height, width) 로 만들고, offset / wh / landmark 는 object 중심에서의 값만 sparse 하게 만든다.
+    - index_target : (batch, max_objects) - object 중심의 flatten 위치 (center_y * output_width + center_x)
+    - offset_target, wh_target : (batch, max_objects, 2), landmark_target : (batch, max_objects, 10)
+    - mask_target : (batch, max_objects) - object 가 있는 칸은 1, 나머지는 0 (landmark 에도 같은 mask 를 쓴다.)
+    한 image 의 object 가 max_objects 보다 많으면 max_objects 개만 쓴다.
+
+    on_device=True 이면 gt_boxes / gt_ids 를 받은 device 에서 torch 로 만든다. (numpy 로 만든 것과 같은 값)
+    - dataloader worker 는 box 만 넘기고, dense heatmap 은 학습 device 에서 바로 만든다.
+    '''
+    def __init__(self, num_classes=3, max_objects=1024, on_device=False):
         super(TargetGenerator, self).__init__()
         self._num_classes = num_classes
+        self._max_objects = max_objects
+        self._on_device = on_device
 
     def forward(self, gt_boxes, gt_ids, gt_landmarks, output_width, output_height, device):
 
+        if self._on_device:
+            return self._forward_tensor(gt_boxes, gt_ids, gt_landmarks, output_width, output_height, device)
+
         if isinstance(gt_boxes, torch.Tensor):
             gt_boxes = gt_boxes.detach().cpu().numpy()
         if isinstance(gt_landmarks, torch.Tensor):
@@ -82,61 +255,123 @@ class TargetGenerator(nn.Module):
         batch_size = gt_boxes.shape[0]
         heatmap = np.zeros((batch_size, self._num_classes, output_height, output_width),
                            dtype=np.float32)
-        offset_target = np.zeros((batch_size, 2, output_height, output_width), dtype=np.float32)
-        wh_target = np.zeros((batch_size, 2, output_height, output_width), dtype=np.float32)
+        offset_target = np.zeros((batch_size, self._max_objects, 2), dtype=np.float32)
+        wh_target = np.zeros((batch_size, self._max_objects, 2), dtype=np.float32)
 
         '''
             for face five(x,y) points landmark
             중심으로부터의 offset을 계산하자
         '''
         _, _, repeats = gt_landmarks.shape
-        landmark_target = np.zeros((batch_size, repeats, output_height, output_width), dtype=np.float32)
-        mask_target = np.zeros((batch_size, 2, output_height, output_width), dtype=np.float32)
-        landmarks_mask_target = np.zeros((batch_size, repeats, output_height, output_width), dtype=np.float32)
+        landmark_target = np.zeros((batch_size, self._max_objects, repeats), dtype=np.float32)
+        mask_target = np.zeros((batch_size, self._max_objects), dtype=np.float32)
+        index_target = np.zeros((batch_size, self._max_objects), dtype=np.int64)
 
-        for batch, gt_box, gt_id, gt_landmark in zip(range(len(gt_boxes)), gt_boxes, gt_ids, gt_landmarks):
-            for bbox, id, landmark in zip(gt_box, gt_id, gt_landmark):
+        # box 단위 python loop 대신 batch 의 모든 box 를 한번에 계산
+        bbox = gt_boxes.reshape(-1, 4)
+        id = gt_ids.reshape(-1)
+        landmark = gt_landmarks.reshape(-1, repeats)
+        batch = np.repeat(np.arange(batch_size), gt_boxes.shape[1])
 
-                # background인 경우
-                if bbox[0] == -1 or bbox[1] == -1 or bbox[2] == -1 or bbox[3] == -1 or id == -1:
-                    continue
+        # background인 경우
+        foreground = np.all(bbox != -1, axis=-1) & (id != -1)
+        bbox, id, landmark, batch = bbox[foreground], id[foreground], landmark[foreground], batch[foreground]
 
-                box_h, box_w = bbox[3] - bbox[1], bbox[2] - bbox[0]
-                center = np.array(
-                    [(bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2],
-                    dtype=np.float32)
-                center_int = center.astype(np.int32)
-                center_x, center_y = center_int
+        box_h, box_w = bbox[:, 3] - bbox[:, 1], bbox[:, 2] - bbox[:, 0]
+        center = np.stack([(bbox[:, 0] + bbox[:, 2]) / 2, (bbox[:, 1] + bbox[:, 3]) / 2], axis=-1).astype(np.float32)
+        center_int = center.astype(np.int32)
 
-                # data augmentation으로 인해 범위가 넘어갈수 가 있음.
-                center_x = np.clip(center_x, 0, output_width - 1)
-                center_y = np.clip(center_y, 0, output_height - 1)
+        # data augmentation으로 인해 범위가 넘어갈수 가 있음.
+        center_x = np.clip(center_int[:, 0], 0, output_width - 1)
+        center_y = np.clip(center_int[:, 1], 0, output_height - 1)
 
-                # heatmap
-                # C:\ProgramData\Anaconda3\Lib\site-packages\gluoncv\model_zoo\center_net\target_generator.py
-                radius = gaussian_radius(height=box_h, width=box_w)
-                radius = max(0, int(radius))
+        # heatmap
+        # C:\ProgramData\Anaconda3\Lib\site-packages\gluoncv\model_zoo\center_net\target_generator.py
+        radius = gaussian_radius(height=box_h, width=box_w)
 
-                # 가우시안 그리기 - inplace 연산(np.maximum)
-                draw_gaussian(heatmap[batch, int(id), ...], center_x, center_y,
-                              radius)
-                # wh
-                box = np.array([box_w, box_h], dtype=np.float32)
-                wh_target[batch, :, center_y, center_x] = box
+        # 가우시안 그리기 - inplace 연산
+        draw_gaussians(heatmap, batch, id, center_x, center_y, radius)
 
-                # center offset
-                offset_target[batch, :, center_y, center_x] = center - center_int
+        # 중심이 같은 object 는 하나만, image 마다 앞에서부터 max_objects 개까지
+        last = _last_unique(batch, center_x, center_y, output_width, output_height)
+        batch, center_x, center_y = batch[last], center_x[last], center_y[last]
+        slot = np.arange(len(batch)) - np.searchsorted(batch, batch, side="left")  # image 안에서의 순서 (batch 는 정렬되어 있다.)
+        keep = slot < self._max_objects
+        if not keep.all():
+            _warn_dropped(len(keep) - int(keep.sum()), self._max_objects)
+        last, batch, slot = last[keep], batch[keep], slot[keep]
 
-                # landmark - center / (width, height)
-                center = center.tolist()
-                center_repeat = (repeats//2)*center #np.repeat([center], 5, axis=0).ravel()
-                landmark_target[batch, :, center_y, center_x] = landmark-center_repeat
-                
-                # mask
-                mask_target[batch, :, center_y, center_x] = 1.0
-                landmarks_mask_target[batch, :, center_y, center_x] = 1.0
+        index_target[batch, slot] = (center_y * output_width + center_x)[keep]
+
+        # wh
+        wh_target[batch, slot] = np.stack([box_w, box_h], axis=-1).astype(np.float32)[last]
+
+        # center offset
+        offset_target[batch, slot] = (center - center_int)[last]
+
+        # landmark - center / (width, height)
+        center_repeat = np.tile(center.astype(np.float64), (1, repeats // 2))
+        landmark_target[batch, slot] = (landmark - center_repeat)[last]
+
+        # mask
+        mask_target[batch, slot] = 1.0
+
+        return tuple([torch.as_tensor(ele, device=device) for ele in (heatmap, offset_target, wh_target, landmark_target, mask_target, index_target)])
+
+    def _forward_tensor(self, gt_boxes, gt_ids, gt_landmarks, output_width, output_height, device):
+
+        # forward 와 같은 계산을 device 위의 tensor 로
+        gt_boxes = torch.as_tensor(gt_boxes, device=device)
+        gt_ids = torch.as_tensor(gt_ids, device=device)
+        gt_landmarks = torch.as_tensor(gt_landmarks, device=device)
+
+        batch_size = gt_boxes.shape[0]
+        _, _, repeats = gt_landmarks.shape
+        heatmap = torch.zeros((batch_size, self._num_classes, output_height, output_width), dtype=torch.float32, device=device)
+        offset_target = torch.zeros((batch_size, self._max_objects, 2), dtype=torch.float32, device=device)
+        wh_target = torch.zeros((batch_size, self._max_objects, 2), dtype=torch.float32, device=device)
+        landmark_target = torch.zeros((batch_size, self._max_objects, repeats), dtype=torch.float32, device=device)
+        mask_target = torch.zeros((batch_size, self._max_objects), dtype=torch.float32, device=device)
+        index_target = torch.zeros((batch_size, self._max_objects), dtype=torch.int64, device=device)
+
+        bbox = gt_boxes.reshape(-1, 4)
+        id = gt_ids.reshape(-1)
+        landmark = gt_landmarks.reshape(-1, repeats)
+        batch = torch.arange(batch_size, device=device).repeat_interleave(gt_boxes.shape[1])
+
+        # background인 경우
+        foreground = torch.all(bbox != -1, dim=-1) & (id != -1)
+        bbox, id, landmark, batch = bbox[foreground], id[foreground].long(), landmark[foreground], batch[foreground]
+
+        box_h, box_w = bbox[:, 3] - bbox[:, 1], bbox[:, 2] - bbox[:, 0]
+        center = torch.stack([(bbox[:, 0] + bbox[:, 2]) / 2, (bbox[:, 1] + bbox[:, 3]) / 2], dim=-1).float()
+        center_int = center.int()
+
+        # data augmentation으로 인해 범위가 넘어갈수 가 있음.
+        center_x = torch.clamp(center_int[:, 0].long(), 0, output_width - 1)
+        center_y = torch.clamp(center_int[:, 1].long(), 0, output_height - 1)
+
+        radius = gaussian_radius_tensor(height=box_h, width=box_w)
+        draw_gaussians_tensor(heatmap, batch, id, center_x, center_y, radius)
+
+        last = _last_unique_tensor(batch, center_x, center_y, output_width, output_height)
+        batch, center_x, center_y = batch[last], center_x[last], center_y[last]
+        slot = torch.arange(batch.shape[0], device=device) - torch.searchsorted(batch, batch)
+        keep = slot < self._max_objects
+        # object 가 max_objects 개 이하면 잘린 것이 없으므로 host 와 동기화하지 않는다.
+        if keep.shape[0] > self._max_objects and not bool(keep.all()):
+            _warn_dropped(keep.shape[0] - int(keep.sum()), self._max_objects)
+        last, batch, slot = last[keep], batch[keep], slot[keep]
+
+        index_target[batch, slot] = (center_y * output_width + center_x)[keep]
+        wh_target[batch, slot] = torch.stack([box_w, box_h], dim=-1).float()[last]
+        offset_target[batch, slot] = (center - center_int.float())[last]
+        center_repeat = center.double().repeat(1, repeats // 2)
+        landmark_target[batch, slot] = (landmark.double() - center_repeat)[last].float()
+        mask_target[batch, slot] = 1.0
+
+        return heatmap, offset_target, wh_target, landmark_target, mask_target, index_target
 
-        return tuple([torch.as_tensor(ele, device=device) for ele in (heatmap, offset_target, wh_target, landmark_target, mask_target, landmarks_mask_target)])
 
 # test
 if __name__ == "__main__":
@@ -163,7 +398,7 @@ if __name__ == "__main__":
     gt_boxes = label[:, :, :4]
     gt_ids = label[:, :, 4:5]
     gt_landmarks = label[:, :, 5:]
-    heatmap_target, offset_target, wh_target, landmark_target, mask_target, landmarks_mask_target = targetgenerator(gt_boxes, gt_ids, gt_landmarks,
+    heatmap_target, offset_target, wh_target, landmark_target, mask_target, index_target = targetgenerator(gt_boxes, gt_ids, gt_landmarks,
                                                                                                                     input_size[1] // scale_factor,
                                                                                                                     input_size[0] // scale_factor, image.device)
 
@@ -172,12 +407,81 @@ if __name__ == "__main__":
     print(f"wh_targets shape : {wh_target.shape}")
     print(f"landmark_target shape : {landmark_target.shape}")
     print(f"mask_targets shape : {mask_target.shape}")
-    print(f"landmarks_mask_target shape : {landmarks_mask_target.shape}")
+    print(f"index_target shape : {index_target.shape}")
     '''
     heatmap_targets shape : torch.Size([1, 1, 192, 320])
-    offset_targets shape : torch.Size([1, 2, 192, 320])
-    wh_targets shape : torch.Size([1, 2, 192, 320])
-    landmark_target shape : torch.Size([1, 10, 192, 320])
-    mask_targets shape : torch.Size([1, 2, 192, 320])
-    landmarks_mask_target shape : torch.Size([1, 10, 192, 320])
+    offset_targets shape : torch.Size([1, 1024, 2])
+    wh_targets shape : torch.Size([1, 1024, 2])
+    landmark_target shape : torch.Size([1, 1024, 10])
+    mask_targets shape : torch.Size([1, 1024])
+    index_target shape : torch.Size([1, 1024])
     '''
+
+    # box 마다 python loop 로 그리던 방식과 같은 결과인지, 얼마나 빠른지 - 작은 box 가 많은 경우
+    import time
+
+    def loop_target(gt_boxes, gt_ids, output_width, output_height):
+        heatmap = np.zeros((gt_boxes.shape[0], num_classes, output_height, output_width), dtype=np.float32)
+        wh_target = np.zeros((gt_boxes.shape[0], 2, output_height, output_width), dtype=np.float32)
+        for batch, gt_box, gt_id in zip(range(len(gt_boxes)), gt_boxes, gt_ids):
+            for bbox, id in zip(gt_box, gt_id.reshape(-1)):
+                if bbox[0] == -1 or id == -1:
+                    continue
+                center_x, center_y = np.array([(bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2], dtype=np.float32).astype(np.int32)
+                center_x = np.clip(center_x, 0, output_width - 1)
+                center_y = np.clip(center_y, 0, output_height - 1)
+                radius = gaussian_radius(height=bbox[3] - bbox[1], width=bbox[2] - bbox[0])
+                draw_gaussian(heatmap[batch, int(id), ...], center_x, center_y, radius)
+                wh_target[batch, :, center_y, center_x] = np.array([bbox[2] - bbox[0], bbox[3] - bbox[1]], dtype=np.float32)
+        return heatmap, wh_target
+
+    output_width, output_height = input_size[1] // scale_factor, input_size[0] // scale_factor
+    xy = np.random.uniform(0, output_width - 1, size=(8, 500, 2)).astype(np.float32)
+    wh = np.random.uniform(1, 12, size=(8, 500, 2)).astype(np.float32)
+    gt_boxes = np.concatenate([xy, xy + wh], axis=-1)
+    gt_ids = np.random.randint(0, num_classes, size=(8, 500, 1)).astype(np.float32)
+    gt_landmarks = np.random.uniform(0, output_width - 1, size=(8, 500, 10)).astype(np.float32)
+    gt_boxes[:, -50:] = -1  # padding
+    gt_ids[:, -50:] = -1
+
+    start = time.time()
+    loop_heatmap, loop_wh = loop_target(gt_boxes, gt_ids, output_width, output_height)
+    loop_time = time.time() - start
+    start = time.time()
+    heatmap_target, _, wh_target, _, mask_target, index_target = targetgenerator(gt_boxes, gt_ids, gt_landmarks, output_width, output_height, "cpu")
+    vector_time = time.time() - start
+
+    # sparse wh 를 dense 로 펼쳐서 비교
+    sparse_wh = np.zeros_like(loop_wh)
+    batch, slot = np.nonzero(mask_target.numpy())
+    index = index_target.numpy()[batch, slot]
+    sparse_wh[batch, :, index // output_width, index % output_width] = wh_target.numpy()[batch, slot]
+    print(f"same heatmap : {np.array_equal(loop_heatmap, heatmap_target.numpy())}, same wh : {np.array_equal(loop_wh, sparse_wh)}")
+    print(f"loop : {loop_time:0.4f}s, vectorized : {vector_time:0.4f}s")
+
+    # on_device=True 로 만든 target 이 numpy 로 만든 것과 같은지 - cuda 가 있으면 cuda 에서
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    numpy_targets = TargetGenerator(num_classes=num_classes, max_objects=500)(gt_boxes, gt_ids, gt_landmarks, output_width, output_height, "cpu")
+    device_generator = TargetGenerator(num_classes=num_classes, max_objects=500, on_device=True)
+    tensors = [torch.as_tensor(ele, device=device) for ele in (gt_boxes, gt_ids, gt_landmarks)]
+    start = time.time()
+    device_targets = device_generator(*tensors, output_width, output_height, device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    device_time = time.time() - start
+    print(f"same as numpy target : {all(torch.equal(a, b.cpu()) for a, b in zip(numpy_targets, device_targets))}")
+    print(f"on device({device}) : {device_time:0.4f}s")
+
+    # object 가 max_objects 보다 많으면 image 마다 box 순서상 앞에서부터 max_objects 개만 쓴다. (중심이 모두 다른 box)
+    max_objects = 64
+    position = np.random.permutation(output_width * output_height)[:450]
+    xy = np.stack([position % output_width, position // output_width], axis=-1).astype(np.float32)
+    crowd_boxes = np.repeat(np.concatenate([xy, xy + 1], axis=-1)[None], 2, axis=0)
+    crowd_ids = np.zeros((2, len(position), 1), dtype=np.float32)
+    crowd_landmarks = gt_landmarks[:2, :len(position)]
+    numpy_targets = TargetGenerator(num_classes=num_classes, max_objects=max_objects)(crowd_boxes, crowd_ids, crowd_landmarks, output_width, output_height, "cpu")
+    tensors = [torch.as_tensor(ele, device=device) for ele in (crowd_boxes, crowd_ids, crowd_landmarks)]
+    device_targets = TargetGenerator(num_classes=num_classes, max_objects=max_objects, on_device=True)(*tensors, output_width, output_height, device)
+    first = np.broadcast_to(position[:max_objects], (2, max_objects))  # center_y * output_width + center_x
+    print(f"first max_objects boxes kept : {np.array_equal(numpy_targets[-1].numpy(), first)}, "
+          f"same as numpy target : {all(torch.equal(a, b.cpu()) for a, b in zip(numpy_targets, device_targets))}")
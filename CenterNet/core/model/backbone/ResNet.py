@@ -1,8 +1,11 @@
+import inspect
 import logging
 import os
+from typing import Tuple
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from torchvision.models.utils import load_state_dict_from_url
 
 logfilepath = ""
@@ -29,6 +32,29 @@ def conv1x1(in_planes, out_planes, stride=1):
     return nn.Conv2d(in_planes, out_planes, kernel_size=1, stride=stride, bias=False)
 
 
+def _checkpoint(stage, x):
+
+    def recompute(x):
+        # reentrant checkpoint 는 처음 forward 를 no_grad 로 하고, backward 때 grad 를 켜고 다시 계산한다.
+        # 다시 계산할 때는 BatchNorm 의 running_mean / running_var / num_batches_tracked 를 update 하지 않는다.
+        # (track_running_stats=False 여도 train mode 에서는 같은 batch 통계로 normalize 하므로 출력은 같다.)
+        if not torch.is_grad_enabled():
+            return stage(x)
+        norms = [m for m in stage.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+        for m in norms:
+            m.track_running_stats = False
+        try:
+            return stage(x)
+        finally:
+            for m in norms:
+                m.track_running_stats = True
+
+    # torch 1.7 의 checkpoint 에는 use_reentrant 인자가 없다. - 최신 버전에서도 같은(reentrant) 방식으로 재계산
+    if "use_reentrant" in inspect.signature(checkpoint).parameters:
+        return checkpoint(recompute, x, use_reentrant=True)
+    return checkpoint(recompute, x)
+
+
 class BasicBlock(nn.Module):
     expansion = 1
 
@@ -122,11 +148,13 @@ class ResNet(nn.Module):
 
     def __init__(self, block, layers, input_frame_number=2, num_classes=1000, zero_init_residual=False,
                  groups=1, width_per_group=64, replace_stride_with_dilation=None,
-                 norm_layer=None):
+                 norm_layer=None, checkpoint_stages=0):
         super(ResNet, self).__init__()
         if norm_layer is None:
             norm_layer = nn.BatchNorm2d
         self._norm_layer = norm_layer
+        # 학습할 때 앞에서부터 몇개의 stage(layer1 ~ layer4) 를 activation checkpointing 할지 - 0 이면 사용 안함
+        self._checkpoint_stages = checkpoint_stages
 
         self.inplanes = 64
         self.dilation = 1
@@ -203,6 +231,9 @@ class ResNet(nn.Module):
         x = self.relu(x)
         x = self.maxpool(x)
 
+        if self._checkpoint_stages > 0 and self.training and not torch.jit.is_scripting():
+            return self._checkpoint_forward(x)
+
         x = self.layer1(x)
         x = self.layer2(x)
         x = self.layer3(x)
@@ -214,6 +245,21 @@ class ResNet(nn.Module):
 
         return x
 
+    @torch.jit.unused
+    def _checkpoint_forward(self, x: torch.Tensor) -> torch.Tensor:
+
+        '''
+        layer1 ~ layer4 를 stage 단위로 activation checkpointing - stage 의 입력만 저장하고, 안의 activation 은 backward 때 다시 계산한다.
+        torch.jit.script 로 export 할 때는 컴파일되지 않고 기존 forward 를 쓴다.
+        다시 계산할 때는 BatchNorm 의 running stats 를 update 하지 않으므로 checkpointing 을 하지 않을 때와 같다.
+        '''
+        for i, layer in enumerate([self.layer1, self.layer2, self.layer3, self.layer4]):
+            if i < self._checkpoint_stages and torch.is_grad_enabled() and not torch.jit.is_tracing():
+                x = _checkpoint(layer, x)
+            else:
+                x = layer(x)
+        return x
+
     def forward(self, x):
         return self._forward_impl(x)
 
@@ -288,18 +334,18 @@ def resnet152(pretrained=False, progress=True, input_frame_number=2, **kwargs):
     return _resnet('resnet152', Bottleneck, [3, 8, 36, 3], pretrained, progress, input_frame_number,
                    **kwargs)
 
-def get_resnet(base, pretrained=False, input_frame_number=2):
+def get_resnet(base, pretrained=False, input_frame_number=2, checkpoint_stages=0):
 
     if base==18:
-        model = resnet18(pretrained=pretrained, input_frame_number=input_frame_number)
+        model = resnet18(pretrained=pretrained, input_frame_number=input_frame_number, checkpoint_stages=checkpoint_stages)
     elif base==34:
-        model = resnet34(pretrained=pretrained, input_frame_number=input_frame_number)
+        model = resnet34(pretrained=pretrained, input_frame_number=input_frame_number, checkpoint_stages=checkpoint_stages)
     elif base==50:
-        model = resnet50(pretrained=pretrained, input_frame_number=input_frame_number)
+        model = resnet50(pretrained=pretrained, input_frame_number=input_frame_number, checkpoint_stages=checkpoint_stages)
     elif base==101:
-        model = resnet101(pretrained=pretrained, input_frame_number=input_frame_number)
+        model = resnet101(pretrained=pretrained, input_frame_number=input_frame_number, checkpoint_stages=checkpoint_stages)
     elif base==152:
-        model = resnet152(pretrained=pretrained, input_frame_number=input_frame_number)
+        model = resnet152(pretrained=pretrained, input_frame_number=input_frame_number, checkpoint_stages=checkpoint_stages)
     else:
         raise ValueError
 
@@ -318,3 +364,16 @@ if __name__ == "__main__":
     < input size(height, width) : (512, 512) >
     < output shape : torch.Size([1, 512, 16, 16]) >
     '''
+
+    # activation checkpointing - 한 step 학습 후 BatchNorm 의 running stats 가 checkpointing 을 하지 않을 때와 같은지 확인
+    x = torch.rand(2, 3, 128, 128)
+    plain = get_resnet(18, pretrained=False, input_frame_number=1, checkpoint_stages=0)
+    checkpointed = get_resnet(18, pretrained=False, input_frame_number=1, checkpoint_stages=4)
+    checkpointed.load_state_dict(plain.state_dict())
+    for net in [plain, checkpointed]:
+        net.train()
+        output = net(x)
+        sum(out.mean() for out in (output if isinstance(output, tuple) else [output])).backward()
+    for (name, plain_buffer), (_, checkpointed_buffer) in zip(plain.named_buffers(), checkpointed.named_buffers()):
+        assert torch.allclose(plain_buffer.float(), checkpointed_buffer.float(), atol=1e-6), name
+    print("< checkpoint_stages 4 : BatchNorm running stats 가 checkpointing 을 하지 않을 때와 같다 >")
@@ -1,6 +1,8 @@
 import glob
 import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from xml.etree.ElementTree import parse
 
 import cv2
@@ -14,6 +16,76 @@ if os.path.isfile(logfilepath):
 logging.basicConfig(filename=logfilepath, level=logging.INFO)
 
 
+def _parse_annotation(path, class_index):
+
+    '''
+    Pascal-VOC xml 하나를 (object number, 5) - xmin, ymin, xmax, ymax, class 로 변환
+    index 를 만들 때 ProcessPoolExecutor 에서 쓰기 위해 module 함수로 둔다.
+    '''
+    xml_list = []
+    try:
+        tree = parse(path)
+        root = tree.getroot()
+        object = root.findall("object")
+        for ob in object:
+            if ob.find("bndbox") != None:
+                bndbox = ob.find("bndbox")
+                xmin, ymin, xmax, ymax = [int(pos.text) for i, pos in enumerate(bndbox.iter()) if i > 0]
+
+                # or
+                # xmin = int(bndbox.findtext("xmin"))
+                # ymin = int(bndbox.findtext("ymin"))
+                # xmax = int(bndbox.findtext("xmax"))
+                # ymax = int(bndbox.findtext("ymax"))
+
+                classes = class_index.get(ob.findtext("name"), -1)
+                if classes < 0:
+                    xmin, ymin, xmax, ymax = -1, -1, -1, -1
+                xml_list.append((xmin, ymin, xmax, ymax, classes))
+            else:
+                '''
+                    image만 있고 labeling 없는 데이터에 대비 하기 위함 - ssd, retinanet loss에는 아무런 영향이 없음.
+                    yolo 대비용임
+                '''
+                print(f"only image : {path}")
+                xml_list.append((-1, -1, -1, -1, -1))
+
+    except Exception:
+        print(f"only image or json crash : {path}")
+        xml_list.append((-1, -1, -1, -1, -1))
+
+    return np.array(xml_list, dtype="float32").reshape((-1, 5))  # 반드시 numpy여야함.
+
+
+def _file_stat(path):
+    # (mtime, size) / 파일이 없으면 (-1, -1)
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return -1, -1
+
+
+class _StringTable(object):
+
+    '''
+    문자열 list 를 하나의 utf-8 byte 배열 + offset 배열로 보관
+    python list 의 str 객체는 fork 된 worker 에서 읽기만 해도 refcount 가 바뀌어 page 가 복사(copy-on-write)되지만,
+    numpy 배열은 refcount 를 건드리지 않으므로 worker 메모리가 epoch 동안 늘어나지 않는다.
+    '''
+    def __init__(self, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+        self._offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=self._offsets[1:])
+        self._buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    def __getitem__(self, idx):
+        return self._buffer[self._offsets[idx]:self._offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
 class DetectionDataset(Dataset):
     """
     Parameters
@@ -21,110 +93,152 @@ class DetectionDataset(Dataset):
     path : str(jpg)
         Path to input image directory.
     transform : object
+    keep_origin : bool
+        transform 이 target 을 만들지 않을 때(결과가 3개), 원본 image / label 도 같이 돌려줄지 - 학습 device 에서 target 을 만들면 필요 없다.
     """
     CLASSES = ['meerkat', 'otter', 'panda', 'raccoon', 'pomeranian']
 
-    def __init__(self, path='Dataset/train', transform=None, sequence_number=1):
+    def __init__(self, path='Dataset/train', transform=None, sequence_number=1, index_cache=True, keep_origin=True):
         super(DetectionDataset, self).__init__()
         if sequence_number < 1 and isinstance(sequence_number, float):
             logging.error(f"{sequence_number} Must be greater than 0")
             return
 
         self._name = os.path.basename(path)
+        self._path = path
         self._sequence_number = sequence_number
-        self._image_path_List = sorted(glob.glob(os.path.join(path, "*.jpg")), key=lambda path: self.key_func(path))
+        self._class_index = {name: i for i, name in enumerate(self.CLASSES)}
+        self._index_cache = index_cache
+        self._index_path = os.path.normpath(path) + ".index.npz"
         self._transform = transform
-        self._items = []
-        self._itemname = []
+        self._keep_origin = keep_origin
         self._make_item_list()
 
     def key_func(self, path):
         return path
 
-    def _make_item_list(self):
+    def _load_index(self):
+
+        try:
+            with np.load(self._index_path, allow_pickle=False) as index:
+                index = {key: index[key] for key in index.files}
+        except Exception:
+            return None
+
+        # class 구성이 바뀌었으면 새로 만든다.
+        if index["classes"].tolist() != list(self.CLASSES):
+            return None
+        return index
 
-        if self._image_path_List:
-            for i in range(len(self._image_path_List) - (self._sequence_number - 1)):
-                image_path = self._image_path_List[i:i + self._sequence_number]
-                xml_path = image_path[-1].replace(".jpg", ".xml")
-                self._items.append((image_path, xml_path))
+    def _build_index(self):
 
-                # 이름 저장
-                base_image = os.path.basename(image_path[-1])
-                #name = os.path.splitext(base_image)[0]
-                self._itemname.append(base_image)
+        '''
+        annotation index 만들기
+        모든 xml 을 한번만 parsing 해서 CSR 형태로 저장 - labels (전체 object number, 5) / offsets (image number + 1)
+        i 번째 image 의 label 은 labels[offsets[i]:offsets[i+1]]
+
+        index 는 dataset 폴더 옆(path + ".index.npz")에 저장하고, 다음 실행부터는
+        1. dataset 폴더의 mtime 이 같으면 (파일 추가/삭제가 없으면) glob, sort 를 생략하고 저장된 image list 를 쓴다.
+        2. xml 의 mtime/size 가 같은 것은 다시 parsing 하지 않는다.
+        '''
+        if not os.path.isdir(self._path):
+            return [], np.zeros((0, 5), dtype=np.float32), np.zeros(1, dtype=np.int64)
+
+        index = self._load_index() if self._index_cache else None
+        directory_mtime = os.stat(self._path).st_mtime_ns
+
+        if index is not None and int(index["directory_mtime"]) == directory_mtime:
+            image_names = index["names"].tolist()
         else:
+            image_names = [os.path.basename(path) for path in
+                           sorted(glob.glob(os.path.join(self._path, "*.jpg")), key=lambda path: self.key_func(path))]
+
+        stats = np.array([_file_stat(os.path.join(self._path, name.replace(".jpg", ".xml"))) for name in image_names],
+                         dtype=np.int64).reshape((-1, 2))
+
+        # 바뀐 것이 없으면 그대로 사용
+        if index is not None and index["names"].tolist() == image_names and np.array_equal(index["stats"], stats):
+            return image_names, index["labels"], index["offsets"]
+
+        labels = [None] * len(image_names)
+        if index is not None:
+            cached = {name: i for i, name in enumerate(index["names"].tolist())}
+            for i, name in enumerate(image_names):
+                j = cached.get(name)
+                if j is not None and np.array_equal(index["stats"][j], stats[i]):
+                    labels[i] = index["labels"][index["offsets"][j]:index["offsets"][j + 1]]
+
+        todo = [i for i, label in enumerate(labels) if label is None]
+        paths = [os.path.join(self._path, image_names[i].replace(".jpg", ".xml")) for i in todo]
+        if len(todo) >= 1024 and (os.cpu_count() or 1) > 1:
+            with ProcessPoolExecutor() as executor:
+                parsed = list(executor.map(_parse_annotation, paths, repeat(self._class_index), chunksize=256))
+        else:
+            parsed = [_parse_annotation(path, self._class_index) for path in paths]
+        for i, label in zip(todo, parsed):
+            labels[i] = label
+
+        offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+        np.cumsum([len(label) for label in labels], out=offsets[1:])
+        labels = np.concatenate(labels, axis=0) if labels else np.zeros((0, 5), dtype=np.float32)
+
+        if self._index_cache and image_names:
+            # DDP 에서는 모든 rank 가 동시에 index 를 만든다 - 같은 임시 파일에 쓰지 않도록 process 마다 이름을 다르게 한다.
+            temp_path = f"{self._index_path}.{os.getpid()}.tmp"
+            try:
+                with open(temp_path, "wb") as f:
+                    np.savez(f, names=np.array(image_names), stats=stats, labels=labels, offsets=offsets,
+                             classes=np.array(self.CLASSES), directory_mtime=np.int64(directory_mtime))
+                os.replace(temp_path, self._index_path)
+            except OSError:
+                logging.warning(f"can not save annotation index : {self._index_path}")
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+        return image_names, labels, offsets
+
+    def _make_item_list(self):
+
+        image_names, self._labels, self._offsets = self._build_index()
+
+        # worker 에서 copy-on-write 가 일어나지 않도록 python list 대신 numpy 배열로 보관
+        # idx 번째 item 은 image[idx:idx + sequence_number] 이고, label 과 이름은 마지막 image 의 것을 쓴다.
+        self._image_path_List = _StringTable([os.path.join(self._path, name) for name in image_names])
+        if len(self._image_path_List) == 0:
             logging.info("The dataset does not exist")
 
+    def _item_name(self, index):
+        return os.path.basename(self._image_path_List[index])
+
     def __getitem__(self, idx):
 
         images = []
-        image_sequence_path, label_path = self._items[idx]
-        for image_path in image_sequence_path:
-            image = cv2.imread(image_path, flags=-1)
+        label_index = idx + self._sequence_number - 1
+        for index in range(idx, label_index + 1):
+            image = cv2.imread(self._image_path_List[index], flags=-1)
             image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
             images.append(image)
         images = np.concatenate(images, axis=-1)
 
-        origin_images = images.copy()
-        label = self._parsing(label_path)  # dtype을 float 으로 해야 아래 단계에서 편하다
-        origin_label = label.copy()
+        origin_images = images.copy() if self._keep_origin else None
+        label = self._label(label_index)  # dtype을 float 으로 해야 아래 단계에서 편하다
+        origin_label = label.copy() if self._keep_origin else None
 
         if self._transform:
-            result = self._transform(images, label, self._itemname[idx])
+            result = self._transform(images, label, self._item_name(label_index))
             if len(result) == 3:
+                if not self._keep_origin:
+                    return result[0], result[1], result[2]
                 return result[0], result[1], result[2], torch.as_tensor(origin_images), torch.as_tensor(origin_label)
             else:
                 return result[0], result[1], result[2], result[3], result[4], result[5], result[
-                    6]
+                    6], result[7]
         else:
-            return images, label, self._itemname[idx]
+            return images, label, self._item_name(label_index)
 
-    def _parsing(self, path):
-        xml_list = []
-        try:
-            tree = parse(path)
-            root = tree.getroot()
-            object = root.findall("object")
-            for ob in object:
-                if ob.find("bndbox") != None:
-                    bndbox = ob.find("bndbox")
-                    xmin, ymin, xmax, ymax = [int(pos.text) for i, pos in enumerate(bndbox.iter()) if i > 0]
-
-                    # or
-                    # xmin = int(bndbox.findtext("xmin"))
-                    # ymin = int(bndbox.findtext("ymin"))
-                    # xmax = int(bndbox.findtext("xmax"))
-                    # ymax = int(bndbox.findtext("ymax"))
-
-                    select = ob.findtext("name")
-                    if select == "meerkat":
-                        classes = 0
-                    elif select == "otter":
-                        classes = 1
-                    elif select == "panda":
-                        classes = 2
-                    elif select == "raccoon":
-                        classes = 3
-                    elif select == "pomeranian":
-                        classes = 4
-                    else:
-                        xmin, ymin, xmax, ymax, classes = -1, -1, -1, -1, -1
-                    xml_list.append((xmin, ymin, xmax, ymax, classes))
-                else:
-                    '''
-                        image만 있고 labeling 없는 데이터에 대비 하기 위함 - ssd, retinanet loss에는 아무런 영향이 없음.
-                        yolo 대비용임
-                    '''
-                    print(f"only image : {path}")
-                    xml_list.append((-1, -1, -1, -1, -1))
-
-        except Exception:
-            print(f"only image or json crash : {path}")
-            xml_list.append((-1, -1, -1, -1, -1))
-            return np.array(xml_list, dtype="float32")  # 반드시 numpy여야함.
-        else:
-            return np.array(xml_list, dtype="float32")  # 반드시 numpy여야함.
+    def _label(self, index):
+        # index 에서 slice 만 하면 된다. transform 에서 값을 바꿀 수 있으므로 복사
+        return self._labels[self._offsets[index]:self._offsets[index + 1]].copy()
 
     @property
     def classes(self):
@@ -139,7 +253,7 @@ class DetectionDataset(Dataset):
         return self._name + " " + "dataset"
 
     def __len__(self):
-        return len(self._items)
+        return max(len(self._image_path_List) - (self._sequence_number - 1), 0)
 
 
 # test
@@ -168,3 +282,28 @@ if __name__ == "__main__":
     images length: 1499
     sequence image shape: (720, 1280, 9)
     '''
+
+    # annotation index - index 없이 parsing 할 때와 저장된 index 를 쓸 때의 시작 시간 비교
+    import time
+
+    begin = time.time()
+    DetectionDataset(path=os.path.join(root, 'Dataset', 'train'), index_cache=False)
+    print(f"without index : {time.time() - begin:0.3f}s")
+    DetectionDataset(path=os.path.join(root, 'Dataset', 'train'))  # index 저장
+    begin = time.time()
+    DetectionDataset(path=os.path.join(root, 'Dataset', 'train'))
+    print(f"with index : {time.time() - begin:0.3f}s")
+
+    # worker 별 private RSS(MB) - copy-on-write 로 복사된 page 가 여기에 잡히므로, epoch 동안 늘어나지 않아야 한다. (linux)
+    from torch.utils.data import DataLoader, get_worker_info
+
+    def worker_rss(batch):
+        with open("/proc/self/statm") as f:
+            _, resident, shared = [int(page) for page in f.read().split()[:3]]
+        return get_worker_info().id, (resident - shared) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+    rss = {}
+    for worker_id, memory in DataLoader(dataset, batch_size=8, shuffle=True, collate_fn=worker_rss, num_workers=4):
+        rss.setdefault(worker_id, []).append(memory)
+    for worker_id, memory in sorted(rss.items()):
+        print(f"worker {worker_id} RSS : start {memory[0]:0.1f}MB, middle {memory[len(memory) // 2]:0.1f}MB, end {memory[-1]:0.1f}MB")
@@ -12,7 +12,7 @@ from core.utils.util.image_utils import *
 class CenterTrainTransform(object):
 
     def __init__(self, input_size, input_frame_number=1, mean=(0.485, 0.456, 0.406),
-                 std=(0.229, 0.224, 0.225), scale_factor=4, augmentation=True, make_target=False, num_classes=3):
+                 std=(0.229, 0.224, 0.225), scale_factor=4, augmentation=True, make_target=False, num_classes=3, max_objects=128):
 
         self._width = input_size[1]
         self._height = input_size[0]
@@ -24,7 +24,7 @@ class CenterTrainTransform(object):
         self._augmentation = augmentation
         self._make_target = make_target
         if self._make_target:
-            self._target_generator = TargetGenerator(num_classes=num_classes)
+            self._target_generator = TargetGenerator(num_classes=num_classes, max_objects=max_objects)
         else:
             self._target_generator = None
 
@@ -104,9 +104,9 @@ class CenterTrainTransform(object):
         if self._make_target:
             bbox = bbox[np.newaxis, :, :]
             bbox = torch.as_tensor(bbox)
-            heatmap, offset_target, wh_target, mask_target = self._target_generator(bbox[:, :, :4], bbox[:, :, 4:5],
-                                                                                    output_w, output_h, img.device)
-            return img, bbox[0], heatmap[0], offset_target[0], wh_target[0], mask_target[0], name
+            heatmap, offset_target, wh_target, mask_target, index_target = self._target_generator(bbox[:, :, :4], bbox[:, :, 4:5],
+                                                                                                  output_w, output_h, img.device)
+            return img, bbox[0], heatmap[0], offset_target[0], wh_target[0], mask_target[0], index_target[0], name
         else:
             bbox = torch.as_tensor(bbox)
             return img, bbox, name
@@ -115,7 +115,7 @@ class CenterTrainTransform(object):
 class CenterValidTransform(object):
 
     def __init__(self, input_size, input_frame_number=1, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], scale_factor=4,
-                 make_target=False, num_classes=3):
+                 make_target=False, num_classes=3, max_objects=128):
         self._width = input_size[1]
         self._height = input_size[0]
         self._mean = torch.as_tensor(mean*input_frame_number).reshape((3*input_frame_number, 1, 1))
@@ -124,7 +124,7 @@ class CenterValidTransform(object):
         self._scale_factor = scale_factor
         self._make_target = make_target
         if self._make_target:
-            self._target_generator = TargetGenerator(num_classes=num_classes)
+            self._target_generator = TargetGenerator(num_classes=num_classes, max_objects=max_objects)
         else:
             self._target_generator = None
 
@@ -151,10 +151,10 @@ class CenterValidTransform(object):
         if self._make_target:
             bbox = bbox[np.newaxis, :, :]
             bbox = torch.as_tensor(bbox)
-            heatmap, offset_target, wh_target, mask_target = self._target_generator(bbox[:, :, :4], bbox[:, :, 4:5],
-                                                                                    output_w, output_h, img.device)
+            heatmap, offset_target, wh_target, mask_target, index_target = self._target_generator(bbox[:, :, :4], bbox[:, :, 4:5],
+                                                                                                  output_w, output_h, img.device)
 
-            return img, bbox[0], heatmap[0], offset_target[0], wh_target[0], mask_target[0], name
+            return img, bbox[0], heatmap[0], offset_target[0], wh_target[0], mask_target[0], index_target[0], name
         else:
             bbox = torch.as_tensor(bbox)
             return img, bbox, name
@@ -1,11 +1,16 @@
+import contextlib
 import logging
 import os
+import queue
 import random
+import threading
 
 import cv2
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
 from matplotlib import pyplot as plt
 
 logfilepath = ""
@@ -137,6 +142,268 @@ class PrePostNet(nn.Module):
     def forward(self, x):
         x = torch.sub(x, self._mean.to(x.device))
         x = torch.div(x, self._scale.to(x.device))
+        # (N, H, W, C) 의 permute 는 복사 없는 view 이고 memory 순서로는 channels_last 이다.
+        # channels_last 로 학습해서 export 한 net 은 이 view 를 그대로 받으므로 NCHW 로 바꾸는 복사가 없다.
         x = x.permute(0, 3, 1, 2)
         heatmap_pred, offset_pred, wh_pred = self._net(x)
         return self._auxnet(heatmap_pred, offset_pred, wh_pred)
+
+
+class AsyncLogger(object):
+
+    '''
+    tensorboard(SummaryWriter) / mlflow 에 쓰는 작업을 background thread 에서 처리한다. - 학습 loop 는 queue 에 넣기만 한다.
+    scalar 는 device 의 tensor 를 그대로 넘겨도 된다. (.item() 은 logging thread 에서)
+    queue 가 가득 차면(writer 가 밀리면) 학습을 기다리게 하지 않고 그 기록은 버린다.
+    '''
+    def __init__(self, summary=None, using_mlflow=False, maxsize=1024):
+
+        self._summary = summary
+        self._mlflow_client = None
+        if using_mlflow:
+            import mlflow as ml
+            from mlflow.tracking import MlflowClient
+            # mlflow 의 active run 은 thread 마다 따로일 수 있으므로 run id 를 잡아두고 client 로 쓴다.
+            self._mlflow_client = MlflowClient()
+            self._run_id = ml.active_run().info.run_id
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            function, args, kwargs = item
+            try:
+                function(*args, **kwargs)
+            except Exception as E:
+                logging.error(f"logging 실패 : {E}")
+
+    def _put(self, function, *args, **kwargs):
+        try:
+            self._queue.put_nowait((function, args, kwargs))
+        except queue.Full:
+            self._dropped += 1
+            if self._dropped == 1:
+                logging.warning("logging queue 가 가득 차서 기록을 버립니다.")
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        if self._summary is not None:
+            if isinstance(scalar_value, torch.Tensor):
+                scalar_value = scalar_value.detach()
+            self._put(self._summary.add_scalar, tag, scalar_value, global_step=global_step)
+
+    def add_image(self, tag, img_tensor, global_step=None):
+        if self._summary is not None:
+            self._put(self._summary.add_image, tag, img_tensor, global_step=global_step)
+
+    def add_histogram(self, tag, values, global_step=None):
+        # parameter 는 다음 step 에서 바뀌므로 지금 값을 복사해서 넘긴다. (device 에서 복사하므로 기다리지 않는다.)
+        if self._summary is not None:
+            self._put(self._summary.add_histogram, tag, values.detach().clone(), global_step=global_step)
+
+    def log_metric(self, key, value, step=None):
+        if self._mlflow_client is not None:
+            self._put(self._mlflow_client.log_metric, self._run_id, key, value, step=step)
+
+    def close(self):
+        # 남은 기록을 모두 쓰고 끝낸다.
+        self._queue.put(None)
+        self._thread.join()
+        if self._summary is not None:
+            self._summary.flush()
+        if self._dropped:
+            logging.warning(f"logging queue 가 가득 차서 버린 기록 : {self._dropped}")
+
+
+def _to_cpu(obj):
+    # state_dict 를 cpu 로 복사 - 학습이 이어지면서 바뀌지 않도록 cpu tensor 도 복사한다.
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        copied = type(obj)((key, _to_cpu(value)) for key, value in obj.items())
+        if hasattr(obj, "_metadata"):  # module.state_dict() 의 version 정보
+            copied._metadata = obj._metadata
+        return copied
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def _checkpoint_worker(build_net, build_prepostnet, tasks, results):
+
+    # 학습 process 의 cpu 를 뺏지 않도록 thread 하나로 - script 변환은 어차피 python 에서 하나로 돈다.
+    torch.set_num_threads(1)
+    net = None
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        model_state_dict, optimizer_state_dict, pt_path, jit_path, prepost_path = task
+        try:
+            torch.save({
+                'model_state_dict': model_state_dict,
+                'optimizer_state_dict': optimizer_state_dict}, pt_path)
+
+            # model 은 처음 한번만 만들고 weight 만 바꿔서 export 한다.
+            if net is None:
+                net = build_net()
+            net.load_state_dict(model_state_dict)
+
+            # torch.jit.trace() 보다는 control-flow 연산 적용이 가능한 torch.jit.script() 을 사용하자
+            script = torch.jit.script(net)
+            script.save(jit_path)
+
+            script = torch.jit.script(build_prepostnet(net=net))  # 새로운 객체가 생성
+            script.save(prepost_path)
+        except Exception as E:
+            results.put((False, f"{os.path.basename(pt_path)} pt, jit export 예외 발생 : {E}"))
+        else:
+            results.put((True, f"{os.path.basename(pt_path)} pt, jit export 성공"))
+    results.put(None)
+
+
+class AsyncCheckpointer(object):
+
+    '''
+    save_period 마다의 torch.save / torch.jit.script export 를 background process 에서 처리한다. - 학습 loop 는 disk 쓰기, script 변환을 기다리지 않는다.
+    save 는 state_dict 를 cpu 로 복사해서 queue 에 넣고 바로 돌아간다.
+    process 는 build_net() 으로 만든 cpu model 에 weight 를 load 해서 .pt, .jit, -prepost-.jit 을 저장하고, 결과는 이 process 의 logging 으로 남긴다.
+    build_net : model 을 만드는 함수, build_prepostnet : build_prepostnet(net=model) 로 PrePostNet 을 만드는 함수
+    - spawn 으로 넘기므로 pickle 이 되어야 한다. (lambda 대신 functools.partial)
+    '''
+    def __init__(self, build_net, build_prepostnet):
+
+        # cuda 를 쓰고 있는 process 는 fork 하면 안된다.
+        context = torch.multiprocessing.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._process = context.Process(target=_checkpoint_worker, args=(build_net, build_prepostnet, self._tasks, self._results), daemon=True)
+        self._process.start()
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._thread = threading.Thread(target=self._reporter, daemon=True)
+        self._thread.start()
+
+    def _reporter(self):
+        while True:
+            result = self._results.get()
+            if result is None:
+                break
+            success, message = result
+            with self._lock:
+                self._pending -= 1
+            if success:
+                logging.info(message)
+            else:
+                logging.error(message)
+
+    def save(self, model_state_dict, optimizer_state_dict, pt_path, jit_path, prepost_path):
+
+        model_state_dict = _to_cpu(model_state_dict)
+        optimizer_state_dict = _to_cpu(optimizer_state_dict)
+        if not self._process.is_alive():
+            # export process 가 죽었으면 .pt 만이라도 여기서 저장한다.
+            logging.error(f"checkpoint process 가 종료됨(exitcode : {self._process.exitcode}) - {os.path.basename(pt_path)} 만 저장, jit export 안함")
+            torch.save({
+                'model_state_dict': model_state_dict,
+                'optimizer_state_dict': optimizer_state_dict}, pt_path)
+            return
+
+        with self._lock:
+            self._pending += 1
+            pending = self._pending
+        if pending > 1:
+            logging.warning(f"이전 checkpoint 의 export 가 아직 끝나지 않았습니다. (대기 : {pending}) - save_period 를 늘려주세요.")
+        self._tasks.put((model_state_dict, optimizer_state_dict, pt_path, jit_path, prepost_path))
+
+    def close(self):
+        # 남은 export 를 모두 끝내고 종료한다.
+        if self._process.is_alive():
+            self._tasks.put(None)
+        self._process.join()
+        if self._process.exitcode != 0:
+            logging.error(f"checkpoint process 비정상 종료 (exitcode : {self._process.exitcode})")
+            self._results.put(None)
+        self._thread.join()
+
+
+def all_reduce_mean(values, device=None):
+
+    '''
+    distributed 학습(main.py 의 distributed 모드)이면 process 들의 평균, 아니면 그대로 돌려준다.
+    values : python float 또는 0 차원 tensor 의 list (nccl 이면 device 는 cuda 여야 한다.)
+    return : python float 의 list
+    '''
+    values = torch.stack([torch.as_tensor(value, dtype=torch.float64, device=device) for value in values])
+    if dist.is_available() and dist.is_initialized():
+        dist.all_reduce(values)
+        values = values / dist.get_world_size()
+    return values.tolist()
+
+
+def gradient_sync(net, sync=True):
+
+    '''
+    DistributedDataParallel 은 backward 마다 gradient 를 all-reduce 한다.
+    subdivision 으로 chunk 마다 backward 할 때 마지막 chunk 만 sync=True 로 두면, 앞의 chunk 는 no_sync() 로 gradient 를 쌓기만 한다.
+    forward 도 이 context 안에서 해야 한다. - DistributedDataParallel 이 아니면 아무것도 하지 않는다.
+    '''
+    if isinstance(net, DistributedDataParallel) and not sync:
+        return net.no_sync()
+    return contextlib.nullcontext()
+
+
+def amp_dtype(precision, device):
+
+    '''
+    precision 설정(fp32, fp16, bf16)을 autocast 의 dtype 으로 바꾼다. - fp32 이면 None
+    cpu autocast 는 bfloat16 만 되므로 cpu 에서 fp16 을 고르면 bf16 으로 학습한다.
+    torch.autocast 가 없는 버전(< 1.10)은 cuda 의 fp16 만 된다.
+    '''
+    precision = precision.lower()
+    if precision == "fp32":
+        return None
+    elif precision == "fp16":
+        dtype = torch.float16
+        if device.type != "cuda":
+            logging.warning("cpu 에서는 fp16 autocast 를 쓸 수 없어서 bf16 으로 학습합니다.")
+            dtype = torch.bfloat16
+    elif precision == "bf16":
+        dtype = torch.bfloat16
+    else:
+        raise ValueError(f"precision 은 fp32, fp16, bf16 중 하나여야 합니다 : {precision}")
+
+    if not hasattr(torch, "autocast") and not (device.type == "cuda" and dtype == torch.float16):
+        raise RuntimeError(f"pytorch {torch.__version__} 에서는 {device.type} {precision} autocast 를 쓸 수 없습니다.")
+    return dtype
+
+
+def autocast(device, dtype=None):
+
+    '''
+    dtype(amp_dtype 의 결과)으로 forward, loss 를 감싸는 context - None 이면 아무것도 하지 않는다.
+    backward 는 이 context 밖에서 한다.
+    '''
+    if dtype is None:
+        return contextlib.nullcontext()
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device.type, dtype=dtype)
+    return torch.cuda.amp.autocast()
+
+
+def grad_scaler(dtype=None):
+
+    '''
+    fp16 은 작은 gradient 가 0 으로 underflow 되므로 loss 를 키워서 backward 하고, step 전에 다시 나눈다.
+    bf16 은 fp32 와 지수 범위가 같아서 scaling 이 필요 없다. - enabled=False 면 scale / step 은 그냥 backward / optimizer.step 이다.
+    '''
+    enabled = dtype == torch.float16
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
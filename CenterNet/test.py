@@ -32,6 +32,7 @@ def run(input_frame_number=2,
         lambda_off=1,
         lambda_size=0.1,
         num_workers=4,
+        prefetch_factor=2,
         show_flag=True,
         save_flag=True,
         video_flag=True,
@@ -87,6 +88,7 @@ def run(input_frame_number=2,
                                                        input_size=(netheight, netwidth),
                                                        input_frame_number= input_frame_number,
                                                        num_workers=num_workers,
+                                                       prefetch_factor=prefetch_factor,
                                                        mean=mean, std=std, scale_factor=scale_factor)
     except Exception:
         logging.info("The dataset does not exist")
@@ -210,13 +212,13 @@ def run(input_frame_number=2,
             if i >= video_min and i <= video_max:
                 out.write(hconcat_images)
 
-        heatmap_target, offset_target, wh_target, mask_target = targetgenerator(gt_boxes, gt_ids,
-                                                                                netwidth // scale_factor,
-                                                                                netheight // scale_factor,
-                                                                                image.device)
+        heatmap_target, offset_target, wh_target, mask_target, index_target = targetgenerator(gt_boxes, gt_ids,
+                                                                                              netwidth // scale_factor,
+                                                                                              netheight // scale_factor,
+                                                                                              image.device)
         heatmap_loss = heatmapfocalloss(heatmap_pred, heatmap_target)
-        offset_loss = normedl1loss(offset_pred, offset_target, mask_target) * lambda_off
-        wh_loss = normedl1loss(wh_pred, wh_target, mask_target) * lambda_size
+        offset_loss = normedl1loss(offset_pred, offset_target, mask_target, index_target) * lambda_off
+        wh_loss = normedl1loss(wh_pred, wh_target, mask_target, index_target) * lambda_size
 
         heatmap_loss_sum += heatmap_loss.item()
         offset_loss_sum += offset_loss.item()
@@ -264,6 +266,7 @@ if __name__ == "__main__":
         lambda_off=1,
         lambda_size=0.1,
         num_workers=4,
+        prefetch_factor=2,
         show_flag=True,
         video_flag=True,
         save_flag=True,
@@ -1,4 +1,5 @@
 from core.utils.dataprocessing.dataloader import *
+from core.utils.dataprocessing.mining import HardNegativeMiner
 from core.utils.util.image_utils import *
 from core.utils.util.utils import *
 from core.model.ResNet import get_resnet
@@ -2,6 +2,19 @@ import torch
 from torch.nn import Module
 from torch.nn.modules.distance import PairwiseDistance
 
+
+def _to_float(tensor):
+    # autocast(fp16, bf16) 의 출력만 fp32 로 올린다. - fp32, fp64 는 그대로
+    return tensor.float() if tensor.dtype in (torch.float16, torch.bfloat16) else tensor
+
+
+def _autocast_disabled(device):
+    # torch.autocast 가 없는 버전(< 1.10)은 cuda autocast 만 있다.
+    if hasattr(torch, "autocast"):
+        return torch.autocast(device_type=device.type, enabled=False)
+    return torch.cuda.amp.autocast(enabled=False)
+
+
 class TripletLoss(Module):
 
     def __init__(self, margin):
@@ -11,7 +24,53 @@ class TripletLoss(Module):
 
     def forward(self, anchor, positive, negative):
 
+        anchor, positive, negative = _to_float(anchor), _to_float(positive), _to_float(negative)
         ap_loss = self.PDLoss(anchor, positive)
         an_loss = self.PDLoss(anchor, negative)
         loss = torch.clamp(ap_loss - an_loss + self.margin, min=0.0)
-        return torch.mean(loss)
\ No newline at end of file
+        return torch.mean(loss)
+
+class BatchTripletLoss(Module):
+
+    '''
+    PK batch 의 embedding 전체로 pairwise distance matrix 를 한번에 구하고, batch 안에서 triplet 을 고른다.
+    semi_hard_negative=True : d(a,p) < d(a,n) < d(a,p) + margin 을 만족하는 모든 (a, p, n) 의 평균
+    semi_hard_negative=False : batch hard - anchor 마다 가장 먼 positive 와 가장 가까운 negative
+    '''
+    def __init__(self, margin, semi_hard_negative=True):
+        super(BatchTripletLoss, self).__init__()
+        self.margin = margin
+        self.semi_hard_negative = semi_hard_negative
+
+    def _distance(self, embedding):
+        # |a-b|^2 = |a|^2 - 2ab + |b|^2, 대각(0)에서 sqrt 의 gradient 가 nan 이 되지 않도록 clamp
+        # autocast 안에서는 matmul 이 다시 fp16 / bf16 으로 내려가므로 끄고 계산한다.
+        with _autocast_disabled(embedding.device):
+            square = torch.sum(embedding * embedding, dim=-1)
+            distance = square.unsqueeze(1) - 2 * torch.matmul(embedding, embedding.t()) + square.unsqueeze(0)
+        return torch.sqrt(torch.clamp(distance, min=1e-12))
+
+    def forward(self, embedding, identity):
+
+        # autocast 로 학습해도 거리는 fp32 로 - |a|^2 - 2ab + |b|^2 는 낮은 정밀도에서 자릿수가 크게 지워진다.
+        embedding = _to_float(embedding)
+        distance = self._distance(embedding)  # (B, B)
+        same = identity.unsqueeze(1) == identity.unsqueeze(0)
+        eye = torch.eye(same.shape[0], dtype=torch.bool, device=same.device)
+        positive_mask = same & ~eye
+        negative_mask = ~same
+
+        if self.semi_hard_negative:
+            ap = distance.unsqueeze(2)  # (B, B, 1) - d(a, p)
+            an = distance.unsqueeze(1)  # (B, 1, B) - d(a, n)
+            valid = positive_mask.unsqueeze(2) & negative_mask.unsqueeze(1) & (ap < an) & (an - ap < self.margin)
+            loss = (ap - an + self.margin)[valid]
+        else:
+            hardest_positive = torch.max(distance * positive_mask, dim=1)[0]
+            hardest_negative = torch.min(distance.masked_fill(~negative_mask, float("inf")), dim=1)[0]
+            valid = positive_mask.any(dim=1) & negative_mask.any(dim=1)
+            loss = torch.clamp(hardest_positive - hardest_negative + self.margin, min=0.0)[valid]
+
+        if loss.numel() == 0:  # 고를 triplet 이 없으면 0 (graph 는 유지)
+            return torch.sum(distance) * 0
+        return torch.mean(loss)
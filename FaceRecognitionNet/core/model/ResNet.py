@@ -325,3 +325,29 @@ if __name__ == "__main__":
     < input size(height, width) : (256, 256) >
     < output shape : torch.Size([1, 128]) >
     '''
+
+    # channels_last - cpu(oneDNN) 에서 memory format 별 처리량 비교 (batch 4, 5 번 평균)
+    import time
+    net = get_resnet(18, pretrained=False, input_frame_number=1, embedding=128)
+    for memory_format in [torch.contiguous_format, torch.channels_last]:
+        net = net.to(memory_format=memory_format)
+        x = torch.rand(4, 3, input_size[0], input_size[1]).contiguous(memory_format=memory_format)
+        net.eval()
+        with torch.no_grad():
+            net(x)  # warm up
+            start = time.time()
+            for _ in range(5):
+                net(x)
+            inference = 4 * 5 / (time.time() - start)
+        net.train()
+        net(x).mean().backward()  # warm up
+        start = time.time()
+        for _ in range(5):
+            net(x).mean().backward()
+        train = 4 * 5 / (time.time() - start)
+        print(f"< resnet18 {str(memory_format):24s} : inference {inference:0.2f} / train {train:0.2f} images/sec >")
+    '''
+    cpu 1 core 에서 측정
+    < resnet18 torch.contiguous_format  : inference 17.75 / train 6.45 images/sec >
+    < resnet18 torch.channels_last      : inference 24.17 / train 7.14 images/sec >
+    '''
@@ -1,53 +1,261 @@
-from torch.utils.data import DataLoader
+import math
+import random
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
 
 from core.utils.dataprocessing.dataset import FaceDataset
 from core.utils.dataprocessing.transformer import CenterTrainTransform, CenterValidTransform
 
 
-def traindataloader(augmentation=True, path="Dataset/train",
-                    input_size=(512, 512), batch_size=8, pin_memory=True, num_workers=4, shuffle=True,
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
+def _worker_init_fn(worker_id):
+
+    '''
+    worker 마다 numpy / random 의 seed 를 다르게 설정
+    설정하지 않으면 fork 된 worker 들이 같은 numpy 상태를 물려받아, 같은 augmentation 을 만들게 된다.
+    torch.initial_seed() 는 worker 마다 (base_seed + worker_id) 이고, base_seed 는 iterator 를 만들 때마다 바뀐다.
+    '''
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def _worker_options(num_workers, prefetch_factor, persistent_workers):
+
+    # num_workers=0 일 때는 prefetch_factor, persistent_workers 를 넘기면 안된다.
+    if num_workers > 0:
+        return dict(worker_init_fn=_worker_init_fn,
+                    prefetch_factor=prefetch_factor,
+                    persistent_workers=persistent_workers)
+    else:
+        return dict()
+
+
+def _hard_negative(table, identity, generator):
+    # identity 의 hardest impostor identity 중 하나, 없으면 -1
+    candidates = table[identity]
+    candidates = candidates[candidates >= 0]
+    if len(candidates) == 0:
+        return -1
+    return int(candidates[int(torch.randint(len(candidates), (1,), generator=generator))])
+
+
+class TripletSampler(Sampler):
+
+    '''
+    image index 를 섞어서 내보내는 sampler
+    set_hard_negatives 로 identity 별 hardest impostor identity 표(HardNegativeMiner 의 결과)를 넘기면,
+    (idx, negative identity) 를 내보내서 FaceDataset 이 그 identity 에서 negative 를 뽑게 한다.
+    same_identity_per_batch : FaceDataset 의 same_identity_per_batch 와 같은 값
+        FaceDataset 은 same_identity_per_batch 개씩 연속된 idx 에 같은 anchor identity 를 쓰므로,
+        image index 대신 이 block 들의 순서를 섞고 block 안의 index 는 연속되게 내보낸다. (섞어도 같은 batch 에 모인다.)
+    num_replicas, rank : distributed 학습에서 섞은 index 를 process 수로 나눠서 rank 번째 몫만 내보낸다.
+        block 이 흩어지지 않도록 DistributedSampler 처럼 건너뛰며 나누지 않고 연속된 구간으로 나눈다.
+    '''
+    def __init__(self, dataset, shuffle=True, seed=None, num_replicas=1, rank=0, same_identity_per_batch=1):
+        super(TripletSampler, self).__init__()
+
+        self._identity = torch.as_tensor(dataset.identity)
+        self._shuffle = shuffle
+        self._num_replicas = num_replicas
+        self._rank = rank
+        self._same_identity_per_batch = same_identity_per_batch
+        # process 마다 initial_seed 가 다르므로, 나눠 볼 때는 DistributedSampler 처럼 0 으로 맞춘다.
+        if seed is None:
+            seed = torch.initial_seed() % 2 ** 32 if num_replicas == 1 else 0
+        self._seed = seed
+        self._num_samples = math.ceil(len(self._identity) / num_replicas)  # process 하나의 몫
+        self._epoch = 0
+        self._hard_negatives = None
+
+    def set_epoch(self, epoch):
+        self._epoch = epoch
+
+    def set_hard_negatives(self, table):
+        self._hard_negatives = torch.as_tensor(table)
+
+    def __iter__(self):
+
+        generator = torch.Generator()
+        generator.manual_seed(self._seed + self._epoch)
+
+        length = len(self._identity)
+        group = self._same_identity_per_batch
+        if self._shuffle:
+            blocks = torch.randperm(math.ceil(length / group), generator=generator).tolist()
+            indices = [idx for block in blocks for idx in range(block * group, min((block + 1) * group, length))]
+        else:
+            indices = list(range(length))
+
+        if self._num_replicas > 1:
+            # 앞에서부터 다시 채워서 process 수로 나누어 떨어지게 한다.
+            total_size = self._num_samples * self._num_replicas
+            indices += (indices * math.ceil(total_size / length))[:total_size - length]
+            indices = indices[self._rank * self._num_samples:(self._rank + 1) * self._num_samples]
+
+        for idx in indices:
+            if self._hard_negatives is None:
+                yield idx
+            else:
+                negative = _hard_negative(self._hard_negatives, int(self._identity[idx]), generator)
+                yield idx if negative < 0 else (idx, negative)
+
+    def __len__(self):
+        return self._num_samples
+
 
-    num_workers = 0 if pin_memory else num_workers
+class PKBatchSampler(Sampler):
 
+    '''
+    batch 마다 P(identities_per_batch) 개의 identity 를 뽑고, identity 마다 K(images_per_identity) 장의 image index 를 뽑는다.
+    batch 안에 identity 마다 positive 가 K-1 개, negative 가 (P-1)K 개 있으므로 batch 안에서 triplet 을 만들 수 있다.
+    image 가 K 장보다 적은 identity 는 중복을 허용해서 뽑는다.
+    같은 seed, epoch 이면 같은 batch 가 나온다. (set_epoch 으로 epoch 마다 다른 batch)
+    set_hard_negatives 로 identity 별 hardest impostor identity 표를 넘기면, P 개 중 절반은 random 으로 뽑고
+    나머지는 뽑힌 identity 의 hardest impostor 로 채운다.
+    num_replicas, rank : distributed 학습에서 process 마다 다른 batch 를 뽑고, epoch 당 batch 수는 process 수로 나눈다.
+    '''
+    def __init__(self, dataset, identities_per_batch=8, images_per_identity=4, seed=None, num_replicas=1, rank=0):
+        super(PKBatchSampler, self).__init__()
+
+        self._identity_offsets = torch.as_tensor(dataset.identity_offsets)
+        self._num_identity = dataset.num_identity
+        self._identities_per_batch = min(identities_per_batch, self._num_identity)
+        self._images_per_identity = images_per_identity
+        # epoch 당 image 수가 (모든 process 를 합쳐서) dataset 과 비슷하도록
+        self._length = max(len(dataset) // (self._identities_per_batch * images_per_identity * num_replicas), 1)
+        self._num_replicas = num_replicas
+        self._rank = rank
+        if seed is None:
+            seed = torch.initial_seed() % 2 ** 32 if num_replicas == 1 else 0
+        self._seed = seed
+        self._epoch = 0
+        self._hard_negatives = None
+
+    def set_epoch(self, epoch):
+        self._epoch = epoch
+
+    def set_hard_negatives(self, table):
+        self._hard_negatives = torch.as_tensor(table)
+
+    def _identities(self, generator):
+
+        identities = torch.randperm(self._num_identity, generator=generator)[:self._identities_per_batch].tolist()
+        if self._hard_negatives is None:
+            return identities
+
+        # 앞의 절반을 seed 로 두고, seed 의 hardest impostor 로 나머지를 채운다. (못 채우면 random 으로 남겨둔 identity 를 쓴다.)
+        seed_number = (self._identities_per_batch + 1) // 2
+        selected = identities[:seed_number]
+        chosen = set(selected)
+        rest = identities[seed_number:]
+        for identity in selected:
+            if len(chosen) == self._identities_per_batch:
+                break
+            negative = _hard_negative(self._hard_negatives, identity, generator)
+            if negative >= 0 and negative not in chosen:
+                chosen.add(negative)
+                selected.append(negative)
+        for identity in rest:
+            if len(selected) == self._identities_per_batch:
+                break
+            if identity not in chosen:
+                chosen.add(identity)
+                selected.append(identity)
+        return selected
+
+    def __iter__(self):
+
+        generator = torch.Generator()
+        # (epoch, rank) 마다 다른 seed - num_replicas 가 1 이면 seed + epoch
+        generator.manual_seed(self._seed + self._epoch * self._num_replicas + self._rank)
+
+        for _ in range(self._length):
+            batch = []
+            for identity in self._identities(generator):
+                begin = int(self._identity_offsets[identity])
+                count = int(self._identity_offsets[identity + 1]) - begin
+                if count >= self._images_per_identity:
+                    index = torch.randperm(count, generator=generator)[:self._images_per_identity]
+                else:
+                    index = torch.randint(count, (self._images_per_identity,), generator=generator)
+                batch.extend((index + begin).tolist())
+            yield batch
+
+    def __len__(self):
+        return self._length
+
+
+def traindataloader(augmentation=True, path="Dataset/train",
+                    input_size=(512, 512), batch_size=8, pin_memory=True, num_workers=4, prefetch_factor=2, persistent_workers=True, shuffle=True,
+                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225],
+                    pk_sampling=False, identities_per_batch=8, images_per_identity=4, distributed=False, same_identity_per_batch=1):
+
+    '''
+    pk_sampling=True 면 batch_size 대신 identities_per_batch x images_per_identity 장의 image 가 한 batch 가 되고,
+    batch 는 (image, identity, path) 이다. triplet 은 train 에서 batch 안의 embedding 으로 만든다.
+    pk_sampling=False 면 same_identity_per_batch 개씩 연속된 triplet 이 같은 anchor identity 를 쓴다. (shuffle 해도 유지된다.)
+    '''
     transform = CenterTrainTransform(input_size, mean=mean, std=std,
                                      augmentation=augmentation)
-    dataset = FaceDataset(path=path, same_identity_per_batch=1, transform=transform)
+
+    # distributed 이면 process 마다 dataset 을 나눠서 본다.
+    num_replicas = dist.get_world_size() if distributed else 1
+    rank = dist.get_rank() if distributed else 0
+
+    if pk_sampling:
+        dataset = FaceDataset(path=path, triplet=False, transform=transform)
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=PKBatchSampler(dataset, identities_per_batch=identities_per_batch,
+                                         images_per_identity=images_per_identity,
+                                         num_replicas=num_replicas, rank=rank),
+            pin_memory=pin_memory,
+            num_workers=num_workers,
+            **_worker_options(num_workers, prefetch_factor, persistent_workers))
+        return dataloader, dataset
+
+    dataset = FaceDataset(path=path, same_identity_per_batch=same_identity_per_batch, transform=transform)
 
     dataloader = DataLoader(
         dataset,
         batch_size=batch_size,
-        shuffle=shuffle,
+        sampler=TripletSampler(dataset, shuffle=shuffle, num_replicas=num_replicas, rank=rank,
+                               same_identity_per_batch=same_identity_per_batch),
         pin_memory=pin_memory,
         drop_last=False,
-        num_workers=num_workers)
+        num_workers=num_workers,
+        **_worker_options(num_workers, prefetch_factor, persistent_workers))
 
     return dataloader, dataset
 
 
-def validdataloader(path="Dataset/valid", input_size=(512, 512), batch_size=1, pin_memory=True, num_workers=4, shuffle=True,
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
-
-    num_workers = 0 if pin_memory else num_workers
+def validdataloader(path="Dataset/valid", input_size=(512, 512), batch_size=1, pin_memory=True, num_workers=4, prefetch_factor=2, persistent_workers=True, shuffle=True,
+                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], distributed=False):
 
     transform = CenterValidTransform(input_size, mean=mean, std=std)
     dataset = FaceDataset(path=path, same_identity_per_batch=1, transform=transform)
 
+    sampler = DistributedSampler(dataset, shuffle=shuffle) if distributed else None
+
     dataloader = DataLoader(
         dataset,
         batch_size=batch_size,
-        shuffle=shuffle,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
         drop_last=False,
         pin_memory=pin_memory,
-        num_workers=num_workers)
+        num_workers=num_workers,
+        **_worker_options(num_workers, prefetch_factor, persistent_workers))
 
     return dataloader, dataset
 
 
 def testdataloader(path="Dataset/test", input_size=(512, 512), pin_memory=True,
-                   num_workers=4, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
-
-    num_workers = 0 if pin_memory else num_workers
+                   num_workers=4, prefetch_factor=2, persistent_workers=True, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
 
     transform = CenterValidTransform(input_size, mean=mean, std=std)
     dataset = FaceDataset(path=path, same_identity_per_batch=1, transform=transform)
@@ -56,7 +264,8 @@ def testdataloader(path="Dataset/test", input_size=(512, 512), pin_memory=True,
         dataset,
         batch_size=1,
         pin_memory=pin_memory,
-        num_workers=num_workers)
+        num_workers=num_workers,
+        **_worker_options(num_workers, prefetch_factor, persistent_workers))
     return dataloader, dataset
 
 # test
@@ -4,6 +4,7 @@ import os
 import random
 
 import cv2
+import numpy as np
 from torch.utils.data import Dataset
 
 logfilepath = ""  # 따로 지정하지 않으면 terminal에 뜸
@@ -12,6 +13,26 @@ if os.path.isfile(logfilepath):
 logging.basicConfig(filename=logfilepath, level=logging.INFO)
 
 
+class _StringTable(object):
+
+    '''
+    문자열 list 를 하나의 utf-8 byte 배열 + offset 배열로 보관
+    python list 의 str 객체는 fork 된 worker 에서 읽기만 해도 refcount 가 바뀌어 page 가 복사(copy-on-write)되지만,
+    numpy 배열은 refcount 를 건드리지 않으므로 worker 메모리가 epoch 동안 늘어나지 않는다.
+    '''
+    def __init__(self, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+        self._offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=self._offsets[1:])
+        self._buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    def __getitem__(self, idx):
+        return self._buffer[self._offsets[idx]:self._offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
 class FaceDataset(Dataset):
 
     """
@@ -19,34 +40,67 @@ class FaceDataset(Dataset):
     ----------
     path : str(jpg)
         Path to input image directory.
+    triplet : bool
+        True 면 idx 마다 (anchor, positive, negative) triplet 을, False 면 idx 번째 image 1장과 identity 를 반환
+        (False 는 PKBatchSampler 와 함께 쓴다.)
     transform : object
     """
-    def __init__(self, path='Dataset/train', same_identity_per_batch=1, transform=None):
+    def __init__(self, path='Dataset/train', same_identity_per_batch=1, triplet=True, transform=None):
         super(FaceDataset, self).__init__()
 
         self._path = path
         self._name = os.path.basename(path)
-        self._folder_list = glob.glob(os.path.join(path, "*"))
+        self._folder_list = sorted([folder for folder in glob.glob(os.path.join(path, "*")) if os.path.isdir(folder)],
+                                   key=lambda path: self.key_func(path))
         self._same_identity_per_batch = same_identity_per_batch
+        self._triplet = triplet
         self._transform = transform
-        self._items = []
         self._make_item_list()
-        self._count = 0
-        self._pin = None
 
     def key_func(self, path):
         return path
 
     def _make_item_list(self):
 
+        '''
+        identity index 만들기 - 생성할 때 한번만 폴더를 읽는다.
+        image 는 identity 별로 연속되게 저장하고, i 번째 identity 의 image 는 items[identity_offsets[i]:identity_offsets[i+1]]
+        '''
+        items = []
+        counts = []
         if self._folder_list:
             for folder in self._folder_list:
-                image_list = glob.glob(os.path.join(folder, "*"))
-                for image in image_list:
-                    self._items.append(image)
+                image_list = sorted(glob.glob(os.path.join(folder, "*")), key=lambda path: self.key_func(path))
+                if image_list:
+                    items.extend(image_list)
+                    counts.append(len(image_list))
         else:
             logging.info("The dataset does not exist")
 
+        # worker 에서 copy-on-write 가 일어나지 않도록 python list 대신 numpy 배열로 보관
+        self._items = _StringTable(items)
+        self._identity_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self._identity_offsets[1:])
+        self._identity = np.repeat(np.arange(len(counts), dtype=np.int64), counts)  # image 별 identity
+
+    @property
+    def identity_offsets(self):
+        return self._identity_offsets
+
+    @property
+    def identity(self):
+        return self._identity
+
+    @property
+    def num_identity(self):
+        return len(self._identity_offsets) - 1
+
+    def _sample(self, identity, number):
+        begin, end = int(self._identity_offsets[identity]), int(self._identity_offsets[identity + 1])
+        if end - begin < number:  # image 가 1장 뿐인 identity
+            return [self._items[begin]] * number
+        return [self._items[index] for index in random.sample(range(begin, end), number)]
+
     def __getitem__(self, idx):
 
         '''
@@ -54,27 +108,38 @@ class FaceDataset(Dataset):
         such that around 40 faces are selected per identity per minibatch.
         Additionally, randomly sampled negative faces are
         added to each mini-batch.
-        '''
-
-        if self._count % self._same_identity_per_batch == 0:
-            self._pin = idx
-
-        anchor_positive_folder, _ = os.path.split(self._items[self._pin])
-        anchor_positive_candidate_list = glob.glob(os.path.join(anchor_positive_folder, "*"))
-        anchor_path, positive_path = random.sample(anchor_positive_candidate_list, 2)
 
-        dataset_folder, _ = os.path.split(anchor_positive_folder)
-        dataset_path_list = glob.glob(os.path.join(dataset_folder, "*"))
-        random.shuffle(dataset_path_list)
-
-        for dataset_path in dataset_path_list:
-            if dataset_path == anchor_positive_folder:
-                continue
-            else:
-                negative_folder = dataset_path
-                break
+        sampling 은 idx 와 random 에만 의존하고 dataset 의 상태를 바꾸지 않으므로, worker 가 여러 개여도 된다.
+        (random 의 seed 는 dataloader 의 worker_init_fn 에서 worker 마다 다르게 설정)
+        same_identity_per_batch 개씩 연속된 idx 는 같은 anchor identity 를 쓴다.
+        (idx 가 섞여서 들어오면 묶음이 깨지므로, 1 보다 크면 block 단위로 섞는 TripletSampler 와 함께 쓴다.)
+        idx 가 (idx, negative identity) 이면 negative 를 그 identity 에서 뽑는다. (TripletSampler 의 hard negative)
+        '''
 
-        negative_path = random.choice(glob.glob(os.path.join(negative_folder, "*")))
+        negative_identity = None
+        if isinstance(idx, tuple):
+            idx, negative_identity = idx
+
+        if not self._triplet:
+            # triplet 은 batch 안에서 만든다. (Loss.BatchTripletLoss)
+            image_path = self._items[idx]
+            image = cv2.imread(image_path, flags=-1)
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            identity = int(self._identity[idx])
+            if self._transform:
+                image, = self._transform(image)
+            return image, identity, image_path
+
+        pin = idx - idx % self._same_identity_per_batch
+        anchor_identity = int(self._identity[pin])
+        anchor_path, positive_path = self._sample(anchor_identity, 2)
+
+        # anchor 와 다른 identity 를 하나 뽑기
+        if negative_identity is None:
+            negative_identity = random.randrange(len(self._identity_offsets) - 2)
+            if negative_identity >= anchor_identity:
+                negative_identity += 1
+        negative_path, = self._sample(negative_identity, 1)
 
         anchor = cv2.imread(anchor_path, flags=-1)
         positive = cv2.imread(positive_path, flags=-1)
@@ -84,8 +149,6 @@ class FaceDataset(Dataset):
         positive = cv2.cvtColor(positive, cv2.COLOR_BGR2RGB)
         negative = cv2.cvtColor(negative, cv2.COLOR_BGR2RGB)
 
-        self._count+=1
-
         if self._transform:
             return self._transform(anchor, positive, negative) + (anchor_path, positive_path, negative_path)
         else:
@@ -125,3 +188,17 @@ if __name__ == "__main__":
     negative shape: (250, 250, 3)
     negative path: D:\CASIA-WebFace\valid\1708957\003.jpg
     '''
+
+    # worker 별 private RSS(MB) - copy-on-write 로 복사된 page 가 여기에 잡히므로, epoch 동안 늘어나지 않아야 한다. (linux)
+    from torch.utils.data import DataLoader, get_worker_info
+
+    def worker_rss(batch):
+        with open("/proc/self/statm") as f:
+            _, resident, shared = [int(page) for page in f.read().split()[:3]]
+        return get_worker_info().id, (resident - shared) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+    rss = {}
+    for worker_id, memory in DataLoader(dataset, batch_size=8, shuffle=True, collate_fn=worker_rss, num_workers=4):
+        rss.setdefault(worker_id, []).append(memory)
+    for worker_id, memory in sorted(rss.items()):
+        print(f"worker {worker_id} RSS : start {memory[0]:0.1f}MB, middle {memory[len(memory) // 2]:0.1f}MB, end {memory[-1]:0.1f}MB")
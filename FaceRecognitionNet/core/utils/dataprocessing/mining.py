@@ -0,0 +1,250 @@
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from core.model.ResNet import get_resnet
+from core.utils.dataprocessing.dataset import FaceDataset
+from core.utils.dataprocessing.transformer import CenterValidTransform
+
+logfilepath = ""  # 따로 지정하지 않으면 terminal에 뜸
+if os.path.isfile(logfilepath):
+    os.remove(logfilepath)
+logging.basicConfig(filename=logfilepath, level=logging.INFO)
+
+
+def embed_dataset(net, path="Dataset/train", input_size=(256, 256), mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225],
+                  batch_size=64, num_workers=4, device=torch.device("cpu")):
+
+    '''
+    dataset 의 모든 image 를 augmentation 없이 embedding
+    return : embedding (N, E), identity (N,) - dataset 의 image 순서
+    '''
+    transform = CenterValidTransform(input_size, mean=mean, std=std)
+    dataset = FaceDataset(path=path, triplet=False, transform=transform)
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    embeddings = []
+    identities = []
+    net.eval()
+    with torch.no_grad():
+        for image, identity, _ in dataloader:
+            embeddings.append(net(image.to(device)))
+            identities.append(identity.to(device))
+    return torch.cat(embeddings, dim=0), torch.cat(identities, dim=0)
+
+
+def _nearest_impostor_images(embedding, identity, square, rows, neighbour, block):
+
+    '''
+    rows 의 image 마다 다른 identity 의 가장 가까운 image neighbour 개를 block 단위 matmul 로 구한다.
+    return : (row, impostor identity, 거리) 쌍, row 마다 본 이웃 중 가장 먼 거리(cutoff) - 다른 identity 의 image 를 모두 봤으면 inf
+    '''
+    pair_rows = []
+    impostors = []
+    distances = []
+    cutoffs = []
+    for begin in range(0, len(rows), block):
+        row = rows[begin:begin + block]
+        query_identity = identity[row]
+        distance = square[row].unsqueeze(1) - 2 * torch.matmul(embedding[row], embedding.t()) + square.unsqueeze(0)
+        distance.masked_fill_(query_identity.unsqueeze(1) == identity.unsqueeze(0), float("inf"))
+        value, index = torch.topk(distance, neighbour, dim=1, largest=False)
+        cutoffs.append(value[:, -1])
+        pair_rows.append(row.unsqueeze(1).expand_as(index).reshape(-1))
+        impostors.append(identity[index].reshape(-1))
+        distances.append(value.reshape(-1))
+
+    pair_rows = torch.cat(pair_rows).cpu().numpy()
+    impostors = torch.cat(impostors).cpu().numpy()
+    distances = torch.cat(distances).cpu().numpy()
+    valid = np.isfinite(distances)  # 다른 identity 의 image 가 이웃 수보다 적은 경우
+    return pair_rows[valid], impostors[valid], distances[valid], torch.cat(cutoffs).cpu().numpy()
+
+
+def _identity_table(anchors, impostors, distances, num_identity, topk):
+
+    '''
+    (anchor identity, impostor identity, 거리) 쌍에서 identity 마다 가장 가까운 다른 identity topk 개
+    return : (num_identity, topk) int64 - 채우지 못한 칸은 -1, identity 마다 topk 번째 거리 - 채우지 못했으면 inf
+    '''
+    # (anchor, impostor) identity 쌍마다 최소 거리만 남기기
+    order = np.argsort(distances, kind="stable")
+    _, first = np.unique(anchors[order] * num_identity + impostors[order], return_index=True)
+    order = order[first]
+    anchors, impostors, distances = anchors[order], impostors[order], distances[order]
+
+    # anchor identity 별로 거리 순 정렬 후 앞에서 topk 개
+    order = np.lexsort((distances, anchors))
+    anchors, impostors, distances = anchors[order], impostors[order], distances[order]
+    rank = np.arange(len(anchors)) - np.searchsorted(anchors, anchors, side="left")
+    keep = rank < topk
+
+    table = np.full((num_identity, topk), -1, dtype=np.int64)
+    table[anchors[keep], rank[keep]] = impostors[keep]
+    kth = np.full(num_identity, np.inf)
+    last = rank == topk - 1
+    kth[anchors[last]] = distances[last]
+    return table, kth
+
+
+def hardest_impostor_identities(embedding, identity, num_identity, topk=10, neighbour=None, block=4096):
+
+    '''
+    identity 마다 가장 가까운 다른 identity topk 개를 거리 순으로 반환 (identity 사이의 거리 = 두 identity image 사이의 최소 거리)
+    image 마다 가까운 이웃 neighbour 개만 보고, 결과가 정확하지(exact) 않을 수 있는 identity 의 image 만 neighbour 를 두배로 늘려서 다시 구한다.
+    - 보지 않은 image 쌍의 거리는 그 image 의 cutoff(본 이웃 중 가장 먼 거리) 이상이므로,
+      identity 의 topk 번째 거리가 그 identity image 들의 cutoff 최소값 이하이면 빠진 identity 가 없다.
+
+    Parameters
+    ----------
+    embedding : (N, E) tensor
+    identity : (N,) tensor
+    neighbour : image 마다 처음에 볼 이웃 image 수, 기본값은 topk x 4
+    block : 한번에 거리를 구할 query 수 - (block, N) 행렬만 메모리에 올라간다.
+
+    return : (num_identity, topk) int64, 채우지 못한 칸은 -1
+    '''
+    number = embedding.shape[0]
+    if number == 0:
+        return np.full((num_identity, topk), -1, dtype=np.int64)
+    neighbour = min(topk * 4 if neighbour is None else neighbour, number)
+    square = torch.sum(embedding * embedding, dim=-1)
+    identity_numpy = identity.cpu().numpy()
+
+    rows = torch.arange(number, device=embedding.device)
+    cutoff = np.full(number, np.inf)
+    pair_rows = np.empty(0, dtype=np.int64)
+    impostors = np.empty(0, dtype=identity_numpy.dtype)
+    distances = np.empty(0, dtype=np.float32)
+    while True:
+        new_rows, new_impostors, new_distances, new_cutoff = _nearest_impostor_images(embedding, identity, square, rows, neighbour, block)
+        rows = rows.cpu().numpy()
+        old = ~np.isin(pair_rows, rows)  # 다시 구한 image 의 이전 결과는 버린다.
+        pair_rows = np.concatenate([pair_rows[old], new_rows])
+        impostors = np.concatenate([impostors[old], new_impostors])
+        distances = np.concatenate([distances[old], new_distances])
+        cutoff[rows] = new_cutoff
+
+        table, kth = _identity_table(identity_numpy[pair_rows], impostors, distances, num_identity, topk)
+        bound = np.full(num_identity, np.inf)
+        np.minimum.at(bound, identity_numpy, cutoff)
+        inexact = np.nonzero(kth > bound)[0]
+        if len(inexact) == 0 or neighbour >= number:
+            return table
+        neighbour = min(neighbour * 2, number)
+        rows = torch.as_tensor(np.nonzero(np.isin(identity_numpy, inexact))[0], device=embedding.device)
+
+
+def _mine(checkpoint_path, output_path, path, input_size, mean, std, base, embedding, topk, batch_size, num_workers, device):
+
+    device = torch.device(device)
+    net = get_resnet(base, pretrained=False, embedding=embedding)
+    net.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
+    net.to(device)
+
+    embeddings, identities = embed_dataset(net, path=path, input_size=input_size, mean=mean, std=std,
+                                           batch_size=batch_size, num_workers=num_workers, device=device)
+    num_identity = int(identities.max().item()) + 1 if identities.numel() else 0
+    table = hardest_impostor_identities(embeddings, identities, num_identity, topk=topk)
+
+    # 다 쓴 다음에 이름을 바꿔서, 읽는 쪽에서 쓰다 만 파일을 보지 않게 한다.
+    with open(output_path + ".tmp", "wb") as f:
+        np.save(f, table)
+    os.replace(output_path + ".tmp", output_path)
+
+
+class HardNegativeMiner(object):
+
+    '''
+    직전 checkpoint 로 train dataset 전체를 embedding 하고 identity 별 hardest impostor identity 를 찾는 작업을
+    별도의 process 에서 돌린다. - 학습과 겹쳐서 돌아간다.
+
+    start(state_dict) 로 시작하고, poll() 이 끝난 결과((num_identity, topk) int64)를 돌려준다.
+    결과는 TripletSampler / PKBatchSampler 의 set_hard_negatives 에 넘긴다.
+    '''
+    def __init__(self, work_path, path="Dataset/train", input_size=(256, 256), mean=[0.485, 0.456, 0.406],
+                 std=[0.229, 0.224, 0.225], base=18, embedding=128, topk=10, batch_size=64, num_workers=4, device="cpu"):
+
+        if not os.path.exists(work_path):
+            os.makedirs(work_path)
+        self._checkpoint_path = os.path.join(work_path, "hard_negative_mining.pt")
+        self._output_path = os.path.join(work_path, "hard_negative_mining.npy")
+        self._args = (path, tuple(input_size), mean, std, base, embedding, topk, batch_size, num_workers, str(device))
+        # cuda 를 쓰는 process 는 fork 로 만들 수 없다.
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+
+    @property
+    def running(self):
+        return self._process is not None and self._process.is_alive()
+
+    def start(self, state_dict):
+
+        # 이전 mining 이 아직 돌고 있으면 건너뛴다.
+        if self._process is not None:
+            return False
+
+        torch.save({key: value.cpu() for key, value in state_dict.items()}, self._checkpoint_path)
+        # mining process 는 dataloader worker 를 만들어야 하므로 daemon 으로 두지 않는다. - close() 에서 정리
+        self._process = self._context.Process(target=_mine, args=(self._checkpoint_path, self._output_path) + self._args)
+        self._process.start()
+        return True
+
+    def poll(self):
+
+        if self._process is None or self._process.is_alive():
+            return None
+
+        self._process.join()
+        exitcode = self._process.exitcode
+        self._process = None
+        if exitcode != 0:
+            logging.error(f"hard negative mining 실패 : exitcode {exitcode}")
+            return None
+        return np.load(self._output_path)
+
+    def close(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+
+# test
+if __name__ == "__main__":
+    import time
+
+    def brute_force(embedding, identity, num_identity, topk):
+        distance = torch.cdist(embedding, embedding) ** 2
+        identity_distance = torch.full((num_identity, num_identity), float("inf"))
+        for a in range(num_identity):
+            rows = distance[identity == a]
+            for b in range(num_identity):
+                if a != b and rows.numel() and (identity == b).any():
+                    identity_distance[a, b] = rows[:, identity == b].min()
+        expected = torch.topk(identity_distance, topk, dim=1, largest=False)[1].numpy()
+        present = torch.bincount(identity, minlength=num_identity).numpy() > 0
+        return expected, present
+
+    # 기본 neighbour(topk x 4) 로 구한 결과가 전체 거리 행렬로 구한 결과와 같은지
+    torch.manual_seed(0)
+    embedding = torch.nn.functional.normalize(torch.randn(5000, 128), dim=-1)
+    identity = torch.randint(500, (5000,))
+    start = time.time()
+    table = hardest_impostor_identities(embedding, identity, 500, topk=5, block=512)
+    print(f"mining time : {time.time() - start:0.3f}s")
+    expected, present = brute_force(embedding, identity, 500, 5)
+    print(f"same as brute force : {np.array_equal(table[present], expected[present])}")
+
+    # 4 개의 identity 가 한 군데 모여 있으면 image 마다 가까운 이웃 20 개가 모두 같은 무리의 다른 3 개 identity 에서 나온다.
+    # - 한번만 보면 나머지 2 개를 놓치므로 neighbour 를 늘려서 다시 구해야 한다.
+    center = torch.randn(25, 128).repeat_interleave(4, dim=0)
+    identity = torch.arange(100).repeat_interleave(10)
+    embedding = torch.nn.functional.normalize(center[identity] * 4 + torch.randn(1000, 128) * 0.1, dim=-1)
+    table = hardest_impostor_identities(embedding, identity, 100, topk=5, block=256)
+    expected, present = brute_force(embedding, identity, 100, 5)
+    print(f"clustered identities, same as brute force : {np.array_equal(table[present], expected[present])}")
@@ -19,88 +19,40 @@ class CenterTrainTransform(object):
         self._toTensor = torchvision.transforms.ToTensor()
         self._augmentation = augmentation
 
-    def __call__(self, anchor, positive, negative):
+    def _transform(self, image):
 
         if self._augmentation:
 
-            # anchor
             distortion = np.random.choice([False, True], p=[0.5, 0.5])
             if distortion:
-                anchor = image_random_color_distort(anchor, brightness_delta=32, contrast_low=0.5, contrast_high=1.5,
-                                                    saturation_low=0.5, saturation_high=1.5, hue_delta=0.21)
+                image = image_random_color_distort(image, brightness_delta=32, contrast_low=0.5, contrast_high=1.5,
+                                                   saturation_low=0.5, saturation_high=1.5, hue_delta=0.21)
 
             # random horizontal flip with probability of 0.5
-            anchor, flips = random_flip(anchor, px=0.5)
+            image, flips = random_flip(image, px=0.5)
 
             # # random vertical flip with probability of 0.5
-            # anchor, flips = random_flip(anchor, py=0.5)
+            # image, flips = random_flip(image, py=0.5)
             #
             # # rotate
             # select = [cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE, cv2.ROTATE_180]
-            # anchor = cv2.rotate(anchor,  random.choice(select))
+            # image = cv2.rotate(image,  random.choice(select))
 
             # resize with random interpolation
             interp = np.random.randint(0, 5)
-            anchor = cv2.resize(anchor, (self._width, self._height), interpolation=interp)
-
-            # positive
-            distortion = np.random.choice([False, True], p=[0.5, 0.5])
-            if distortion:
-                positive = image_random_color_distort(positive, brightness_delta=32, contrast_low=0.5, contrast_high=1.5,
-                                                      saturation_low=0.5, saturation_high=1.5, hue_delta=0.21)
-
-            # random horizontal flip with probability of 0.5
-            positive, flips = random_flip(positive, px=0.5)
-
-            # # random vertical flip with probability of 0.5
-            # positive, flips = random_flip(positive, py=0.5)
-            #
-            # # rotate
-            # select = [cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE, cv2.ROTATE_180]
-            # positive = cv2.rotate(positive,  random.choice(select))
-
-            # resize with random interpolation
-            interp = np.random.randint(0, 5)
-            positive = cv2.resize(positive, (self._width, self._height), interpolation=interp)
-
-            # negative
-            distortion = np.random.choice([False, True], p=[0.5, 0.5])
-            if distortion:
-                negative = image_random_color_distort(negative, brightness_delta=32, contrast_low=0.5, contrast_high=1.5,
-                                                      saturation_low=0.5, saturation_high=1.5, hue_delta=0.21)
-
-            # random horizontal flip with probability of 0.5
-            negative, flips = random_flip(negative, px=0.5)
-
-            # # random vertical flip with probability of 0.5
-            # negative, flips = random_flip(negative, py=0.5)
-
-            # # rotate
-            # select = [cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE, cv2.ROTATE_180]
-            # negative = cv2.rotate(negative,  random.choice(select))
-
-            # resize with random interpolation
-            interp = np.random.randint(0, 5)
-            negative = cv2.resize(negative, (self._width, self._height), interpolation=interp)
+            image = cv2.resize(image, (self._width, self._height), interpolation=interp)
 
         else:
-            anchor = cv2.resize(anchor, (self._width, self._height), interpolation=1)
-            positive = cv2.resize(positive, (self._width, self._height), interpolation=1)
-            negative = cv2.resize(negative, (self._width, self._height), interpolation=1)
-
-        anchor = self._toTensor(anchor)  # 0 ~ 1 로 바꾸기
-        anchor = torch.sub(anchor, self._mean)
-        anchor = torch.div(anchor, self._std)
+            image = cv2.resize(image, (self._width, self._height), interpolation=1)
 
-        positive = self._toTensor(positive)  # 0 ~ 1 로 바꾸기
-        positive = torch.sub(positive, self._mean)
-        positive = torch.div(positive, self._std)
+        image = self._toTensor(image)  # 0 ~ 1 로 바꾸기
+        image = torch.sub(image, self._mean)
+        image = torch.div(image, self._std)
+        return image
 
-        negative = self._toTensor(negative)  # 0 ~ 1 로 바꾸기
-        negative = torch.sub(negative, self._mean)
-        negative = torch.div(negative, self._std)
-
-        return anchor, positive, negative
+    def __call__(self, *images):
+        # (anchor, positive, negative) 또는 PK sampling 의 image 1장 - 들어온 image 마다 따로 augmentation
+        return tuple(self._transform(image) for image in images)
 
 
 
@@ -114,24 +66,16 @@ class CenterValidTransform(object):
         self._std = torch.as_tensor(std).reshape((3, 1, 1))
         self._toTensor = torchvision.transforms.ToTensor()
 
-    def __call__(self, anchor, positive, negative):
-
-        anchor = cv2.resize(anchor, (self._width, self._height), interpolation=1)
-        anchor = self._toTensor(anchor)  # 0 ~ 1 로 바꾸기
-        anchor = torch.sub(anchor, self._mean)
-        anchor = torch.div(anchor, self._std)
-
-        positive = cv2.resize(positive, (self._width, self._height), interpolation=1)
-        positive = self._toTensor(positive)  # 0 ~ 1 로 바꾸기
-        positive = torch.sub(positive, self._mean)
-        positive = torch.div(positive, self._std)
+    def _transform(self, image):
 
-        negative = cv2.resize(negative, (self._width, self._height), interpolation=1)
-        negative = self._toTensor(negative)  # 0 ~ 1 로 바꾸기
-        negative = torch.sub(negative, self._mean)
-        negative = torch.div(negative, self._std)
+        image = cv2.resize(image, (self._width, self._height), interpolation=1)
+        image = self._toTensor(image)  # 0 ~ 1 로 바꾸기
+        image = torch.sub(image, self._mean)
+        image = torch.div(image, self._std)
+        return image
 
-        return anchor, positive, negative
+    def __call__(self, *images):
+        return tuple(self._transform(image) for image in images)
 
 # test
 if __name__ == "__main__":
@@ -7,8 +7,11 @@ https://tech.kakaoenterprise.com/63
 
 Face recognition is a broad problem of identifying or verifying people in photographs and videos.
 '''
+import logging
+
 import mlflow as ml
 import torch
+import torch.distributed as dist
 import yaml
 
 import test_verification
@@ -47,13 +50,21 @@ image_std = parser["image_std"]
 embedding = parser["embedding"]
 margin = parser["margin"]
 semi_hard_negative = parser["semi_hard_negative"]
+pk_sampling = parser["pk_sampling"]
+identities_per_batch = parser["identities_per_batch"]
+images_per_identity = parser["images_per_identity"]
+hard_negative_mining = parser["hard_negative_mining"]
+hard_negative_topk = parser["hard_negative_topk"]
 
 epoch = parser["epoch"]
 batch_size = parser["batch_size"]
 batch_log = parser["batch_log"]
 subdivision = parser["subdivision"]
+precision = parser["precision"]
+channels_last = parser["channels_last"]
 data_augmentation = parser["data_augmentation"]
 num_workers = parser["num_workers"]
+prefetch_factor = parser["prefetch_factor"]
 optimizer = parser["optimizer"]
 learning_rate = parser["learning_rate"]
 weight_decay = parser["weight_decay"]
@@ -63,6 +74,10 @@ decay_step = parser["decay_step"]
 # gpu vs cpu
 parser = stream['context']
 using_cuda = parser["using_cuda"]
+distributed = parser["distributed"]
+world_size = parser["world_size"]
+backend = parser["backend"]
+init_method = parser["init_method"]
 
 parser = stream['validation']
 valid_size = parser["valid_size"]
@@ -78,6 +93,31 @@ if torch.cuda.device_count() > 0 and using_cuda:
 else:
     GPU_COUNT = 0
 
+
+def distributed_run(rank, world_size, backend, init_method, run_id, kwargs):
+
+    '''
+    distributed 모드에서 torch.multiprocessing.spawn 이 process 마다 부르는 함수 - rank 는 spawn 이 0 부터 넘겨준다.
+    process group 을 만들고 train.run 을 부르면, train.run 은 DataParallel 대신 DistributedDataParallel 로 학습한다.
+    '''
+    dist.init_process_group(backend=backend, init_method=init_method, world_size=world_size, rank=rank)
+    if rank == 0:
+        if run_id is not None:
+            # spawn 된 process 에는 active run 이 없으므로, 부모 process 가 만든 run 에 이어서 기록한다.
+            ml.set_tracking_uri("./mlruns")
+            ml.start_run(run_id=run_id)
+    else:
+        # 같은 log 가 process 수 만큼 찍히지 않게 rank 0 만 info 를 남긴다.
+        logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        train.run(**kwargs)
+    finally:
+        if rank == 0 and run_id is not None:
+            ml.end_run()
+        dist.destroy_process_group()
+
+
 # window 운영체제에서 freeze support 안나오게 하려면, 아래와 같이 __name__ == "__main__" 에 해줘야함.
 if __name__ == "__main__":
 
@@ -96,6 +136,11 @@ if __name__ == "__main__":
             ml.log_param("embedding vector size", embedding)
             ml.log_param("margin", margin)
             ml.log_param("semi hard negative", semi_hard_negative)
+            ml.log_param("pk sampling", pk_sampling)
+            ml.log_param("identities per batch", identities_per_batch)
+            ml.log_param("images per identity", images_per_identity)
+            ml.log_param("hard negative mining", hard_negative_mining)
+            ml.log_param("hard negative topk", hard_negative_topk)
 
             ml.log_param("height", input_size[0])
             ml.log_param("width", input_size[1])
@@ -105,49 +150,75 @@ if __name__ == "__main__":
             ml.log_param("test dataset path", test_dataset_path)
             ml.log_param("epoch", epoch)
             ml.log_param("batch size", batch_size)
+            ml.log_param("precision", precision)
+            ml.log_param("channels_last", channels_last)
             ml.log_param("data augmentation", data_augmentation)
             ml.log_param("optimizer", optimizer)
             ml.log_param("num_workers", num_workers)
+            ml.log_param("prefetch_factor", prefetch_factor)
 
             ml.log_param("learning rate", learning_rate)
             ml.log_param("weight decay", weight_decay)
             ml.log_param("decay lr", decay_lr)
             ml.log_param("decay step", decay_step)
             ml.log_param("using_cuda", using_cuda)
+            ml.log_param("distributed", distributed)
+            if distributed:
+                ml.log_param("world_size", world_size)
+                ml.log_param("backend", backend)
             ml.log_param("save_period", save_period)
 
         torch.backends.cudnn.deterministic = False
         torch.backends.cudnn.benchmark = True # 그래프가 변하는 경우 학습 속도 느려질수 있음.
-        train.run(mean=image_mean,
-                  std=image_std,
-                  threshold = threshold,
-                  embedding=embedding,
-                  margin=margin,
-                  semi_hard_negative=semi_hard_negative,
-                  epoch=epoch,
-                  input_size=input_size,
-                  batch_size=batch_size,
-                  batch_log=batch_log,
-                  subdivision=subdivision,
-                  train_dataset_path=train_dataset_path,
-                  valid_dataset_path=valid_dataset_path,
-                  data_augmentation=data_augmentation,
-                  num_workers=num_workers,
-                  optimizer=optimizer,
-                  save_period=save_period,
-                  load_period=load_period,
-                  learning_rate=learning_rate,
-                  weight_decay=weight_decay,
-                  decay_lr=decay_lr,
-                  decay_step=decay_step,
-                  GPU_COUNT=GPU_COUNT,
-                  base=base,
-                  pretrained_base=pretrained_base,
-
-                  valid_size=valid_size,
-                  eval_period=eval_period,
-                  tensorboard=tensorboard,
-                  using_mlflow=using_mlflow)
+        train_kwargs = dict(mean=image_mean,
+                            std=image_std,
+                            threshold = threshold,
+                            embedding=embedding,
+                            margin=margin,
+                            semi_hard_negative=semi_hard_negative,
+                            pk_sampling=pk_sampling,
+                            identities_per_batch=identities_per_batch,
+                            images_per_identity=images_per_identity,
+                            hard_negative_mining=hard_negative_mining,
+                            hard_negative_topk=hard_negative_topk,
+                            epoch=epoch,
+                            input_size=input_size,
+                            batch_size=batch_size,
+                            batch_log=batch_log,
+                            subdivision=subdivision,
+                            precision=precision,
+                            channels_last=channels_last,
+                            train_dataset_path=train_dataset_path,
+                            valid_dataset_path=valid_dataset_path,
+                            data_augmentation=data_augmentation,
+                            num_workers=num_workers,
+                            prefetch_factor=prefetch_factor,
+                            optimizer=optimizer,
+                            save_period=save_period,
+                            load_period=load_period,
+                            learning_rate=learning_rate,
+                            weight_decay=weight_decay,
+                            decay_lr=decay_lr,
+                            decay_step=decay_step,
+                            GPU_COUNT=GPU_COUNT,
+                            base=base,
+                            pretrained_base=pretrained_base,
+
+                            valid_size=valid_size,
+                            eval_period=eval_period,
+                            tensorboard=tensorboard,
+                            using_mlflow=using_mlflow)
+
+        if distributed:
+            # process 마다 model 하나씩 - checkpoint / tensorboard / mlflow 는 rank 0 만 쓴다.
+            torch.multiprocessing.spawn(distributed_run,
+                                        args=(world_size, backend, init_method,
+                                              ml.active_run().info.run_id if using_mlflow else None,
+                                              train_kwargs),
+                                        nprocs=world_size,
+                                        join=True)
+        else:
+            train.run(**train_kwargs)
 
         if using_mlflow:
             ml.end_run()
@@ -161,7 +232,7 @@ if __name__ == "__main__":
                                   threshold = threshold,
                                   load_name=load_name, load_period=load_period, GPU_COUNT=GPU_COUNT,
                                   test_weight_path=test_weight_path,
-                                  test_dataset_path=test_dataset_path, num_workers=num_workers,
+                                  test_dataset_path=test_dataset_path, num_workers=num_workers, prefetch_factor=prefetch_factor,
                                   test_save_path=test_save_path,
                                   show_flag=show_flag,
                                   save_flag=save_flag)
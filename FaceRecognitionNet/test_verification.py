@@ -7,7 +7,7 @@ import numpy as np
 import torch
 from tqdm import tqdm
 
-from core import testdataloader
+from core import testdataloader, triplet_embedding
 
 logfilepath = ""  # 따로 지정하지 않으면 terminal에 뜸
 if os.path.isfile(logfilepath):
@@ -22,6 +22,7 @@ def run(mean=[0.485, 0.456, 0.406],
         test_weight_path="weights",
         test_dataset_path="Dataset/test",
         num_workers=4,
+        prefetch_factor=2,
         test_save_path="result",
         show_flag=True,
         save_flag=True):
@@ -64,6 +65,7 @@ def run(mean=[0.485, 0.456, 0.406],
         test_dataloader, test_dataset = testdataloader(path=test_dataset_path,
                                                        input_size=(netheight, netwidth),
                                                        num_workers=num_workers,
+                                                       prefetch_factor=prefetch_factor,
                                                        mean=mean, std=std)
     except Exception:
         logging.info("The dataset does not exist")
@@ -100,9 +102,8 @@ def run(mean=[0.485, 0.456, 0.406],
 
         with torch.no_grad():
 
-            anchor_pred = net(anchor)
-            positive_pred = net(positive)
-            negative_pred = net(negative)
+            anchor_pred, positive_pred, negative_pred = triplet_embedding(net, anchor, positive, negative,
+                                                                          anchor_path, positive_path, negative_path)
 
             distance_of_ap = torch.nn.functional.pairwise_distance(anchor_pred, positive_pred, p=2.0)
             distance_of_an = torch.nn.functional.pairwise_distance(anchor_pred, negative_pred, p=2.0)
@@ -172,5 +173,6 @@ if __name__ == "__main__":
         test_dataset_path="Dataset/test",
         test_save_path="result",
         num_workers=4,
+        prefetch_factor=2,
         show_flag=True,
         save_flag=True)
@@ -1,3 +1,4 @@
+import functools
 import glob
 import logging
 import os
@@ -5,18 +6,20 @@ import platform
 import time
 
 import cv2
-import mlflow as ml
 import numpy as np
 import torch
+import torch.distributed as dist
 import torchvision
 from torch.nn import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import Adam, RMSprop, SGD, lr_scheduler
 from torch.utils.tensorboard import SummaryWriter
 from torchsummary import summary as modelsummary
 from tqdm import tqdm
 
-from core import PrePostNet
-from core import TripletLoss, PairwiseDistance
+from core import PrePostNet, triplet_embedding, AsyncLogger, AsyncCheckpointer, all_reduce_mean, gradient_sync, amp_dtype, autocast, grad_scaler
+from core import HardNegativeMiner
+from core import TripletLoss, BatchTripletLoss, PairwiseDistance
 from core import get_resnet
 from core import traindataloader, validdataloader
 
@@ -38,15 +41,23 @@ def run(mean=[0.485, 0.456, 0.406],
         batch_size=16,
         batch_log=100,
         subdivision=4,
+        precision="fp32",
+        channels_last=False,
         train_dataset_path="Dataset/train",
         valid_dataset_path="Dataset/valid",
         data_augmentation=True,
         num_workers=4,
+        prefetch_factor=2,
         optimizer="ADAM",
         save_period=5,
         load_period=10,
         margin = 0.2,
         semi_hard_negative=True,
+        pk_sampling=False,
+        identities_per_batch=8,
+        images_per_identity=4,
+        hard_negative_mining=False,
+        hard_negative_topk=10,
         learning_rate=0.001, decay_lr=0.999, decay_step=10,
         weight_decay=0.000001,
         GPU_COUNT=0,
@@ -57,8 +68,21 @@ def run(mean=[0.485, 0.456, 0.406],
         tensorboard=True,
         using_mlflow=True):
 
+    # main.py 의 distributed 모드 - process 마다 불리고, process group 은 main.py 에서 만든다.
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    world_size = dist.get_world_size() if distributed else 1
+    # checkpoint / tensorboard / mlflow 는 rank 0 만 쓴다.
+    main_process = rank == 0
+    tensorboard = tensorboard and main_process
+    using_mlflow = using_mlflow and main_process
+
     if GPU_COUNT == 0:
         device = torch.device("cpu")
+    elif distributed:
+        # process 마다 gpu 하나
+        device = torch.device(f"cuda:{rank % GPU_COUNT}")
+        torch.cuda.set_device(device)
     elif GPU_COUNT == 1:
         device = torch.device("cuda")
     else:
@@ -87,7 +111,7 @@ def run(mean=[0.485, 0.456, 0.406],
             logging.info(f'{torch.cuda.get_device_name(d)}')
             logging.info(f'Running on {d} / free memory : {free_memory}GB / total memory {total_memory}GB')
     else:
-        if GPU_COUNT == 1:
+        if device.type == "cuda":
             total_memory = torch.cuda.get_device_properties(device).total_memory
             free_memory = total_memory - torch.cuda.max_memory_allocated(device)
             free_memory = round(free_memory / (1024 ** 3), 2)
@@ -97,7 +121,7 @@ def run(mean=[0.485, 0.456, 0.406],
         else:
             logging.info(f'Running on {device}')
 
-    if GPU_COUNT > 0 and batch_size < GPU_COUNT:
+    if not distributed and GPU_COUNT > 0 and batch_size < GPU_COUNT:
         logging.info("batch size must be greater than gpu number")
         exit(0)
 
@@ -107,13 +131,29 @@ def run(mean=[0.485, 0.456, 0.406],
     logging.info("training classification")
     input_shape = (1, 3) + tuple(input_size)
 
+    if pk_sampling:
+        # P x K 장이 (process 마다) 한 batch, triplet 은 batch 안에서 고른다.
+        batch_size = identities_per_batch * images_per_identity * world_size
+        logging.info(f"PK sampling : {identities_per_batch} identities x {images_per_identity} images per batch")
+
+    if batch_size % world_size != 0:
+        logging.info("batch size must be divisible by world size")
+        exit(0)
+    # batch_size 는 모든 process 를 합친 batch 이고, process 하나는 local_batch_size 씩 올린다. (distributed 가 아니면 같다.)
+    local_batch_size = batch_size // world_size
+
     train_dataloader, train_dataset = traindataloader(augmentation=data_augmentation,
                                                       path=train_dataset_path,
                                                       input_size=input_size,
-                                                      batch_size=batch_size,
+                                                      batch_size=local_batch_size,
                                                       pin_memory=True,
                                                       num_workers=num_workers,
-                                                      shuffle=True, mean=mean, std=std)
+                                                      prefetch_factor=prefetch_factor,
+                                                      shuffle=True, mean=mean, std=std,
+                                                      pk_sampling=pk_sampling,
+                                                      identities_per_batch=identities_per_batch,
+                                                      images_per_identity=images_per_identity,
+                                                      distributed=distributed)
 
     train_update_number_per_epoch = len(train_dataloader)
     if train_update_number_per_epoch < 1:
@@ -126,8 +166,10 @@ def run(mean=[0.485, 0.456, 0.406],
                                                           input_size=input_size,
                                                           batch_size=valid_size,
                                                           num_workers=num_workers,
+                                                          prefetch_factor=prefetch_factor,
                                                           pin_memory=True,
-                                                          shuffle=True, mean=mean, std=std)
+                                                          shuffle=True, mean=mean, std=std,
+                                                          distributed=distributed)
         valid_update_number_per_epoch = len(valid_dataloader)
         if valid_update_number_per_epoch < 1:
             logging.warning("valid batch size가 데이터 수보다 큼")
@@ -148,18 +190,22 @@ def run(mean=[0.485, 0.456, 0.406],
     param_path = os.path.join(weight_path, f'{model}-{load_period:04d}.pt')
 
     start_epoch = 0
-    net = get_resnet(18, pretrained=pretrained_base, embedding=embedding)
+    build_net = functools.partial(get_resnet, 18, pretrained=pretrained_base, embedding=embedding)
+    net = build_net()
 
     # https://github.com/sksq96/pytorch-summary
-    if GPU_COUNT == 0:
+    if main_process and GPU_COUNT == 0:
         modelsummary(net.to(context), input_shape[1:], device="cpu")
-    elif GPU_COUNT > 0:
+    elif main_process and GPU_COUNT > 0:
         modelsummary(net.to(context), input_shape[1:], device="cuda")
 
     if tensorboard:
         summary = SummaryWriter(log_dir=os.path.join("torchboard", model), max_queue=10, flush_secs=10)
         summary.add_graph(net.to(context), input_to_model=torch.ones(input_shape, device=context), verbose=False)
 
+    # tensorboard / mlflow 기록은 background thread 에서 - 학습 loop 를 기다리게 하지 않는다.
+    logger = AsyncLogger(summary=summary if tensorboard else None, using_mlflow=using_mlflow)
+
     if os.path.exists(param_path):
         start_epoch = load_period
         checkpoint = torch.load(param_path)
@@ -176,6 +222,10 @@ def run(mean=[0.485, 0.456, 0.406],
         exit(0)
 
     net.to(context)
+    # channels_last 이면 conv weight 와 input 을 NHWC 순서로 둔다. - cudnn / oneDNN 이 layout 을 바꾸는 복사 없이 계산한다.
+    memory_format = torch.channels_last if channels_last else torch.preserve_format
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
 
     if optimizer.upper() == "ADAM":
         trainer = Adam(net.parameters(), lr=learning_rate, betas=(0.9, 0.999), weight_decay=weight_decay)
@@ -198,11 +248,18 @@ def run(mean=[0.485, 0.456, 0.406],
             else:
                 logging.info(f"loading optimizer_state_dict")
 
-    if isinstance(device, (list, tuple)):
+    if distributed:
+        # gloo 로 cpu 에서 돌릴 때는 device_ids 없이
+        net = DistributedDataParallel(net, device_ids=[context] if context.type == "cuda" else None)
+    elif isinstance(device, (list, tuple)):
         net = DataParallel(net, device_ids=device, output_device=context, dim=0)
+    module = net.module if isinstance(net, (DataParallel, DistributedDataParallel)) else net
+    # 검증은 process 마다 자기 몫만 - DistributedDataParallel 의 forward 는 buffer 를 broadcast 하므로 rank 0 만 부르면 멈춘다.
+    valid_net = module if distributed else net
 
     PDLoss = PairwiseDistance(p = 2.0)
     TLLoss = TripletLoss(margin=margin)
+    BTLoss = BatchTripletLoss(margin=margin, semi_hard_negative=semi_hard_negative)
 
     # optimizer
     # https://pytorch.org/docs/master/optim.html?highlight=lr%20sche#torch.optim.lr_scheduler.CosineAnnealingLR
@@ -210,134 +267,184 @@ def run(mean=[0.485, 0.456, 0.406],
     step = unit * decay_step
     lr_sch = lr_scheduler.StepLR(trainer, step, gamma=decay_lr, last_epoch=-1)
 
+    # precision 이 fp16 / bf16 이면 forward 와 loss 를 autocast 로 감싼다. - fp16 은 GradScaler 로 loss 를 키워서 backward 한다.
+    amp = amp_dtype(precision, context)
+    scaler = grad_scaler(amp)
+    if amp is not None:
+        logging.info(f"mixed precision : {amp}")
+
     # torch split이 numpy, mxnet split과 달라서 아래와 같은 작업을 하는 것
-    if batch_size % subdivision == 0:
-        chunk = int(batch_size) // int(subdivision)
+    if local_batch_size % subdivision == 0:
+        chunk = int(local_batch_size) // int(subdivision)
     else:
         logging.info(f"batch_size / subdivision 이 나누어 떨어지지 않습니다.")
         logging.info(f"subdivision 을 다시 설정하고 학습 진행하세요.")
         exit(0)
 
+    # 학습과 별도의 process 에서 epoch 마다 직전 weight 로 identity 별 hardest impostor identity 를 찾는다.
+    # distributed 이면 rank 0 만 찾고, 찾은 표는 모든 process 에 broadcast 한다.
+    train_sampler = train_dataloader.batch_sampler if pk_sampling else train_dataloader.sampler
+    if hard_negative_mining and main_process:
+        miner = HardNegativeMiner(weight_path, path=train_dataset_path, input_size=input_size, mean=mean, std=std,
+                                  base=18, embedding=embedding, topk=hard_negative_topk,
+                                  batch_size=local_batch_size, num_workers=num_workers, device=context)
+
+    # save_period 마다의 .pt / .jit 저장은 background process 에서 - 학습은 disk 쓰기, script 변환을 기다리지 않는다.
+    if main_process:
+        checkpointer = AsyncCheckpointer(build_net=functools.partial(build_net, pretrained=False),
+                                         build_prepostnet=PrePostNet)
+
     start_time = time.time()
-    for i in tqdm(range(start_epoch + 1, epoch + 1, 1), initial=start_epoch + 1, total=epoch):
+    for i in tqdm(range(start_epoch + 1, epoch + 1, 1), initial=start_epoch + 1, total=epoch,
+                  disable=not main_process):
 
         loss_sum = 0
+        nan_count = 0
         net.train()
         time_stamp = time.time()
 
+        train_sampler.set_epoch(i)
+        if hard_negative_mining:
+            hard_negatives = miner.poll() if main_process else None
+            if distributed:
+                hard_negatives = [hard_negatives]
+                dist.broadcast_object_list(hard_negatives, src=0)
+                hard_negatives = hard_negatives[0]
+            if hard_negatives is not None:
+                train_sampler.set_hard_negatives(hard_negatives)
+                logging.info(f"[Epoch {i}] using mined hard negatives")
+
         # multiscale을 하게되면 여기서 train_dataloader을 다시 만드는 것이 좋겠군..
-        for batch_count, (anchor, positive, negative, _, _, _) in enumerate(
+        for batch_count, batch in enumerate(
                 train_dataloader,
                 start=1):
 
             trainer.zero_grad()
 
-            anchor = anchor.to(context)
-            positive = positive.to(context)
-            negative = negative.to(context)
-
-            '''
-            이렇게 하는 이유?
-            209 line에서 net = net.to(context)로 함
-            gpu>=1 인 경우 net = DataParallel(net, device_ids=device, output_device=context, dim=0) 에서 
-            output_device - gradient가 계산되는 곳을 context로 했기 때문에 아래의 target들도 context로 지정해줘야 함
-            '''
-            anchor_split = torch.split(anchor, chunk, dim=0)
-            positive_split = torch.split(positive, chunk, dim=0)
-            negative_split = torch.split(negative, chunk, dim=0)
-
-            losses = []
-            total_loss = 0.0
-
-            for anchor_part, positive_part, negative_part in zip(
-                    anchor_split,
-                    positive_split,
-                    negative_split):
-
-                anchor_pred = net(anchor_part)
-                positive_pred = net(positive_part)
-                negative_pred = net(negative_part)
+            if pk_sampling:
+                image, identity, _ = batch
+                image = image.to(context, memory_format=memory_format)
+                identity = identity.to(context)
+
+                # batch 안의 모든 (anchor, positive, negative) 조합에서 고르려면 P x K 장의 embedding 이 한번에 있어야 하므로
+                # subdivision 으로 나누지 않고 한번에 forward 한다.
+                with autocast(context, amp):
+                    loss = BTLoss(net(image), identity)
+                scaler.scale(loss).backward()
+                losses = [loss.detach()]
+                sample_number = image.shape[0]
+            else:
+                anchor, positive, negative, _, _, _ = batch
+                anchor = anchor.to(context, memory_format=memory_format)
+                positive = positive.to(context, memory_format=memory_format)
+                negative = negative.to(context, memory_format=memory_format)
 
                 '''
-                pytorch는 trainer.step()에서 batch_size 인자가 없다.
-                Loss 구현시 고려해야 한다.(mean 모드) 
+                이렇게 하는 이유?
+                209 line에서 net = net.to(context)로 함
+                gpu>=1 인 경우 net = DataParallel(net, device_ids=device, output_device=context, dim=0) 에서 
+                output_device - gradient가 계산되는 곳을 context로 했기 때문에 아래의 target들도 context로 지정해줘야 함
                 '''
-                ap_select = PDLoss(anchor_pred, positive_pred)
-                an_select = PDLoss(anchor_pred, negative_pred)
-
-                if semi_hard_negative:
-                    # Semi-Hard Negative triplet selection
-                    # (negative_distance - positive_distance < margin) AND (positive_distance < negative_distance)
-                    # https://github.com/tamerthamoqa/facenet-pytorch-vggface2/blob/master/train_triplet_loss.py
-                    first_condition = (an_select - ap_select) < margin
-                    second_condition = ap_select < an_select
-                    all = (torch.logical_and(first_condition, second_condition))
-                    valid_triplets = torch.where(all == 1)
-                else:
-                    # Hard Negative triplet selection
-                    # (negative_distance - positive_distance < margin)
-                    # https://github.com/tamerthamoqa/facenet-pytorch-vggface2/blob/master/train_triplet_loss.py
-                    all = (an_select - ap_select) < margin
-                    valid_triplets = torch.where(all == 1)
-
-                triplet_loss = TLLoss(anchor_pred[valid_triplets],
-                                      positive_pred[valid_triplets],
-                                      negative_pred[valid_triplets])
-                loss = torch.div(triplet_loss, subdivision)
-                losses.append(loss.item())
-                total_loss = total_loss + loss
-
-            if total_loss.isnan():
-                logging.info("loss is nan")
-                loss_sum += 0
+                anchor_split = torch.split(anchor, chunk, dim=0)
+                positive_split = torch.split(positive, chunk, dim=0)
+                negative_split = torch.split(negative, chunk, dim=0)
+
+                losses = []
+
+                for j, (anchor_part, positive_part, negative_part) in enumerate(zip(
+                        anchor_split,
+                        positive_split,
+                        negative_split)):
+
+                    # distributed 이면 마지막 chunk 의 backward 에서만 gradient 를 all-reduce 한다.
+                    with gradient_sync(net, sync=j == len(anchor_split) - 1):
+                        with autocast(context, amp):
+                            # augmentation 이 image 마다 다르므로 중복 제거 없이 합쳐서 한번에 forward
+                            anchor_pred, positive_pred, negative_pred = triplet_embedding(net, anchor_part, positive_part, negative_part)
+
+                            '''
+                            pytorch는 trainer.step()에서 batch_size 인자가 없다.
+                            Loss 구현시 고려해야 한다.(mean 모드) 
+                            '''
+                            ap_select = PDLoss(anchor_pred, positive_pred)
+                            an_select = PDLoss(anchor_pred, negative_pred)
+
+                            if semi_hard_negative:
+                                # Semi-Hard Negative triplet selection
+                                # (negative_distance - positive_distance < margin) AND (positive_distance < negative_distance)
+                                # https://github.com/tamerthamoqa/facenet-pytorch-vggface2/blob/master/train_triplet_loss.py
+                                first_condition = (an_select - ap_select) < margin
+                                second_condition = ap_select < an_select
+                                all = (torch.logical_and(first_condition, second_condition))
+                                valid_triplets = torch.where(all == 1)
+                            else:
+                                # Hard Negative triplet selection
+                                # (negative_distance - positive_distance < margin)
+                                # https://github.com/tamerthamoqa/facenet-pytorch-vggface2/blob/master/train_triplet_loss.py
+                                all = (an_select - ap_select) < margin
+                                valid_triplets = torch.where(all == 1)
+
+                            triplet_loss = TLLoss(anchor_pred[valid_triplets],
+                                                  positive_pred[valid_triplets],
+                                                  negative_pred[valid_triplets])
+                            loss = torch.div(triplet_loss, subdivision)
+                        losses.append(loss.detach())
+
+                        # chunk 마다 backward - 이 chunk 의 graph 는 여기서 풀리고 gradient 는 parameter 의 .grad 에 누적된다.
+                        # 모든 chunk 의 graph 를 들고 있다가 한번에 backward 하면 subdivision 으로 activation memory 가 줄지 않는다.
+                        scaler.scale(loss).backward()
+
+                sample_number = anchor.shape[0] * 3
+
+            # nan 인 batch 는 optimizer / lr_sch 의 step 을 모두 건너뛴다. (gradient 를 0 으로 만들고 step 하면 momentum, weight decay 로 parameter 가 움직인다.)
+            # step 을 할지 정하려면 batch 마다 한번은 기다려야 한다. loss 값은 device 에 쌓아두고 batch_log 마다 한번만 가져온다.
+            losses = sum(losses).float()
+            finite = torch.isfinite(losses)
+            if distributed:
+                # 한 process 라도 nan 이면 모든 process 가 같이 건너뛰어야 parameter 가 어긋나지 않는다. - flag 하나만 all-reduce
+                finite = finite.int()
+                dist.all_reduce(finite, op=dist.ReduceOp.MIN)
+            if not finite.item():
+                # 이미 chunk 마다 backward 했으므로, nan 이 섞인 gradient 를 지우고 이 batch 는 건너뛴다.
+                trainer.zero_grad()
+                nan_count += 1
                 continue
-            else:
-                total_loss.backward()
-                trainer.step()
-                lr_sch.step()
-                loss_sum += sum(losses)
+
+            scaler.step(trainer)
+            scaler.update()
+            lr_sch.step()
+            loss_sum += losses
 
             if batch_count % batch_log == 0:
                 logging.info(f'[Epoch {i}][Batch {batch_count}/{train_update_number_per_epoch}]'
-                             f'[Speed {(anchor.shape[0]*3) / (time.time() - time_stamp):.3f} samples/sec]'
+                             f'[Speed {sample_number / (time.time() - time_stamp):.3f} samples/sec]'
                              f'[Lr = {lr_sch.get_last_lr()}]'
-                             f'[loss = {sum(losses):.3f}]')
+                             f'[loss = {losses.item():.3f}]'
+                             f'[nan batch = {nan_count}]')
             time_stamp = time.time()
 
+        # process 마다 다른 data 를 봤으므로 process 평균 (distributed 가 아니면 그대로)
+        loss_sum, = all_reduce_mean([loss_sum])
         train_loss_mean = np.divide(loss_sum, train_update_number_per_epoch)
 
         logging.info(
             f"train loss : {train_loss_mean}")
+        if nan_count > 0:
+            logging.info(f"loss is nan : {nan_count} batch")
+
+        if hard_negative_mining and main_process and miner.start(module.state_dict()):
+            logging.info(f"[Epoch {i}] hard negative mining started")
 
-        if i % save_period == 0:
+        if i % save_period == 0 and main_process:
 
             if not os.path.exists(weight_path):
                 os.makedirs(weight_path)
 
-            module = net.module if isinstance(device, (list, tuple)) else net
-            pretnet = PrePostNet(net=module)  # 새로운 객체가 생성
-
-            try:
-                torch.save({
-                    'model_state_dict': net.state_dict(),
-                    'optimizer_state_dict': trainer.state_dict()}, os.path.join(weight_path, f'{model}-{i:04d}.pt'))
-
-                # torch.jit.trace() 보다는 control-flow 연산 적용이 가능한 torch.jit.script() 을 사용하자
-                # torch.jit.script
-
-                script = torch.jit.script(module)
-                script.save(os.path.join(weight_path, f'{model}-{i:04d}.jit'))
-
-                script = torch.jit.script(pretnet)
-                script.save(os.path.join(weight_path, f'{model}-prepost-{i:04d}.jit'))
-
-                # trace = torch.jit.trace(prepostnet, torch.rand(input_shape[0], input_shape[1], input_shape[2], input_shape[3], device=context))
-                # trace.save(os.path.join(weight_path, f'{model}-{i:04d}.jit'))
-
-            except Exception as E:
-                logging.error(f"pt, jit export 예외 발생 : {E}")
-            else:
-                logging.info("pt, jit export 성공")
+            # state_dict 를 cpu 로 복사해서 넘기기만 한다. - .pt 저장, torch.jit.script export 는 checkpointer 의 process 에서 (결과는 logging 으로)
+            checkpointer.save(module.state_dict(), trainer.state_dict(),
+                              pt_path=os.path.join(weight_path, f'{model}-{i:04d}.pt'),
+                              jit_path=os.path.join(weight_path, f'{model}-{i:04d}.jit'),
+                              prepost_path=os.path.join(weight_path, f'{model}-prepost-{i:04d}.jit'))
 
         if i % eval_period == 0 and valid_list:
 
@@ -346,15 +453,14 @@ def run(mean=[0.485, 0.456, 0.406],
             net.eval()
 
             # loss 구하기
-            for (anchor, positive, negative, _, _, _) in valid_dataloader:
-                anchor = anchor.to(context)
-                positive = positive.to(context)
-                negative = negative.to(context)
+            for (anchor, positive, negative, anchor_path, positive_path, negative_path) in valid_dataloader:
+                anchor = anchor.to(context, memory_format=memory_format)
+                positive = positive.to(context, memory_format=memory_format)
+                negative = negative.to(context, memory_format=memory_format)
 
                 with torch.no_grad():
-                    anchor_pred = net(anchor)
-                    positive_pred = net(positive)
-                    negative_pred = net(negative)
+                    anchor_pred, positive_pred, negative_pred = triplet_embedding(valid_net, anchor, positive, negative,
+                                                                                  anchor_path, positive_path, negative_path)
 
                     ap_select = PDLoss(anchor_pred, positive_pred)
                     an_select = PDLoss(anchor_pred, negative_pred)
@@ -379,6 +485,8 @@ def run(mean=[0.485, 0.456, 0.406],
                                           negative_pred[valid_triplets])
                     loss_sum += triplet_loss.item()
 
+            # process 마다 나눠 본 valid data 의 평균 (distributed 가 아니면 그대로)
+            loss_sum, = all_reduce_mean([loss_sum], device=context)
             valid_loss_mean = np.divide(loss_sum, valid_update_number_per_epoch)
             logging.info(
                 f"valid loss : {valid_loss_mean}")
@@ -388,15 +496,14 @@ def run(mean=[0.485, 0.456, 0.406],
                 batch_image = []
                 dataloader_iter = iter(valid_dataloader)
                 anchor, positive, negative, anchor_path, positive_path, negative_path = next(dataloader_iter)
-                anchor = anchor.to(context)
-                positive = positive.to(context)
-                negative = negative.to(context)
+                anchor = anchor.to(context, memory_format=memory_format)
+                positive = positive.to(context, memory_format=memory_format)
+                negative = negative.to(context, memory_format=memory_format)
 
                 with torch.no_grad():
 
-                    anchor_pred = net(anchor)
-                    positive_pred = net(positive)
-                    negative_pred = net(negative)
+                    anchor_pred, positive_pred, negative_pred = triplet_embedding(valid_net, anchor, positive, negative,
+                                                                                  anchor_path, positive_path, negative_path)
 
                     distance_of_ap_pred = torch.nn.functional.pairwise_distance(anchor_pred, positive_pred, p=2.0)
                     distance_of_an_pred = torch.nn.functional.pairwise_distance(anchor_pred, negative_pred, p=2.0)
@@ -443,25 +550,30 @@ def run(mean=[0.485, 0.456, 0.406],
                         batch_image.append(hconcat_images)  # (batch, channel, height, width)
 
                     img_grid = torchvision.utils.make_grid(torch.as_tensor(batch_image), nrow=1)
-                    summary.add_image(tag="valid_result", img_tensor=img_grid, global_step=i)
+                    logger.add_image(tag="valid_result", img_tensor=img_grid, global_step=i)
+
+                    logger.add_scalar(tag="loss/train_loss_mean",
+                                      scalar_value=train_loss_mean,
+                                      global_step=i)
+                    logger.add_scalar(tag="loss/valid_loss_mean",
+                                      scalar_value=valid_loss_mean,
+                                      global_step=i)
 
-                    summary.add_scalar(tag="loss/train_loss_mean",
-                                       scalar_value=train_loss_mean,
-                                       global_step=i)
-                    summary.add_scalar(tag="loss/valid_loss_mean",
-                                       scalar_value=valid_loss_mean,
-                                       global_step=i)
+                    for name, param in module.named_parameters():
+                        logger.add_histogram(tag=name, values=param, global_step=i)
 
-                    for name, param in net.named_parameters():
-                        summary.add_histogram(tag=name, values=param, global_step=i)
+    if hard_negative_mining and main_process:
+        miner.close()
 
     end_time = time.time()
     learning_time = end_time - start_time
     logging.info(f"learning time : 약, {learning_time / 3600:0.2f}H")
     logging.info("optimization completed")
 
-    if using_mlflow:
-        ml.log_metric("learning time", round(learning_time / 3600, 2))
+    logger.log_metric("learning time", round(learning_time / 3600, 2))
+    if main_process:
+        checkpointer.close()
+    logger.close()
 
 
 if __name__ == "__main__":
@@ -473,10 +585,13 @@ if __name__ == "__main__":
         batch_size=16,
         batch_log=100,
         subdivision=4,
+        precision="fp32",
+        channels_last=False,
         train_dataset_path="Dataset/train",
         valid_dataset_path="Dataset/valid",
         data_augmentation=True,
         num_workers=4,
+        prefetch_factor=2,
         optimizer="ADAM",
         save_period=5,
         load_period=10,
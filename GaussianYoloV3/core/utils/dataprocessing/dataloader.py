@@ -1,8 +1,11 @@
+import math
 import random
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Dataset, Sampler
+from torch.utils.data.distributed import DistributedSampler
 
 from core.utils.dataprocessing.dataset import DetectionDataset
 from core.utils.dataprocessing.transformer import YoloTrainTransform, YoloValidTransform
@@ -10,11 +13,12 @@ from core.utils.dataprocessing.transformer import YoloTrainTransform, YoloValidT
 
 class Tuple_train(object):
 
-    def __init__(self, fn, *args, dataset = None, interval = 10, train_transform=None):
+    '''
+    MultiScaleBatchSampler 와 함께 사용
+    각 sample 의 마지막 요소가 sampler 가 정해준 scale(train_transform 의 index) 이고, batch 안의 scale 은 모두 같다.
+    '''
+    def __init__(self, fn, *args, train_transform=None):
 
-        self._counter = 0
-        self._dataset = dataset
-        self._interval = interval
         self._train_transform = train_transform
         if isinstance(fn, (list, tuple)):
             assert len(args) == 0, 'Input pattern not understood. The input of Tuple can be ' \
@@ -29,12 +33,8 @@ class Tuple_train(object):
 
     def __call__(self, data):
 
-        self._counter+=1
-        if self._interval == self._counter:
-            train_transform = random.choice(self._train_transform)
-        else:
-            train_transform = self._train_transform[-1] # 원본사이즈 transform을 마지막 리스트의 요소로 놓기
-        data_transform =[train_transform(*ele) for ele in data]
+        train_transform = self._train_transform[data[0][-1]]
+        data_transform =[train_transform(*ele[:-1]) for ele in data]
 
         assert len(data_transform[0]) == len(self._fn), \
             'The number of attributes in each data sample should contains' \
@@ -43,11 +43,96 @@ class Tuple_train(object):
         for i, ele_fn in enumerate(self._fn):
             ret.append(ele_fn([ele[i] for ele in data_transform]))
 
-        if self._counter >= len(self._dataset) // len(data):
-            self._counter = 0
-
         return ret
 
+class ScaleDataset(Dataset):
+
+    '''
+    MultiScaleBatchSampler 가 넘겨주는 (index, scale) 을 받아서, sample 뒤에 scale 을 붙여 collate 로 넘긴다.
+    '''
+    def __init__(self, dataset):
+        super(ScaleDataset, self).__init__()
+        self._dataset = dataset
+
+    def __getitem__(self, idx):
+        index, scale = idx
+        return tuple(self._dataset[index]) + (scale,)
+
+    def __len__(self):
+        return len(self._dataset)
+
+class MultiScaleBatchSampler(Sampler):
+
+    '''
+    batch 마다 input scale 을 정해서 [(index, scale), ...] 을 넘겨주는 batch sampler
+    scale 을 main process 의 sampler 가 정하기 때문에, worker 가 여러 개여도 batch 별 scale 이 어긋나지 않는다.
+
+    interval : interval 개의 batch 마다 scale 을 새로 뽑는다.
+    progressive_epoch : 0 보다 크면, progressive_epoch 까지 작은 scale 부터 뽑을 수 있는 scale 의 범위를 점점 늘린다.
+    (scale 은 train_transform 의 index 이고, 작은 scale 부터 정렬되어 있어야 한다.)
+    같은 seed, epoch 이면 같은 (index, scale) 순서가 나온다.
+    num_replicas, rank : distributed 학습에서 DistributedSampler 처럼 index 를 process 수로 나눠서 rank 번째 몫만 내보낸다.
+    모든 process 가 같은 seed 로 같은 순서를 만들고 나누므로 scale 도 batch 마다 process 끼리 같다.
+    '''
+    def __init__(self, data_source, batch_size=8, num_scale=1, interval=10, shuffle=True, drop_last=False,
+                 progressive_epoch=0, seed=None, num_replicas=1, rank=0):
+        super(MultiScaleBatchSampler, self).__init__()
+
+        self._data_source = data_source
+        self._batch_size = batch_size
+        self._num_scale = num_scale
+        self._interval = max(interval, 1)
+        self._shuffle = shuffle
+        self._drop_last = drop_last
+        self._progressive_epoch = progressive_epoch
+        self._num_replicas = num_replicas
+        self._rank = rank
+        # process 마다 initial_seed 가 다르므로, 나눠 볼 때는 DistributedSampler 처럼 0 으로 맞춘다.
+        if seed is None:
+            seed = torch.initial_seed() % 2 ** 32 if num_replicas == 1 else 0
+        self._seed = seed
+        self._num_samples = math.ceil(len(data_source) / num_replicas)  # process 하나의 몫
+        self._epoch = 1
+
+    def set_epoch(self, epoch):
+        # 1 부터 시작하는 학습 epoch
+        self._epoch = epoch
+
+    def _available_scale(self):
+        if self._progressive_epoch > 0:
+            return min(max(math.ceil(self._num_scale * self._epoch / self._progressive_epoch), 1), self._num_scale)
+        else:
+            return self._num_scale
+
+    def __iter__(self):
+
+        generator = torch.Generator()
+        generator.manual_seed(self._seed + self._epoch)
+
+        length = len(self._data_source)
+        if self._shuffle:
+            indices = torch.randperm(length, generator=generator).tolist()
+        else:
+            indices = list(range(length))
+
+        if self._num_replicas > 1:
+            # 앞에서부터 다시 채워서 process 수로 나누어 떨어지게 한다.
+            total_size = self._num_samples * self._num_replicas
+            indices += (indices * math.ceil(total_size / length))[:total_size - length]
+            indices = indices[self._rank:total_size:self._num_replicas]
+
+        available_scale = self._available_scale()
+        for i, begin in enumerate(range(0, len(self) * self._batch_size, self._batch_size)):
+            if i % self._interval == 0:
+                scale = int(torch.randint(available_scale, (1,), generator=generator))
+            yield [(index, scale) for index in indices[begin:begin + self._batch_size]]
+
+    def __len__(self):
+        if self._drop_last:
+            return self._num_samples // self._batch_size
+        else:
+            return math.ceil(self._num_samples / self._batch_size)
+
 class Tuple_valid(object):
 
     def __init__(self, fn, *args):
@@ -117,8 +202,17 @@ class Pad(object):
 
 class Stack(object):
 
+    '''
+    channels_last=True 이면 (C, H, W) image 들을 (H, W, C) 로 보고 쌓아서, channels_last 인 (N, C, H, W) 를 돌려준다.
+    쌓을 때 한번만 복사하므로 쌓은 뒤에 memory format 을 바꾸는 것보다 복사가 한번 적다.
+    '''
+    def __init__(self, channels_last=False):
+        self._channels_last = channels_last
+
     def __call__(self, batch):
         if isinstance(batch[0], torch.Tensor):
+            if self._channels_last and batch[0].dim() == 3:
+                return torch.stack([ele.permute(1, 2, 0) for ele in batch], dim=0).permute(0, 3, 1, 2)
             return torch.stack(batch, dim=0)
         elif isinstance(batch[0], str):  # str
             return batch
@@ -126,69 +220,105 @@ class Stack(object):
             out = np.asarray(batch)
             return torch.as_tensor(out)
 
-def traindataloader(multiscale=False, factor_scale=[10, 9], augmentation=True, path="Dataset/train",
-                    input_size=(512, 512), input_frame_number=2, batch_size=8, pin_memory=True, batch_interval=10, num_workers=4, shuffle=True,
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
+def _worker_init_fn(worker_id):
+
+    '''
+    worker 마다 numpy / random 의 seed 를 다르게 설정
+    설정하지 않으면 fork 된 worker 들이 같은 numpy 상태를 물려받아, 같은 augmentation 을 만들게 된다.
+    torch.initial_seed() 는 worker 마다 (base_seed + worker_id) 이고, base_seed 는 iterator 를 만들 때마다 바뀐다.
+    '''
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def _worker_options(num_workers, prefetch_factor, persistent_workers):
+
+    # num_workers=0 일 때는 prefetch_factor, persistent_workers 를 넘기면 안된다.
+    if num_workers > 0:
+        return dict(worker_init_fn=_worker_init_fn,
+                    prefetch_factor=prefetch_factor,
+                    persistent_workers=persistent_workers)
+    else:
+        return dict()
 
-    num_workers = 0 if pin_memory else num_workers
+
+def traindataloader(multiscale=False, factor_scale=[10, 9], augmentation=True, path="Dataset/train",
+                    input_size=(512, 512), input_frame_number=2, batch_size=8, pin_memory=True, batch_interval=10, num_workers=4, prefetch_factor=2, persistent_workers=True, shuffle=True,
+                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], progressive_epoch=0, make_target=False,
+                    anchors={"shallow": [(10, 13), (16, 30), (33, 23)],
+                             "middle": [(30, 61), (62, 45), (59, 119)],
+                             "deep": [(116, 90), (156, 198), (373, 326)]},
+                    ignore_threshold=0.5, distributed=False, channels_last=False):
 
     dataset = DetectionDataset(path=path, sequence_number=input_frame_number, test=False)
 
     if multiscale:
         init = factor_scale[0]
         end = init + factor_scale[1] + 1
-        train_transform = [YoloTrainTransform(x * 32, x * 32, input_frame_number=input_frame_number, mean=mean, std=std, augmentation = augmentation) for x in range(init, end)]
+        train_transform = [YoloTrainTransform(x * 32, x * 32, input_frame_number=input_frame_number, mean=mean, std=std, augmentation = augmentation,
+                                              make_target=make_target, anchors=anchors, ignore_threshold=ignore_threshold) for x in range(init, end)]
     else:
         train_transform = [YoloTrainTransform(input_size[0], input_size[1],
                                               input_frame_number = input_frame_number,
                                               mean=mean, std=std,
-                                              augmentation=augmentation)]
+                                              augmentation=augmentation,
+                                              make_target=make_target, anchors=anchors, ignore_threshold=ignore_threshold)]
 
-    dataloader = DataLoader(
-        dataset,
-        batch_size=batch_size,
-        shuffle=shuffle,
-        collate_fn=Tuple_train(Stack(),
-                         Pad(pad_val=-1),
-                         Stack(),
+    if make_target:
+        # image, label, xcyc_target, wh_target, objectness, class_target, weights, name
+        batchify_fn = [Stack(channels_last=channels_last), Pad(pad_val=-1), Stack(), Stack(), Stack(), Stack(), Stack(), Stack()]
+    else:
+        batchify_fn = [Stack(channels_last=channels_last), Pad(pad_val=-1), Stack()]
+
+    # multiscale 의 scale 은 sampler 가 batch 마다 정한다.
+    batch_sampler = MultiScaleBatchSampler(dataset,
+                                           batch_size=batch_size,
+                                           num_scale=len(train_transform),
+                                           interval=batch_interval,
+                                           shuffle=shuffle,
+                                           drop_last=False,
+                                           progressive_epoch=progressive_epoch,
+                                           num_replicas=dist.get_world_size() if distributed else 1,
+                                           rank=dist.get_rank() if distributed else 0)
 
-                         # multiscale을 위한 구현
-                         dataset = dataset,
-                         interval = batch_interval,
-                         train_transform = train_transform),
-        drop_last=False,
+    dataloader = DataLoader(
+        ScaleDataset(dataset),
+        batch_sampler=batch_sampler,
+        collate_fn=Tuple_train(batchify_fn, train_transform=train_transform),
         pin_memory=pin_memory,
-        num_workers=num_workers)
+        num_workers=num_workers,
+        **_worker_options(num_workers, prefetch_factor, persistent_workers))
 
     return dataloader, dataset
 
 def validdataloader(path="Dataset/valid",
-                    input_size=(512, 512), input_frame_number=2, batch_size=8, pin_memory=True, num_workers=4, shuffle=True,
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
-
-    num_workers = 0 if pin_memory else num_workers
+                    input_size=(512, 512), input_frame_number=2, batch_size=8, pin_memory=True, num_workers=4, prefetch_factor=2, persistent_workers=True, shuffle=True,
+                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], distributed=False, channels_last=False):
 
     transform = YoloValidTransform(input_size[0], input_size[1], input_frame_number, mean=mean, std=std)
     dataset = DetectionDataset(path=path, transform=transform, sequence_number=input_frame_number, test=False)
 
+    # distributed 이면 process 마다 valid dataset 을 나눠서 본다. - mAP 는 Voc_2007_AP.synchronize 로 모은다.
+    sampler = DistributedSampler(dataset, shuffle=shuffle) if distributed else None
+
     dataloader = DataLoader(
         dataset,
         batch_size=batch_size,
-        shuffle=shuffle,
-        collate_fn=Tuple_valid(Stack(),
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
+        collate_fn=Tuple_valid(Stack(channels_last=channels_last),
                          Pad(pad_val=-1),
                          Stack()),
         drop_last=False,
         pin_memory=pin_memory,
         num_workers=num_workers,
-    )
+        **_worker_options(num_workers, prefetch_factor, persistent_workers))
 
     return dataloader, dataset
 
 def testdataloader(path="Dataset/test", input_size=(512, 512), input_frame_number=2, pin_memory=True,
-                   num_workers=4, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
-
-    num_workers = 0 if pin_memory else num_workers
+                   num_workers=4, prefetch_factor=2, persistent_workers=True, mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]):
 
     transform = YoloValidTransform(input_size[0], input_size[1], input_frame_number=input_frame_number, mean=mean, std=std)
     dataset = DetectionDataset(path=path, transform=transform, sequence_number=input_frame_number, test=True)
@@ -202,7 +332,8 @@ def testdataloader(path="Dataset/test", input_size=(512, 512), input_frame_numbe
                          Stack(),
                          Pad(pad_val=-1)),
         pin_memory=pin_memory,
-        num_workers=num_workers)
+        num_workers=num_workers,
+        **_worker_options(num_workers, prefetch_factor, persistent_workers))
     return dataloader, dataset
 
 
@@ -228,3 +359,24 @@ if __name__ == "__main__":
     print(f"label shape : {label.shape}")
     print(f"name : {name}")
 
+    # smoke test - Dataset/train 으로 traindataloader 를 만들고 batch 하나를 꺼낸다. (multiscale, make_target, worker 포함)
+    for multiscale, make_target in [(False, False), (True, True)]:
+        dataloader, dataset = traindataloader(multiscale=multiscale, make_target=make_target,
+                                              path=os.path.join(root, 'Dataset', 'train'), input_size=(416, 416),
+                                              input_frame_number=1, batch_size=4, pin_memory=False, num_workers=2)
+        batch = next(iter(dataloader))
+        print(f"< multiscale : {multiscale}, make_target : {make_target}, image shape : {batch[0].shape}, label shape : {batch[1].shape} >")
+
+    # num_workers 에 따른 처리량 비교 - Dataset/train
+    import time
+
+    for workers in [0, 4]:
+        dataloader, dataset = traindataloader(path=os.path.join(root, 'Dataset', 'train'), input_size=(416, 416),
+                                              input_frame_number=1, batch_size=8, pin_memory=True,
+                                              num_workers=workers, augmentation=True)
+        # persistent_workers=True 이면 두번째 epoch 부터는 worker 를 다시 만들지 않는다.
+        for epoch in range(2):
+            begin = time.time()
+            for _ in dataloader:
+                pass
+            print(f"num_workers : {workers}, epoch : {epoch}, {len(dataset) / (time.time() - begin):0.2f} images/s")
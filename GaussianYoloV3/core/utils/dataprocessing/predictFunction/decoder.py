@@ -1,3 +1,5 @@
+from typing import List
+
 import torch
 from torch.nn import Module
 
@@ -11,24 +13,27 @@ class Decoder(Module):
         self._thresh = thresh
         self._multiperclass = multiperclass
 
-    def forward(self, output, anchor, offset, stride):
+    def _decode(self, out, anchor, offset, stride):
 
-        # 자르기
-        batch_size, h, w, ac = output.shape
-        out = output.reshape((batch_size, h*w, -1, self._num_pred)) # (b, 169, 3, 14)
+        '''
+        out 의 마지막 축(num_pred)만 사용하고 나머지 축은 broadcasting 으로 처리
+        dense : out (b, 169, 3, 14) / offset (1, 169, 1, 2) / anchor (1, 1, 3, 2) / stride (1, 1, 1, 2)
+        sparse : out (b, N, 14) / offset, anchor, stride (1, N, 2)
+        :return: bbox (..., 4), class_pred (..., num_classes)
+        '''
 
-        xc_mean_pred = out[:, :, :, 0:1]
-        xc_var_pred = out[:, :, :, 1:2]
-        yc_mean_pred = out[:, :, :, 2:3]
-        yc_var_pred = out[:, :, :, 3:4]
+        xc_mean_pred = out[..., 0:1]
+        xc_var_pred = out[..., 1:2]
+        yc_mean_pred = out[..., 2:3]
+        yc_var_pred = out[..., 3:4]
 
-        w_mean_pred = out[:, :, :, 4:5]
-        w_var_pred = out[:, :, :, 5:6]
+        w_mean_pred = out[..., 4:5]
+        w_var_pred = out[..., 5:6]
 
-        h_mean_pred = out[:, :, :, 6:7]
-        h_var_pred = out[:, :, :, 7:8]
-        objectness = out[:, :, :, 8:9]
-        class_pred = out[:, :, :, 9:]
+        h_mean_pred = out[..., 6:7]
+        h_var_pred = out[..., 7:8]
+        objectness = out[..., 8:9]
+        class_pred = out[..., 9:]
 
         if not self._from_sigmoid:
             xc_mean_pred = torch.sigmoid(xc_mean_pred)
@@ -45,27 +50,84 @@ class Decoder(Module):
         xy_pred = torch.cat([xc_mean_pred, yc_mean_pred], dim=-1)
         wh_pred = torch.cat([w_mean_pred, h_mean_pred], dim=-1)
 
-        # 복구하기
-        '''
-        offset이 output에 따라 변하는 값이기 때문에, 
-        네트워크에서 출력할 때 충분히 크게 만들면,
-        c++에서 inference 할 때 어떤 값을 넣어도 정상적으로 동작하게 된다. 
-        '''
-        offset = offset[:, :w, :h, :, :]
-        offset = offset.reshape((1, -1, 1, 2))
-
         xy_preds = torch.mul(torch.add(xy_pred, offset), stride)
         wh_preds = torch.mul(torch.exp(wh_pred), anchor)
 
         # gaussian yolov3 uncertainty
         var_coordinates = torch.cat([xc_var_pred, yc_var_pred, w_val_pred, h_var_pred], dim=-1)
         uncertainty = torch.mean(var_coordinates, dim=-1, keepdim=True)
-        class_pred = torch.mul(class_pred, objectness)  # (b, 169, 3, 5)
+        class_pred = torch.mul(class_pred, objectness)
         class_pred = torch.mul(class_pred, (1.0 - uncertainty))
 
         # center to corner
         wh = torch.true_divide(wh_preds, 2.0)
-        bbox = torch.cat([xy_preds - wh, xy_preds + wh], dim=-1)  # (b, 169, 3, 4)
+        bbox = torch.cat([xy_preds - wh, xy_preds + wh], dim=-1)
+        return bbox, class_pred
+
+    def _topk(self, score, topk: int):
+
+        # ex) thresh=0.01 이상인것만 뽑기
+        score = torch.where(score > self._thresh, score, torch.zeros_like(score))
+        return torch.topk(score, min(topk, score.shape[1]), dim=1, largest=True, sorted=True)
+
+    def sparse(self, outputs: List[torch.Tensor], anchors: List[torch.Tensor], offsets: List[torch.Tensor],
+               strides: List[torch.Tensor], topk: int):
+
+        '''
+        3개의 level 을 한번에 decoding 한 후, thresh 이상인 (class x objectness) score 중 상위 topk 개만 뽑기
+        multiperclass=True 일 때도 box 를 num_classes 만큼 복사하지 않고, 뽑힌 candidate 의 box 만 gather 한다.
+        :return: (b, topk, 6) - id, score, bbox / thresh 미만은 id -1, score 0
+        '''
+
+        # level 별 grid / anchor / stride 를 (1, N, 2) 하나의 table 로 펼치기
+        preds = []
+        offset_table = []
+        anchor_table = []
+        stride_table = []
+        for out, an, off, st in zip(outputs, anchors, offsets, strides):
+            batch_size, h, w, _ = out.shape
+            num_anchor = an.shape[2]
+            preds.append(out.reshape((batch_size, h * w * num_anchor, self._num_pred)))
+            offset_table.append(off[:, :w, :h, :, :].expand(-1, -1, -1, num_anchor, -1).reshape((1, -1, 2)))
+            anchor_table.append(an.expand(-1, h * w, -1, -1).reshape((1, -1, 2)))
+            stride_table.append(st.expand(-1, h * w, num_anchor, -1).reshape((1, -1, 2)))
+
+        bbox, class_pred = self._decode(torch.cat(preds, dim=1), torch.cat(anchor_table, dim=1),
+                                        torch.cat(offset_table, dim=1), torch.cat(stride_table, dim=1))  # (b, N, 4), (b, N, 5)
+        batch_size = bbox.shape[0]
+
+        if self._multiperclass:
+            score, index = self._topk(class_pred.reshape((batch_size, -1)), topk)  # (b, N*5) -> (b, topk)
+            box_index = index // self._num_classes
+            id = index % self._num_classes
+        else:
+            score, id = torch.max(class_pred, dim=-1)  # (b, N)
+            score, index = self._topk(score, topk)
+            box_index = index
+            id = torch.gather(id, 1, index)
+
+        id = id.to(score.dtype)
+        id = torch.where(score > self._thresh, id, torch.ones_like(id) * -1)
+        bbox = torch.gather(bbox, 1, box_index.unsqueeze(dim=-1).repeat(1, 1, 4))
+
+        return torch.cat([id.unsqueeze(dim=-1), score.unsqueeze(dim=-1), bbox], dim=-1)  # (b, topk, 6)
+
+    def forward(self, output, anchor, offset, stride):
+
+        # 자르기
+        batch_size, h, w, ac = output.shape
+        out = output.reshape((batch_size, h*w, -1, self._num_pred)) # (b, 169, 3, 14)
+
+        # 복구하기
+        '''
+        offset이 output에 따라 변하는 값이기 때문에, 
+        네트워크에서 출력할 때 충분히 크게 만들면,
+        c++에서 inference 할 때 어떤 값을 넣어도 정상적으로 동작하게 된다. 
+        '''
+        offset = offset[:, :w, :h, :, :]
+        offset = offset.reshape((1, -1, 1, 2))
+
+        bbox, class_pred = self._decode(out, anchor, offset, stride)  # (b, 169, 3, 4), (b, 169, 3, 5)
 
         # prediction per class
         if self._multiperclass:
@@ -150,3 +212,14 @@ if __name__ == "__main__":
     multiperclass=False 일 때 
     decoder shape : torch.Size([1, 10647, 6])
     '''
+
+    # sparse 모드와 dense 결과의 상위 200개 score 비교
+    decoder = Decoder(from_sigmoid=False, num_classes=num_classes, thresh=0.01, multiperclass=True)
+    dense = torch.cat([decoder(out, an, off, st) for out, an, off, st in
+                       zip([output1, output2, output3], [anchor1, anchor2, anchor3], [offset1, offset2, offset3],
+                           [stride1, stride2, stride3])], dim=1)
+    dense_score, _ = torch.topk(dense[:, :, 1], 200, dim=1)
+    sparse = decoder.sparse([output1, output2, output3], [anchor1, anchor2, anchor3], [offset1, offset2, offset3],
+                            [stride1, stride2, stride3], 200)
+    print(f"sparse shape : {sparse.shape}")
+    print(f"sparse score == dense topk score : {torch.allclose(sparse[:, :, 1], dense_score)}")
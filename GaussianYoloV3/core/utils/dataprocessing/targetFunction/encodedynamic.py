@@ -1,7 +1,7 @@
-import numpy as np
 import torch
 from torch.nn import Module
 
+from core.utils.dataprocessing.targetFunction.encoderfix import Encoderfix
 from core.utils.dataprocessing.targetFunction.matching import Matcher
 
 
@@ -54,119 +54,46 @@ class BBoxBatchIOU(Module):
         union = torch.add(area_a, area_b) - i
         return torch.true_divide(i, union)
 
-class BBoxCornerToCenter(Module):
-    def __init__(self, axis=-1):
-        super(BBoxCornerToCenter, self).__init__()
-        self._axis = axis
-
-    def forward(self, x):
-        xmin, ymin, xmax, ymax = torch.split(x, 1, dim=self._axis)
-        width = xmax - xmin
-        height = ymax - ymin
-        x_center = torch.true_divide(xmin + width, 2)
-        y_center = torch.true_divide(ymin + height, 2)
-        return x_center, y_center, width, height
-
 class Encoderdynamic(Module):
 
-    def __init__(self, ignore_threshold=0.7, from_sigmoid=False):
+    def __init__(self, ignore_threshold=0.7, from_sigmoid=False, memory_budget=256):
         super(Encoderdynamic, self).__init__()
-        self._cornertocenter = BBoxCornerToCenter(axis=-1)
         self._batch_iou = BBoxBatchIOU(axis=-1)
         self._from_sigmoid = from_sigmoid
         self._ignore_threshold = ignore_threshold
+        '''
+        memory_budget : (batch, prediction 수, object 수) 형태의 iou 계산에 쓸 최대 메모리(MB)
+        prediction 을 나누어서 계산하기 때문에 object 가 많아도 메모리가 일정 크기를 넘지 않는다.
+        None 또는 0 이하면 나누지 않고 한번에 계산한다.
+        '''
+        self._memory_budget = memory_budget
+        # anchor 와 비교하는 ignore 는 하지 않는다. -> positive target 만 만든다.
+        self._encoder = Encoderfix(ignore_threshold=float("inf"))
 
     def forward(self, matches, ious, outputs, anchors, gt_boxes, gt_ids, input_size):
 
         in_height = input_size[0]
         in_width = input_size[1]
-        feature_size = []
-        anchor_size = []
         strides = []
 
-        for i, out, anchor in zip(range(len(outputs)), outputs, anchors):
+        for out, anchor in zip(outputs, anchors):
             _, h, w, ac = out.shape
             _, _, a, _ = anchor.shape
-            feature_size.append([h, w])
-            anchor_size.append(a)
-            stride = np.reshape([in_width // w, in_height // h], (1, 1, 1, 2))
-            strides.append(stride)
-
-        self._num_pred = np.divide(ac, a).astype(int)
-        all_anchors = torch.cat([anchor.reshape(-1, 2) for anchor in anchors], dim=0)
-        num_anchors = np.cumsum(anchor_size)  # ex) (3, 6, 9)
-        num_offsets = np.cumsum([np.prod(feature) for feature in feature_size])  # ex) (338, 1690, 3549)
-        offsets = [0] + num_offsets.tolist()
-
-        # target 공간 만들어 놓기
-        xcyc_targets = torch.zeros(gt_boxes.shape[0],
-                                   num_offsets[-1],
-                                   num_anchors[-1], 2,
-                                   device=gt_boxes.device,
-                                   dtype=gt_boxes.dtype)  # (batch, 3549, 9, 2)가 기본 요소
-        wh_targets = torch.zeros_like(xcyc_targets)
-        weights = torch.zeros_like(xcyc_targets)
-        objectness = torch.zeros_like(xcyc_targets.split(1, dim=-1)[0])
-        class_targets = torch.zeros_like(objectness)
-
-        all_gtx, all_gty, all_gtw, all_gth = self._cornertocenter(gt_boxes)
-
-        np_gtx, np_gty, np_gtw, np_gth = [x.cpu().numpy().copy() for x in [all_gtx, all_gty, all_gtw, all_gth]]
-        np_anchors = all_anchors.cpu().numpy().copy().astype(float)
-        np_gt_ids = gt_ids.cpu().numpy().copy().astype(int)
-
-        # 가장 큰것에 할당하고, target network prediction 비교해서 0.7 이상인것들 무시하기
-        batch, anchorN, objectN = ious.shape
-        for b in range(batch):
-            for a in range(anchorN):
-                for o in range(objectN):
-                    nlayer = np.where(num_anchors > a)[0][0]
-                    out_height = outputs[nlayer].shape[1]
-                    out_width = outputs[nlayer].shape[2]
-
-                    gtx, gty, gtw, gth = (np_gtx[b, o, 0], np_gty[b, o, 0],
-                                          np_gtw[b, o, 0], np_gth[b, o, 0])
-                    ''' 
-                        matching 단계에서 image만 들어온 데이터들도 matching이 되기때문에 아래와 같이 걸러줘야 한다.
-                        image만 들어온 데이터 or padding 된것들은 noobject이다. 
-                    '''
-                    if gtx == -1.0 and gty == -1.0 and gtw == 0.0 and gth == 0.0:
-                        continue
-                    # compute the location of the gt centers
-                    loc_x = int(gtx / in_width * out_width)
-                    loc_y = int(gty / in_height * out_height)
-                    # write back to targets
-                    index = offsets[nlayer] + loc_y * out_width + loc_x
-                    if a == matches[b, o]:  # 최대인 값은 제외
-                        xcyc_targets[b, index, a, 0] = gtx / in_width * out_width - loc_x
-                        xcyc_targets[b, index, a, 1] = gty / in_height * out_height - loc_y
-                        '''
-                        if gtx == -1.0 and gty == -1.0 and gtw == 0.0 and gth == 0.0: 
-                            continue
-                        에서 처리를 해주었으나, 그래도 한번 더 대비 해놓자.
-                        '''
-                        wh_targets[b, index, a, 0] = np.log(
-                            max(gtw, 1) / np_anchors[a, 0])  # max(gtw,1)? gtw,gth가 0일경우가 있다.
-                        wh_targets[b, index, a, 1] = np.log(max(gth, 1) / np_anchors[a, 1])
-                        weights[b, index, a, :] = 2.0 - gtw * gth / in_width / in_height
-                        objectness[b, index, a, 0] = 1
-                        class_targets[b, index, a, 0] = np_gt_ids[b, o, 0]
-
-        xcyc_targets = self._slice(xcyc_targets, num_anchors, num_offsets)
-        wh_targets = self._slice(wh_targets, num_anchors, num_offsets)
-        weights = self._slice(weights, num_anchors, num_offsets)
-        objectness = self._slice(objectness, num_anchors, num_offsets)
-        class_targets = self._slice(class_targets, num_anchors, num_offsets)
-        class_targets = class_targets.squeeze(-1)
-
-        # dynamic
-        box_preds = []
-        for out, an, st in zip(outputs, anchors, strides):
-            box_preds.append(self._boxdecoder(out, an, st))
-        box_preds = torch.cat(box_preds, dim=1)
-        batch_ious = self._batch_iou(box_preds, gt_boxes)  # (b, N, M)
-        ious_max, _ = batch_ious.max(dim=-1, keepdim=True)  # (b, N, 1)
-        objectness_dynamic = (ious_max > self._ignore_threshold) * -1.0  # ignore
+            strides.append((in_width // w, in_height // h))
+
+        self._num_pred = ac // a
+
+        xcyc_targets, wh_targets, objectness, class_targets, weights = self._encoder(matches, ious, outputs, anchors,
+                                                                                     gt_boxes, gt_ids, input_size)
+
+        # dynamic - target 을 만드는 과정이므로 gradient 가 필요없다.
+        with torch.no_grad():
+            box_preds = []
+            for out, an, st in zip(outputs, anchors, strides):
+                box_preds.append(self._boxdecoder(out, an, st))
+            box_preds = torch.cat(box_preds, dim=1)
+            ious_max = self._max_iou(box_preds, gt_boxes)  # (b, N, 1)
+            objectness_dynamic = (ious_max > self._ignore_threshold) * -1.0  # ignore
 
         # objectness 와 objectness_dynamic 조합하기
         objectness = torch.where(objectness > 0, objectness, objectness_dynamic)
@@ -178,26 +105,41 @@ class Encoderdynamic(Module):
 
         return xcyc_targets, wh_targets, objectness, class_targets, weights
 
-    def _slice(self, x, num_anchors, num_offsets):
-
-        anchors = [0] + num_anchors.tolist()
-        offsets = [0] + num_offsets.tolist()
-        ret = []
-        for i in range(len(num_anchors)):
-            y = x[:, offsets[i]:offsets[i + 1], anchors[i]:anchors[i + 1], :]
-            b, f, a, _ = y.shape
-            ret.append(y.reshape(b, f*a, -1))
-        return torch.cat(ret, dim=1)
+    def _max_iou(self, box_preds, gt_boxes):
+
+        '''
+        (b, N, M) iou 를 한번에 만들면 중간 결과물이 여러개 생기면서 메모리를 많이 쓴다.
+        prediction(N) 축을 memory_budget 에 맞게 나누어 계산하고 max 만 남긴다. - 결과는 한번에 계산한 것과 같다.
+        '''
+        batch, num_box, _ = box_preds.shape
+        num_object = gt_boxes.shape[1]
+        # object 가 하나도 없는 이미지들로만 이루어진 batch - 무시할 prediction 이 없다.
+        if num_object == 0:
+            return box_preds.new_zeros((batch, num_box, 1))
+        if self._memory_budget is None or self._memory_budget <= 0:
+            chunk = num_box
+        else:
+            # BBoxBatchIOU 에서 (b, N, M) 크기의 중간 결과가 최대 8개 정도 동시에 살아있다.
+            chunk = int(self._memory_budget * (1024 ** 2) // (batch * num_object * box_preds.element_size() * 8))
+            chunk = min(max(chunk, 1), num_box)
+
+        ious_max = []
+        for box_pred in torch.split(box_preds, chunk, dim=1):
+            batch_ious = self._batch_iou(box_pred, gt_boxes)  # (b, chunk, M)
+            ious_max.append(batch_ious.max(dim=-1, keepdim=True)[0])  # (b, chunk, 1)
+        return torch.cat(ious_max, dim=1)
 
     def _boxdecoder(self, output, anchor, stride):
 
         batch, height, width, _ = output.shape
-        stride = torch.as_tensor(stride, dtype=output.dtype, device=output.device)
-        # grid_x, grid_y = np.meshgrid(np.arange(width), np.arange(height))
-        grid_y, grid_x = np.mgrid[:height, :width]
-        offset = np.concatenate((grid_x[:, :, np.newaxis], grid_y[:, :, np.newaxis]), axis=-1)  # (13,13,2)
-        offset = np.reshape(offset, (1, -1, 1, 2))  # (1, 169, 1, 2)
-        offset = torch.as_tensor(offset, dtype=output.dtype, device=output.device)
+        # autocast(fp16, bf16) 로 학습해도 좌표는 fp32 로 - bf16 은 512 ~ 1024 사이의 간격이 4 pixel 이다.
+        if output.dtype in (torch.float16, torch.bfloat16):
+            output = output.float()
+        # host 에서 만들어 복사하지 않고 device 에서 바로 만들기
+        grid_x = torch.arange(width, dtype=output.dtype, device=output.device).reshape(1, -1).expand(height, width)
+        grid_y = torch.arange(height, dtype=output.dtype, device=output.device).reshape(-1, 1).expand(height, width)
+        offset = torch.stack([grid_x, grid_y], dim=-1)  # (13,13,2)
+        offset = offset.reshape(1, -1, 1, 2)  # (1, 169, 1, 2)
 
         # 자르기
         output = output.reshape((batch, height*width, -1, self._num_pred))  # (b, 169, 3, 10)
@@ -205,7 +147,8 @@ class Encoderdynamic(Module):
         wh_pred = output[:, :, : ,2:4] # (b, 169, 3, 2)
         if not self._from_sigmoid:
             xy_pred = torch.sigmoid(xy_pred)
-        xy_preds = torch.mul(torch.add(xy_pred, offset), stride)
+        xy_preds = torch.add(xy_pred, offset)
+        xy_preds = torch.cat([xy_preds[:, :, :, 0:1] * stride[0], xy_preds[:, :, :, 1:2] * stride[1]], dim=-1)
         wh_preds = torch.mul(torch.exp(wh_pred), anchor)
         # center to corner
         wh = torch.true_divide(wh_preds, 2.0)
@@ -260,6 +203,24 @@ if __name__ == "__main__":
     print(f"objectness shape : {objectness.shape}")
     print(f"class_targets shape : {class_targets.shape}")
     print(f"weights shape : {weights.shape}")
+
+    # memory_budget 에 따라 나누어 계산해도 결과는 같아야 한다.
+    chunk_encoder = Encoderdynamic(ignore_threshold=0.2, from_sigmoid=False, memory_budget=1e-3)
+    _, _, chunk_objectness, _, _ = chunk_encoder(matches, ious, [output1, output2, output3],
+                                                 [anchor1, anchor2, anchor3], gt_boxes.to(device),
+                                                 gt_ids.to(device),
+                                                 input_size)
+    print(f"chunked objectness identical : {torch.equal(objectness, chunk_objectness)}")
+
+    # object 가 없는 batch(gt_boxes : (b, 0, 4)) 도 나누는 방식과 상관없이 max iou 는 0 이어야 한다.
+    box_preds = torch.cat([encoder._boxdecoder(out, an, st) for out, an, st in
+                           zip([output1, output2, output3], [anchor1, anchor2, anchor3],
+                               [(input_size[1] // out.shape[2], input_size[0] // out.shape[1]) for out in
+                                [output1, output2, output3]])], dim=1)
+    empty_boxes = gt_boxes[:, :0].to(device)
+    empty_full = encoder._max_iou(box_preds, empty_boxes)
+    empty_chunk = chunk_encoder._max_iou(box_preds, empty_boxes)
+    print(f"empty gt max iou all zero : {bool((empty_full == 0).all()) and torch.equal(empty_full, empty_chunk)}")
     '''
     < input size(height, width) : (416, 416) >
     xcyc_targets shape : torch.Size([1, 10647, 2])
@@ -3,6 +3,7 @@ from collections import defaultdict
 
 import numpy as np
 import plotly.graph_objs as go
+import torch.distributed as dist
 
 COLOR = defaultdict(lambda: (0, 0, 0))
 COLOR[0] = (134, 229, 127)
@@ -167,6 +168,27 @@ class Voc_base_PR(object):
                     else:  # false_positive
                         self._match[i].append(0)
 
+    def synchronize(self):
+
+        '''
+        distributed 학습이면 process 마다 자기 몫의 valid data 로 쌓은 positive 수 / score / match 를 모든 process 에 모은다.
+        score 순서로 다시 정렬해야 AP 가 나오므로 합계만 all-reduce 해서는 안 되고 전부 모아야 한다.
+        get_PR_list 전에 모든 process 가 불러야 한다. - process group 이 없으면 아무것도 하지 않는다.
+        '''
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+
+        states = [None] * dist.get_world_size()
+        dist.all_gather_object(states, (dict(self._positive_number), dict(self._score), dict(self._match)))
+        self.reset()
+        for positive_number, score, match in states:
+            for i, number in positive_number.items():
+                self._positive_number[i] += number
+            for i, value in score.items():
+                self._score[i].extend(value)
+            for i, value in match.items():
+                self._match[i].extend(value)
+
     def get_PR_list(self):
 
         class_name = [f"{self._class_names[i]}" for i in range(self._class_number)]
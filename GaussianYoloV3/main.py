@@ -4,8 +4,11 @@ anchor를 전 feature map에 다 만드는 것이 아니라
 gt가 있는 곳에만 만듦 -> 이게 ssd와 retinanet 과의 엄청난 차이
 '''
 
+import logging
+
 import mlflow as ml
 import torch
+import torch.distributed as dist
 import yaml
 
 import test
@@ -63,12 +66,19 @@ batch_log = parser["batch_log"]
 batch_size = parser["batch_size"]
 batch_interval = parser["batch_interval"]
 subdivision = parser["subdivision"]
+precision = parser["precision"]
+channels_last = parser["channels_last"]
+checkpoint_stages = parser["checkpoint_stages"]
 multiscale = parser["multiscale"]
 factor_scale = parser["factor_scale"]
+progressive_epoch = parser["progressive_epoch"]
 ignore_threshold = parser["ignore_threshold"]
 dynamic = parser["dynamic"]
+dynamic_memory_budget = parser["dynamic_memory_budget"]
+fused_loss = parser["fused_loss"]
 data_augmentation = parser["data_augmentation"]
 num_workers = parser["num_workers"]
+prefetch_factor = parser["prefetch_factor"]
 optimizer = parser["optimizer"]
 learning_rate = parser["learning_rate"]
 weight_decay = parser["weight_decay"]
@@ -78,6 +88,10 @@ decay_step = parser["decay_step"]
 # gpu vs cpu
 parser = stream['context']
 using_cuda = parser["using_cuda"]
+distributed = parser["distributed"]
+world_size = parser["world_size"]
+backend = parser["backend"]
+init_method = parser["init_method"]
 
 parser = stream['validation']
 valid_size = parser["valid_size"]
@@ -95,6 +109,31 @@ if torch.cuda.device_count() > 0 and using_cuda:
 else:
     GPU_COUNT = 0
 
+
+def distributed_run(rank, world_size, backend, init_method, run_id, kwargs):
+
+    '''
+    distributed 모드에서 torch.multiprocessing.spawn 이 process 마다 부르는 함수 - rank 는 spawn 이 0 부터 넘겨준다.
+    process group 을 만들고 train.run 을 부르면, train.run 은 DataParallel 대신 DistributedDataParallel 로 학습한다.
+    '''
+    dist.init_process_group(backend=backend, init_method=init_method, world_size=world_size, rank=rank)
+    if rank == 0:
+        if run_id is not None:
+            # spawn 된 process 에는 active run 이 없으므로, 부모 process 가 만든 run 에 이어서 기록한다.
+            ml.set_tracking_uri("./mlruns")
+            ml.start_run(run_id=run_id)
+    else:
+        # 같은 log 가 process 수 만큼 찍히지 않게 rank 0 만 info 를 남긴다.
+        logging.getLogger().setLevel(logging.WARNING)
+
+    try:
+        train.run(**kwargs)
+    finally:
+        if rank == 0 and run_id is not None:
+            ml.end_run()
+        dist.destroy_process_group()
+
+
 # window 운영체제에서 freeze support 안나오게 하려면, 아래와 같이 __name__ == "__main__" 에 해줘야함.
 if __name__ == "__main__":
 
@@ -123,17 +162,27 @@ if __name__ == "__main__":
             ml.log_param("anchors", anchors)
 
             ml.log_param("batch size", batch_size)
+            ml.log_param("precision", precision)
+            ml.log_param("channels_last", channels_last)
+            ml.log_param("checkpoint_stages", checkpoint_stages)
             ml.log_param("multiscale", multiscale)
+            ml.log_param("progressive_epoch", progressive_epoch)
             ml.log_param("ignore threshold", ignore_threshold)
+            ml.log_param("fused_loss", fused_loss)
             ml.log_param("data augmentation", data_augmentation)
             ml.log_param("optimizer", optimizer)
             ml.log_param("num_workers", num_workers)
+            ml.log_param("prefetch_factor", prefetch_factor)
 
             ml.log_param("learning rate", learning_rate)
             ml.log_param("weight decay", weight_decay)
             ml.log_param("decay lr", decay_lr)
             ml.log_param("decay step", decay_step)
             ml.log_param("using_cuda", using_cuda)
+            ml.log_param("distributed", distributed)
+            if distributed:
+                ml.log_param("world_size", world_size)
+                ml.log_param("backend", backend)
 
             ml.log_param("save_period", save_period)
             ml.log_param("mAP iou_thresh", iou_thresh)
@@ -143,51 +192,69 @@ if __name__ == "__main__":
 
         torch.backends.cudnn.deterministic = False
         torch.backends.cudnn.benchmark = True # 그래프가 변하는 경우 학습 속도 느려질수 있음.
-        train.run(mean=image_mean,
-                  std=image_std,
-                  offset_alloc_size=offset_alloc_size,
-                  anchors=anchors,
-                  epoch=epoch,
-                  input_size=input_size,
-                  input_frame_number=input_frame_number,
-                  batch_log=batch_log,
-                  batch_size=batch_size,
-                  batch_interval=batch_interval,
-                  subdivision=subdivision,
-                  train_dataset_path=train_dataset_path,
-                  valid_dataset_path=valid_dataset_path,
-                  multiscale=multiscale,
-                  factor_scale=factor_scale,
-                  ignore_threshold=ignore_threshold,
-                  dynamic=dynamic,
-                  data_augmentation=data_augmentation,
-                  num_workers=num_workers,
-                  optimizer=optimizer,
-                  save_period=save_period,
-                  load_period=load_period,
-                  learning_rate=learning_rate,
-                  weight_decay = weight_decay,
-                  decay_lr=decay_lr,
-                  decay_step=decay_step,
-                  GPU_COUNT=GPU_COUNT,
-                  Darknetlayer=Darknetlayer,
-                  pretrained_base=pretrained_base,
-                  pretrained_path = pretrained_path,
-
-                  valid_size=valid_size,
-                  eval_period=eval_period,
-                  tensorboard=tensorboard,
-                  valid_graph_path=valid_graph_path,
-                  valid_html_auto_open=valid_html_auto_open,
-                  using_mlflow=using_mlflow,
-
-                  # valid dataset 그리기
-                  multiperclass=multiperclass,
-                  nms_thresh=nms_thresh,
-                  nms_topk=nms_topk,
-                  iou_thresh=iou_thresh,
-                  except_class_thresh=except_class_thresh,
-                  plot_class_thresh=plot_class_thresh)
+        train_kwargs = dict(mean=image_mean,
+                            std=image_std,
+                            offset_alloc_size=offset_alloc_size,
+                            anchors=anchors,
+                            epoch=epoch,
+                            input_size=input_size,
+                            input_frame_number=input_frame_number,
+                            batch_log=batch_log,
+                            batch_size=batch_size,
+                            batch_interval=batch_interval,
+                            subdivision=subdivision,
+                            precision=precision,
+                            channels_last=channels_last,
+                            checkpoint_stages=checkpoint_stages,
+                            train_dataset_path=train_dataset_path,
+                            valid_dataset_path=valid_dataset_path,
+                            multiscale=multiscale,
+                            factor_scale=factor_scale,
+                            progressive_epoch=progressive_epoch,
+                            ignore_threshold=ignore_threshold,
+                            dynamic=dynamic,
+                            dynamic_memory_budget=dynamic_memory_budget,
+                            fused_loss=fused_loss,
+                            data_augmentation=data_augmentation,
+                            num_workers=num_workers,
+                            prefetch_factor=prefetch_factor,
+                            optimizer=optimizer,
+                            save_period=save_period,
+                            load_period=load_period,
+                            learning_rate=learning_rate,
+                            weight_decay = weight_decay,
+                            decay_lr=decay_lr,
+                            decay_step=decay_step,
+                            GPU_COUNT=GPU_COUNT,
+                            Darknetlayer=Darknetlayer,
+                            pretrained_base=pretrained_base,
+                            pretrained_path = pretrained_path,
+
+                            valid_size=valid_size,
+                            eval_period=eval_period,
+                            tensorboard=tensorboard,
+                            valid_graph_path=valid_graph_path,
+                            valid_html_auto_open=valid_html_auto_open,
+                            using_mlflow=using_mlflow,
+
+                            # valid dataset 그리기
+                            multiperclass=multiperclass,
+                            nms_thresh=nms_thresh,
+                            nms_topk=nms_topk,
+                            iou_thresh=iou_thresh,
+                            except_class_thresh=except_class_thresh,
+                            plot_class_thresh=plot_class_thresh)
+
+        if distributed:
+            # process 마다 model 하나씩 - checkpoint / tensorboard / mlflow 는 rank 0 만 쓴다.
+            torch.multiprocessing.spawn(distributed_run,
+                                        args=(world_size, backend, init_method,
+                                              ml.active_run().info.run_id if using_mlflow else None,
+                                              train_kwargs),
+                                        nprocs=world_size,
+                                        join=True)
+        else:
+            train.run(**train_kwargs)
 
         if using_mlflow:
             ml.end_run()
@@ -199,7 +266,7 @@ if __name__ == "__main__":
                  std=image_std,
                  load_name=load_name, load_period=load_period, GPU_COUNT=GPU_COUNT,
                  test_weight_path=test_weight_path,
-                 test_dataset_path=test_dataset_path, num_workers=num_workers,
+                 test_dataset_path=test_dataset_path, num_workers=num_workers, prefetch_factor=prefetch_factor,
                  test_save_path=test_save_path,
                  test_graph_path=test_graph_path,
                  test_html_auto_open=test_html_auto_open,
@@ -212,6 +279,7 @@ if __name__ == "__main__":
                  video_name = video_name,
                  ignore_threshold=ignore_threshold,
                  dynamic=dynamic,
+                 dynamic_memory_budget=dynamic_memory_budget,
                  multiperclass=multiperclass,
                  nms_thresh=nms_thresh,
                  nms_topk=nms_topk,
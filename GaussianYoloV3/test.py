@@ -28,6 +28,7 @@ def run(input_frame_number=2,
         test_graph_path="test_Graph",
         test_html_auto_open=False,
         num_workers=4,
+        prefetch_factor=2,
         show_flag=True,
         save_flag=True,
         video_flag=True,
@@ -37,6 +38,7 @@ def run(input_frame_number=2,
         video_name = "result",
         ignore_threshold=0.5,
         dynamic=False,
+        dynamic_memory_budget=256,
         multiperclass=True,
         nms_thresh=0.5,
         nms_topk=500,
@@ -82,6 +84,7 @@ def run(input_frame_number=2,
                                                        input_size=(netheight, netwidth),
                                                        input_frame_number=input_frame_number,
                                                        num_workers=num_workers,
+                                                       prefetch_factor=prefetch_factor,
                                                        mean=mean, std=std)
     except Exception:
         logging.info("The dataset does not exist")
@@ -110,7 +113,8 @@ def run(input_frame_number=2,
         logging.info("loading jit 성공")
 
 
-    targetgenerator = TargetGenerator(ignore_threshold=ignore_threshold, dynamic=dynamic, from_sigmoid=False)
+    targetgenerator = TargetGenerator(ignore_threshold=ignore_threshold, dynamic=dynamic, from_sigmoid=False,
+                                      dynamic_memory_budget=dynamic_memory_budget)
     loss = Yolov3Loss(sparse_label=True,
                       from_sigmoid=False,
                       num_classes=num_classes,
@@ -271,6 +275,7 @@ if __name__ == "__main__":
         test_graph_path="test_Graph",
         test_html_auto_open=True,
         num_workers=4,
+        prefetch_factor=2,
         show_flag=True,
         save_flag=True,
         video_flag=True,
@@ -280,6 +285,7 @@ if __name__ == "__main__":
         video_name = "result",
         ignore_threshold=0.5,
         dynamic=False,
+        dynamic_memory_budget=256,
         multiperclass=True,
         nms_thresh=0.5,
         nms_topk=500,
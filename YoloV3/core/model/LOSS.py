@@ -1,12 +1,19 @@
 import torch
 from torch.nn import Module
 
+
+def _to_float(tensor):
+    # autocast(fp16, bf16) 의 출력만 fp32 로 올린다. - fp32, fp64 는 그대로
+    return tensor.float() if tensor.dtype in (torch.float16, torch.bfloat16) else tensor
+
+
 class Yolov3Loss(Module):
 
     def __init__(self, sparse_label = True,
                  from_sigmoid=False,
                  num_classes=5,
-                 reduction="sum"):
+                 reduction="sum",
+                 fused=False):
 
         super(Yolov3Loss, self).__init__()
         self._sparse_label = sparse_label
@@ -14,6 +21,7 @@ class Yolov3Loss(Module):
         self._num_classes = num_classes
         self._reduction = reduction.upper()
         self._num_pred = 5 + num_classes
+        self._fused = fused
 
         self._sigmoid_ce = SigmoidBinaryCrossEntropyLoss(from_sigmoid=from_sigmoid,
                                                          reduction=reduction)
@@ -21,6 +29,12 @@ class Yolov3Loss(Module):
 
     def forward(self, output1, output2, output3, xcyc_target, wh_target, objectness, class_target, weights):
 
+        # autocast(fp16, bf16) 로 학습해도 loss 는 fp32 로 구한다. - exp, log, 제곱합이 낮은 정밀도에서 overflow / underflow 된다.
+        output1, output2, output3 = _to_float(output1), _to_float(output2), _to_float(output3)
+
+        if self._fused:
+            return self._fused_forward([output1, output2, output3], xcyc_target, wh_target, objectness, class_target, weights)
+
         #1. prediction 쪼개기
         b, _, _, _ = output1.shape
         pred = torch.cat([out.reshape(b, -1, self._num_pred) for out in [output1, output2, output3]], dim=1)
@@ -56,6 +70,65 @@ class Yolov3Loss(Module):
 
         return xcyc_loss, wh_loss, object_loss, class_loss
 
+    def _fused_forward(self, outputs, xcyc_target, wh_target, objectness, class_target, weights):
+
+        '''
+        forward 와 같은 loss 를 level 별로 구한다. (fused=True)
+        - prediction 을 이어붙이지 않고, objectness 의 BCE 는 원소마다 한번만 계산한다.(object / noobject mask 를 합쳐서)
+        - 좌표, class loss 는 objectness == 1 인 anchor 만 모아서 계산 - (b, N, num_classes + 1) one-hot 과 full-size mask 를 만들지 않는다.
+        '''
+        batch = outputs[0].shape[0]
+        sums = torch.zeros(4, batch, dtype=objectness.dtype, device=objectness.device)  # xcyc, wh, object, class
+        begin = 0
+        for output in outputs:
+            pred = output.reshape(batch, -1, self._num_pred)
+            end = begin + pred.shape[1]
+
+            # object loss + noobject loss - ignore(-1) 만 빠진다.
+            level_objectness = objectness[:, begin:end]
+            object_loss = _binary_cross_entropy(pred[:, :, 4:5], level_objectness, self._from_sigmoid)
+            object_loss = torch.mul(object_loss, (level_objectness == 1) | (level_objectness == 0))
+            sums[2] += torch.sum(object_loss, dim=[1, 2])
+
+            # positive anchor 만
+            b, n = torch.nonzero(level_objectness[:, :, 0] == 1, as_tuple=True)
+            positive = pred[b, n]
+            n = n + begin
+            weight = weights[b, n]
+
+            xcyc_pred = positive[:, 0:2]
+            if not self._from_sigmoid:
+                xcyc_pred = torch.sigmoid(xcyc_pred)
+            sums[0].index_add_(0, b, torch.sum(torch.square(xcyc_target[b, n] - xcyc_pred) * weight, dim=-1))
+            sums[1].index_add_(0, b, torch.sum(torch.square(wh_target[b, n] - positive[:, 2:4]) * weight, dim=-1))
+
+            if self._sparse_label:
+                label = torch.nn.functional.one_hot(class_target[b, n].to(torch.int64) + 1, self._num_classes + 1)[:, 1:]
+            else:
+                label = class_target[b, n]
+            class_loss = _binary_cross_entropy(positive[:, 5:], label, self._from_sigmoid)
+            sums[3].index_add_(0, b, torch.sum(class_loss, dim=-1))
+            begin = end
+
+        if self._reduction == "SUM":
+            return tuple(sums.mean(dim=-1))
+        elif self._reduction == "MEAN":
+            # forward 처럼 image 마다 원소 수(anchor 수 x channel 수)로 나눈다.
+            numel = torch.as_tensor([2, 2, 1, self._num_classes], dtype=sums.dtype, device=sums.device) * begin
+            return tuple((sums / numel.unsqueeze(-1)).mean(dim=-1))
+        else:
+            raise NotImplementedError
+
+
+def _binary_cross_entropy(pred, label, from_sigmoid=False):
+    # SigmoidBinaryCrossEntropyLoss(pos_weight=None) 의 원소별 loss
+    if not from_sigmoid:
+        return torch.nn.functional.relu(pred) - pred * label + torch.log1p(torch.exp(-torch.abs(pred)))
+    else:
+        eps = 1e-7
+        return -(torch.log(pred + eps) * label + torch.log(1. - pred + eps) * (1. - label))
+
+
 class L2Loss(Module):
 
     def __init__(self, reduction="sum"):
@@ -64,7 +137,7 @@ class L2Loss(Module):
         self._reduction = reduction.upper()
 
     def forward(self, pred, label, sample_weight=None):
-        loss = torch.square(label - pred)
+        loss = torch.square(label - _to_float(pred))
         if sample_weight is not None:
             loss = torch.mul(loss, sample_weight)
         if self._reduction == "SUM":
@@ -83,17 +156,19 @@ class SigmoidBinaryCrossEntropyLoss(Module):
 
     def forward(self, pred, label, sample_weight=None, pos_weight=None):
 
+        # autocast 로 학습해도 fp32 로 - fp16 에서는 1. - pred + eps 의 eps 가 사라져서 log(0) 이 된다.
+        pred = _to_float(pred)
         if not self._from_sigmoid:
             if pos_weight is None:
-                # We use the stable formula: max(x, 0) - x * z + log(1 + exp(-abs(x)))
+                # We use the stable formula: max(x, 0) - x * z + log1p(exp(-abs(x)))
                 loss = torch.nn.functional.relu(pred) - pred * label + \
-                       torch.log(1 + torch.exp(-torch.abs(pred)))
+                       torch.log1p(torch.exp(-torch.abs(pred)))
             else:
                 # We use the stable formula: x - x * z + (1 + z * pos_weight - z) * \
-                #    (log(1 + exp(-abs(x))) + max(-x, 0))
+                #    (log1p(exp(-abs(x))) + max(-x, 0))
                 log_weight = 1 + torch.mul(pos_weight - 1, label)
                 loss = pred - pred * label + log_weight * \
-                       (torch.log(1 + torch.exp(-torch.abs(pred))) + torch.nn.functional.relu(-pred))
+                       (torch.log1p(torch.exp(-torch.abs(pred))) + torch.nn.functional.relu(-pred))
         else:
             eps = 1e-7
             if pos_weight is None:
@@ -111,3 +186,47 @@ class SigmoidBinaryCrossEntropyLoss(Module):
             return torch.mean(loss, dim=[1,2]).mean()
         else:
             raise NotImplementedError
+
+
+# test
+if __name__ == "__main__":
+
+    # fused=True 의 loss, gradient 가 기존 계산과 같은지 - 3 level, 일부 anchor 만 positive / ignore
+    torch.manual_seed(0)
+    num_classes = 5
+    batch = 4
+    outputs = [torch.randn(batch, size, size, 3 * (5 + num_classes), dtype=torch.float64, requires_grad=True) for size in (13, 26, 52)]
+    num_anchor = sum(3 * size * size for size in (13, 26, 52))
+
+    objectness = torch.zeros(batch, num_anchor, 1, dtype=torch.float64)
+    random = torch.rand(batch, num_anchor, 1)
+    objectness[random > 0.99] = 1
+    objectness[random < 0.05] = -1
+    xcyc_target = torch.rand(batch, num_anchor, 2, dtype=torch.float64)
+    wh_target = torch.randn(batch, num_anchor, 2, dtype=torch.float64)
+    class_target = torch.randint(0, num_classes, (batch, num_anchor)).to(torch.float64)
+    weights = torch.rand(batch, num_anchor, 2, dtype=torch.float64) + 1
+
+    results = []
+    for fused in [False, True]:
+        loss = Yolov3Loss(sparse_label=True, from_sigmoid=False, num_classes=num_classes, reduction="sum", fused=fused)
+        losses = loss(*outputs, xcyc_target, wh_target, objectness, class_target, weights)
+        results.append((losses, torch.autograd.grad(sum(losses), outputs)))
+
+    (losses, grads), (fused_losses, fused_grads) = results
+    for name, a, b in zip(["xcyc", "wh", "object", "class"], losses, fused_losses):
+        print(f"{name} loss : {a.item():0.6f} / fused : {b.item():0.6f}, allclose : {torch.allclose(a, b)}")
+    print(f"gradient allclose : {all(torch.allclose(a, b) for a, b in zip(grads, fused_grads))}")
+
+
+    # precision: bf16 - cpu autocast 의 bf16 출력으로 구한 loss 가 fp32 이고 값이 가까운지, gradient 가 유한한지
+    if hasattr(torch, "autocast"):
+        bf16_outputs = [output.detach().to(torch.bfloat16).requires_grad_(True) for output in outputs]
+        loss = Yolov3Loss(sparse_label=True, from_sigmoid=False, num_classes=num_classes, reduction="sum", fused=True)
+        with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+            # 학습처럼 target 은 fp32
+            bf16_losses = loss(*bf16_outputs, *[target.float() for target in [xcyc_target, wh_target, objectness, class_target, weights]])
+        bf16_grads = torch.autograd.grad(sum(bf16_losses), bf16_outputs)
+        for name, a, b in zip(["xcyc", "wh", "object", "class"], losses, bf16_losses):
+            print(f"{name} loss : {a.item():0.6f} / bf16 : {b.item():0.6f}, dtype : {b.dtype}, relative error : {abs(a.item() - b.item()) / a.item():0.2e}")
+        print(f"bf16 gradient finite : {all(torch.isfinite(grad).all().item() for grad in bf16_grads)}")
@@ -53,7 +53,8 @@ class Yolov3(Module):
                  num_classes=1,  # foreground만
                  pretrained=True,
                  pretrained_path="/home/jg/Desktop/YoloV3/darknet53.pth",
-                 alloc_size=(64, 64)):
+                 alloc_size=(64, 64),
+                 checkpoint_stages=0):
         super(Yolov3, self).__init__()
 
         if Darknetlayer not in [53]:
@@ -64,7 +65,7 @@ class Yolov3(Module):
         strides = []
         anchors = OrderedDict(anchors)
         anchors = list(anchors.values())[::-1]
-        self._darknet = get_darknet(Darknetlayer, pretrained=pretrained, pretrained_path=pretrained_path, input_frame_number=input_frame_number)
+        self._darknet = get_darknet(Darknetlayer, pretrained=pretrained, pretrained_path=pretrained_path, input_frame_number=input_frame_number, checkpoint_stages=checkpoint_stages)
 
         output = self._darknet(torch.rand(1, input_frame_number*3, in_height, in_width))
         in_channels = []
@@ -1,16 +1,26 @@
+import inspect
 import logging
 import math
 import os
 from collections import OrderedDict
+from typing import Tuple
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 logfilepath = ""
 if os.path.isfile(logfilepath):
     os.remove(logfilepath)
 logging.basicConfig(filename=logfilepath, level=logging.INFO)
 
+def _checkpoint(stage, x):
+    # torch 1.7 의 checkpoint 에는 use_reentrant 인자가 없다. - 최신 버전에서도 같은(reentrant) 방식으로 재계산
+    if "use_reentrant" in inspect.signature(checkpoint).parameters:
+        return checkpoint(stage, x, use_reentrant=True)
+    return checkpoint(stage, x)
+
+
 class BasicBlock(nn.Module):
     def __init__(self, inplanes, planes):
         super(BasicBlock, self).__init__()
@@ -39,8 +49,10 @@ class BasicBlock(nn.Module):
 
 
 class DarkNet53(nn.Module):
-    def __init__(self, layers, input_frame_number=2):
+    def __init__(self, layers, input_frame_number=2, checkpoint_stages=0):
         super(DarkNet53, self).__init__()
+        # 학습할 때 앞에서부터 몇개의 stage(layer1 ~ layer5) 를 activation checkpointing 할지 - 0 이면 사용 안함
+        self._checkpoint_stages = checkpoint_stages
         self.inplanes = 32
         self.conv1 = nn.Conv2d(input_frame_number*3, self.inplanes, kernel_size=3, stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(self.inplanes, eps=1e-5, momentum=0.9, track_running_stats=False)
@@ -80,6 +92,9 @@ class DarkNet53(nn.Module):
         x = self.bn1(x)
         x = self.relu1(x)
 
+        if self._checkpoint_stages > 0 and self.training and not torch.jit.is_scripting():
+            return self._checkpoint_forward(x)
+
         x = self.layer1(x)
         x = self.layer2(x)
         out3 = self.layer3(x)
@@ -88,12 +103,28 @@ class DarkNet53(nn.Module):
 
         return out3, out4, out5
 
-def get_darknet(Darknetlayer, pretrained=True, pretrained_path="/home/jg/Desktop/YoloV3/darknet53.pth", input_frame_number=1):
+    @torch.jit.unused
+    def _checkpoint_forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+
+        '''
+        layer1 ~ layer5 를 stage 단위로 activation checkpointing - stage 의 입력만 저장하고, 안의 activation 은 backward 때 다시 계산한다.
+        torch.jit.script 로 export 할 때는 컴파일되지 않고 기존 forward 를 쓴다.
+        '''
+        outputs = []
+        for i, layer in enumerate([self.layer1, self.layer2, self.layer3, self.layer4, self.layer5]):
+            if i < self._checkpoint_stages and torch.is_grad_enabled() and not torch.jit.is_tracing():
+                x = _checkpoint(layer, x)
+            else:
+                x = layer(x)
+            outputs.append(x)
+        return outputs[2], outputs[3], outputs[4]
+
+def get_darknet(Darknetlayer, pretrained=True, pretrained_path="/home/jg/Desktop/YoloV3/darknet53.pth", input_frame_number=1, checkpoint_stages=0):
     """Constructs a darknet-53 model.
     """
     # weight download : https://drive.google.com/file/d/1keZwVIfcWmxfTiswzOKUwkUz2xjvTvfm/view
     if Darknetlayer==53:
-        net = DarkNet53([1, 2, 8, 8, 4], input_frame_number=input_frame_number)
+        net = DarkNet53([1, 2, 8, 8, 4], input_frame_number=input_frame_number, checkpoint_stages=checkpoint_stages)
         if pretrained:
             try:
                 net.load_state_dict(torch.load(pretrained_path))
@@ -128,3 +159,71 @@ if __name__ == "__main__":
     (2) feature shape : torch.Size([1, 512, 26, 26])
     (3) feature shape : torch.Size([1, 1024, 13, 13])
     '''
+
+    # channels_last - cpu(oneDNN) 에서 memory format 별 처리량 비교 (batch 4, 5 번 평균)
+    import time
+    net = get_darknet(53, pretrained=False, input_frame_number=1)
+    for memory_format in [torch.contiguous_format, torch.channels_last]:
+        net = net.to(memory_format=memory_format)
+        x = torch.rand(4, 3, input_size[0], input_size[1]).contiguous(memory_format=memory_format)
+        net.eval()
+        with torch.no_grad():
+            net(x)  # warm up
+            start = time.time()
+            for _ in range(5):
+                net(x)
+            inference = 4 * 5 / (time.time() - start)
+        net.train()
+        sum(out.mean() for out in net(x)).backward()  # warm up
+        start = time.time()
+        for _ in range(5):
+            sum(out.mean() for out in net(x)).backward()
+        train = 4 * 5 / (time.time() - start)
+        print(f"< darknet53 {str(memory_format):24s} : inference {inference:0.2f} / train {train:0.2f} images/sec >")
+    '''
+    cpu 1 core 에서 측정
+    < darknet53 torch.contiguous_format  : inference 1.70 / train 0.57 images/sec >
+    < darknet53 torch.channels_last      : inference 2.08 / train 0.61 images/sec >
+    '''
+
+    # activation checkpointing - configs/detector.yaml 의 크기에서 checkpoint_stages 별 backward 를 위해 저장되는 activation 크기, 학습 처리량 비교
+    # activation 크기는 saved_tensors_hooks 로 재므로 torch 1.10 이상에서만 나오고, 그보다 낮으면 학습 처리량만 잰다.
+    # 저장되는 activation 은 batch 에 비례하므로 batch 1 로 재고 batch_size 를 곱한다. (backward 때는 다시 계산하는 stage 하나 만큼이 잠깐 더 필요하다.)
+    import contextlib
+    import time
+    input_size, batch_size = (416, 416), 2
+    x = torch.rand(1, 3, input_size[0], input_size[1])
+    for checkpoint_stages in range(6):
+        net = get_darknet(53, pretrained=False, input_frame_number=1, checkpoint_stages=checkpoint_stages)
+        net.train()
+        parameters = {parameter.data_ptr() for parameter in net.parameters()}
+        saved = {}
+        def pack(tensor):
+            # torch 2.0 부터 storage() 대신 untyped_storage(), nbytes() 는 torch 1.13 부터
+            storage = tensor.untyped_storage() if hasattr(tensor, "untyped_storage") else tensor.storage()
+            if storage.data_ptr() not in parameters:
+                saved[storage.data_ptr()] = storage.nbytes() if hasattr(storage, "nbytes") else storage.size() * storage.element_size()
+            return tensor
+        measurable = hasattr(torch.autograd, "graph") and hasattr(torch.autograd.graph, "saved_tensors_hooks")
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor) if measurable else contextlib.nullcontext():
+            loss = sum(out.mean() for out in net(x))
+        loss.backward()  # warm up
+        start = time.time()
+        for _ in range(3):
+            loss = sum(out.mean() for out in net(x))
+            loss.backward()
+        train = 3 / (time.time() - start)
+        memory = sum(saved.values()) / 1024 ** 2
+        if measurable:
+            print(f"< DarkNet53 {input_size} checkpoint_stages {checkpoint_stages} : saved activation {memory:0.1f}MB x batch {batch_size} = {memory * batch_size:0.1f}MB / train {train:0.2f} images/sec >")
+        else:
+            print(f"< DarkNet53 {input_size} checkpoint_stages {checkpoint_stages} : train {train:0.2f} images/sec >")
+    '''
+    cpu 1 core 에서 측정
+    < DarkNet53 (416, 416) checkpoint_stages 0 : saved activation 375.8MB x batch 2 = 751.5MB / train 0.58 images/sec >
+    < DarkNet53 (416, 416) checkpoint_stages 1 : saved activation 307.1MB x batch 2 = 614.2MB / train 0.57 images/sec >
+    < DarkNet53 (416, 416) checkpoint_stages 2 : saved activation 249.0MB x batch 2 = 498.0MB / train 0.55 images/sec >
+    < DarkNet53 (416, 416) checkpoint_stages 3 : saved activation 148.6MB x batch 2 = 297.3MB / train 0.51 images/sec >
+    < DarkNet53 (416, 416) checkpoint_stages 4 : saved activation 98.4MB x batch 2 = 196.8MB / train 0.46 images/sec >
+    < DarkNet53 (416, 416) checkpoint_stages 5 : saved activation 85.2MB x batch 2 = 170.3MB / train 0.45 images/sec >
+    '''
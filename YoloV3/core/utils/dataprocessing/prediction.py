@@ -12,80 +12,78 @@ class Prediction(Module):
                  nms_thresh=0.5,
                  nms_topk=500,
                  except_class_thresh=0.05,
-                 multiperclass=True):
+                 multiperclass=True,
+                 sparse=True,
+                 nms_chunk=256):
         super(Prediction, self).__init__()
 
-        self._unique_ids = [-1] + [ i for i in range(num_classes)]
         self._except_class_thresh = except_class_thresh
         self._decoder = Decoder(from_sigmoid=from_sigmoid, num_classes=num_classes, thresh=except_class_thresh,
                                 multiperclass=multiperclass)
         self._nms_thresh = nms_thresh
         self._nms_topk = nms_topk
+        # nms_topk > 0 일 때, 전체 결과를 만들지 않고 3개의 level 에서 thresh 이상인 상위 nms_topk 개만 decoding
+        self._sparse = sparse and nms_topk > 0
+        # nms 의 IOU 를 (batch, object number, nms_chunk) 씩 나눠서 구한다. - nms_topk <= 0 이면 object number 가 수만개라 한번에 구하면 메모리가 부족하다.
+        self._nms_chunk = nms_chunk
 
     def _non_maximum_suppression(self, ids, scores, bboxes):
 
-        # https://gist.github.com/mkocabas/a2f565b27331af0da740c11c78699185
         '''
-        1. 내림차순 정렬 하기
-        2. non maximum suppression 후 빈 박스들은  -1로 채우기
-
-        :param ids: (object number, 1)
-        :param scores: (object number, 1)
-        :param bboxes: (object number, 4)
+        batch, class 를 python loop 없이 한번에 처리하는 nms (fast nms)
+        1. score 내림차순 정렬 (topk 를 거쳤다면 이미 정렬되어 있음)
+        2. 모든 box 쌍의 IOU 를 구한 후, 같은 class 이면서 자신보다 score가 높은 box 와의 IOU 최대값이 nms_thresh 보다 크면 제거
+           IOU 는 column(자신) 을 nms_chunk 개씩 나눠서 구한다. - 메모리는 (batch, object number, nms_chunk)
+        3. nms 로 제거된 것과 배경은 -1로 채우기
+
+        :param ids: (batch, object number, 1)
+        :param scores: (batch, object number, 1)
+        :param bboxes: (batch, object number, 4)
         :return: ids, scores, bboxes
         '''
 
-        if ids.shape[0] == 1:
-            return ids, scores, bboxes
-
-        # 내림차순 정렬
-        indices = scores.argsort(dim=0, descending=True)[:,0] # 내림차순 정렬
-        ids = ids[indices]
-        scores = scores[indices]
-        xmin = bboxes[:,0:1][indices]
-        ymin = bboxes[:,1:2][indices]
-        xmax = bboxes[:,2:3][indices]
-        ymax = bboxes[:,3:4][indices]
-
-        # nms 알고리즘
-        x1 = xmin[:, 0]
-        y1 = ymin[:, 0]
-        x2 = xmax[:, 0]
-        y2 = ymax[:, 0]
-        mask = torch.ones_like(x1)
-        i = 0
-        while i < len(ids)-1:
-
-            xx1 = torch.max(x1[i], x1[i+1:])
-            yy1 = torch.max(y1[i], y1[i+1:])
-            xx2 = torch.min(x2[i], x2[i+1:])
-            yy2 = torch.min(y2[i], y2[i+1:])
-            w = xx2 - xx1 + 1
-            h = yy2 - yy1 + 1
-
-            box1_area = (x2[i] - x1[i] + 1) * (y2[i] - y1[i] + 1)
-            boxn_area = (x2[i+1:] - x1[i+1:] + 1) * (y2[i+1:] - y1[i+1:] + 1)
-            overlap = (w * h) / (box1_area + boxn_area - (w * h))
-            mask[i+1:] = torch.where(overlap > self._nms_thresh, torch.ones_like(overlap)*-1, torch.ones_like(overlap))
-            i+=1
-
-        # nms 한 것들 mask 씌우기
-        mask = mask[:,None]
-        ids = ids * mask
-        scores = scores * mask
-        xmin = xmin * mask
-        ymin = ymin * mask
-        xmax = xmax * mask
-        ymax = ymax * mask
-
-        # nms 한 것들 mask 씌우기
-        ids = torch.where(ids<0, torch.ones_like(ids)*-1, ids) # 0 : nms / -1 : 배경 -> -1 로 표현
-        scores = torch.where(scores<0, torch.ones_like(scores)*-1, scores)
-        xmin = torch.where(xmin<0, torch.ones_like(xmin)*-1, xmin)
-        ymin = torch.where(ymin<0, torch.ones_like(ymin)*-1, ymin)
-        xmax = torch.where(xmax<0, torch.ones_like(xmax)*-1, xmax)
-        ymax = torch.where(ymax<0, torch.ones_like(ymax)*-1, ymax)
-        bboxes = torch.cat([xmin, ymin, xmax, ymax], dim=-1)
+        batch_size, number, _ = ids.shape
+        if self._nms_topk <= 0:
+            # 내림차순 정렬
+            indices = scores.argsort(dim=1, descending=True)
+            ids = torch.gather(ids, 1, indices)
+            scores = torch.gather(scores, 1, indices)
+            bboxes = torch.gather(bboxes, 1, indices.repeat(1, 1, 4))
+            # 정렬하면 배경(-1)은 뒤로 모이므로, 앞쪽의 thresh 이상인 것들끼리만 nms
+            number = int((ids >= 0).sum(dim=1).max())
+
+        x1 = bboxes[:, :number, 0:1]
+        y1 = bboxes[:, :number, 1:2]
+        x2 = bboxes[:, :number, 2:3]
+        y2 = bboxes[:, :number, 3:4]
+        area = (x2 - x1 + 1) * (y2 - y1 + 1)
+        object_ids = ids[:, :number]
+
+        # (batch, object number) / 자신보다 score 가 높은 같은 class box 와의 IOU 최대값
+        max_overlap = torch.zeros(batch_size, ids.shape[1], dtype=bboxes.dtype, device=bboxes.device)
+        for start in range(0, number, self._nms_chunk):
+            end = min(start + self._nms_chunk, number)
+            # [b, i, j] : i번째 box와 start + j번째 box의 IOU - i 는 end 보다 앞의 것만 보면 된다.
+            xx1 = torch.max(x1[:, :end], x1[:, start:end].transpose(1, 2))
+            yy1 = torch.max(y1[:, :end], y1[:, start:end].transpose(1, 2))
+            xx2 = torch.min(x2[:, :end], x2[:, start:end].transpose(1, 2))
+            yy2 = torch.min(y2[:, :end], y2[:, start:end].transpose(1, 2))
+            w = torch.clamp(xx2 - xx1 + 1, min=0)
+            h = torch.clamp(yy2 - yy1 + 1, min=0)
+            intersection = w * h
+            overlap = intersection / (area[:, :end] + area[:, start:end].transpose(1, 2) - intersection)
+
+            # 같은 class 끼리만 비교 / 자신보다 score 가 높은 것(i < j)과만 비교
+            same_class = object_ids[:, :end] == object_ids[:, start:end].transpose(1, 2)
+            higher = torch.arange(end, device=ids.device).unsqueeze(-1) < torch.arange(start, end, device=ids.device).unsqueeze(0)
+            overlap = overlap * (same_class & higher.unsqueeze(0)).to(overlap.dtype)
+            max_overlap[:, start:end] = overlap.max(dim=1)[0]
+        keep = (max_overlap.unsqueeze(-1) <= self._nms_thresh) & (ids >= 0)
+
+        # nms 한 것들과 배경 -1 로 표현
+        ids = torch.where(keep, ids, torch.ones_like(ids) * -1)
+        scores = torch.where(keep, scores, torch.ones_like(scores) * -1)
+        bboxes = torch.where(keep, bboxes, torch.ones_like(bboxes) * -1)
 
         return ids, scores, bboxes
 
@@ -94,72 +92,43 @@ class Prediction(Module):
                 offset1, offset2, offset3,
                 stride1, stride2, stride3):
 
-        results = []
-        for out, an, off, st in zip([output1, output2, output3],
-                                    [anchor1, anchor2, anchor3],
-                                    [offset1, offset2, offset3],
-                                    [stride1, stride2, stride3]):
-            results.append(self._decoder(out, an, off, st))
-        results = torch.cat(results, dim=1)
-
-        ids = results[:, :, 0:1]
-        scores = results[:,:,1:2]
-        bboxes = results[:,:,2:]
-
-        batch_size, _, _ = ids.shape
-        if self._nms_topk > 0:
-            scores, topk_score_index = torch.topk(scores, self._nms_topk, dim=1, largest=True, sorted=True)
-            batch_indices = torch.arange(batch_size, device=ids.device).unsqueeze(dim=-1).repeat_interleave(self._nms_topk, dim=-1) # (batch, self._topk)
-            last_indices = torch.zeros_like(batch_indices, dtype=torch.int64)
-            indices = torch.cat((batch_indices, topk_score_index.squeeze(dim=-1), last_indices), dim=0).reshape((3, -1))
-
-            ids = ids[indices[0], indices[1], indices[2]].reshape(batch_size, self._nms_topk, -1)
-            x1 = bboxes[indices[0], indices[1], indices[2]].reshape(batch_size, self._nms_topk, -1)
-            y1 = bboxes[indices[0], indices[1], indices[2]+1].reshape(batch_size, self._nms_topk, -1)
-            x2 = bboxes[indices[0], indices[1], indices[2]+2].reshape(batch_size, self._nms_topk, -1)
-            y2 = bboxes[indices[0], indices[1], indices[2]+3].reshape(batch_size, self._nms_topk, -1)
-            bboxes = torch.cat((x1, y1, x2, y2), dim=-1)
+        if self._sparse:
+            candidates = self._decoder.sparse([output1, output2, output3],
+                                              [anchor1, anchor2, anchor3],
+                                              [offset1, offset2, offset3],
+                                              [stride1, stride2, stride3], self._nms_topk)
+            ids = candidates[:, :, 0:1]
+            scores = candidates[:, :, 1:2]
+            bboxes = candidates[:, :, 2:]
+        else:
+            results = []
+            for out, an, off, st in zip([output1, output2, output3],
+                                        [anchor1, anchor2, anchor3],
+                                        [offset1, offset2, offset3],
+                                        [stride1, stride2, stride3]):
+                results.append(self._decoder(out, an, off, st))
+            results = torch.cat(results, dim=1)
+
+            ids = results[:, :, 0:1]
+            scores = results[:,:,1:2]
+            bboxes = results[:,:,2:]
+
+            batch_size, _, _ = ids.shape
+            if self._nms_topk > 0:
+                scores, topk_score_index = torch.topk(scores, self._nms_topk, dim=1, largest=True, sorted=True)
+                batch_indices = torch.arange(batch_size, device=ids.device).unsqueeze(dim=-1).repeat_interleave(self._nms_topk, dim=-1) # (batch, self._topk)
+                last_indices = torch.zeros_like(batch_indices, dtype=torch.int64)
+                indices = torch.cat((batch_indices, topk_score_index.squeeze(dim=-1), last_indices), dim=0).reshape((3, -1))
+
+                ids = ids[indices[0], indices[1], indices[2]].reshape(batch_size, self._nms_topk, -1)
+                x1 = bboxes[indices[0], indices[1], indices[2]].reshape(batch_size, self._nms_topk, -1)
+                y1 = bboxes[indices[0], indices[1], indices[2]+1].reshape(batch_size, self._nms_topk, -1)
+                x2 = bboxes[indices[0], indices[1], indices[2]+2].reshape(batch_size, self._nms_topk, -1)
+                y2 = bboxes[indices[0], indices[1], indices[2]+3].reshape(batch_size, self._nms_topk, -1)
+                bboxes = torch.cat((x1, y1, x2, y2), dim=-1)
 
         if self._nms_thresh > 0 and self._nms_thresh < 1:
-
-            ids_list = []
-            scores_list = []
-            bboxes_list = []
-
-            # batch 별로 나누기
-            # for id, score, x_min, y_min, x_max, y_max in zip(ids, scores, xmin, ymin, xmax, ymax):
-            for id, score, box in zip(ids, scores, bboxes):
-                id_list = []
-                score_list = []
-                bbox_list = []
-                # id별로 나누기
-                for uid in self._unique_ids:
-                    indices = id == uid
-                    bbox = torch.cat(
-                        [box[:, 0:1][indices, None], box[:, 1:2][indices, None], box[:, 2:3][indices, None],
-                         box[:, 3:4][indices, None]], dim=-1)
-                    if uid < 0:  # 배경인 경우
-                        id_part, score_part, bbox_part = id[indices, None], score[indices, None], bbox
-                    else:
-                        id_part, score_part, bbox_part = self._non_maximum_suppression(id[indices, None],
-                                                                                       score[indices, None], bbox)
-
-                    id_list.append(id_part)
-                    score_list.append(score_part)
-                    bbox_list.append(bbox_part)
-
-                id_concat = torch.cat(id_list, dim=0)
-                score_concat = torch.cat(score_list, dim=0)
-                bbox_concat = torch.cat(bbox_list, dim=0)
-
-                ids_list.append(id_concat)
-                scores_list.append(score_concat)
-                bboxes_list.append(bbox_concat)
-
-            # batch 차원
-            ids = torch.stack(ids_list, dim=0)
-            scores = torch.stack(scores_list, dim=0)
-            bboxes = torch.stack(bboxes_list, dim=0)
+            ids, scores, bboxes = self._non_maximum_suppression(ids, scores, bboxes)
 
         return ids, scores, bboxes
 
@@ -219,3 +188,41 @@ if __name__ == "__main__":
     nms box predictions shape : torch.Size([1, 10647, 4])
 
     '''
+
+    # nms_topk <= 0 (전체 nms) - nms_chunk 로 나눠서 구한 결과가 (batch, N, N) 으로 한번에 구하던 것과 같은지
+    import time
+
+    def full_nms(ids, scores, bboxes, nms_thresh):
+        x1, y1, x2, y2 = bboxes[:, :, 0:1], bboxes[:, :, 1:2], bboxes[:, :, 2:3], bboxes[:, :, 3:4]
+        w = torch.clamp(torch.min(x2, x2.transpose(1, 2)) - torch.max(x1, x1.transpose(1, 2)) + 1, min=0)
+        h = torch.clamp(torch.min(y2, y2.transpose(1, 2)) - torch.max(y1, y1.transpose(1, 2)) + 1, min=0)
+        intersection = w * h
+        area = (x2 - x1 + 1) * (y2 - y1 + 1)
+        overlap = intersection / (area + area.transpose(1, 2) - intersection)
+        overlap = torch.triu(overlap * (ids == ids.transpose(1, 2)).to(overlap.dtype), diagonal=1)
+        return (overlap.max(dim=1)[0].unsqueeze(-1) <= nms_thresh) & (ids >= 0)
+
+    def random_predictions(batch, number, num_classes):
+        xy = torch.rand(batch, number, 2) * 400
+        bboxes = torch.cat([xy, xy + torch.rand(batch, number, 2) * 60 + 4], dim=-1)
+        scores = torch.rand(batch, number, 1)
+        ids = torch.randint(0, num_classes, (batch, number, 1)).to(torch.float32)
+        ids[scores < 0.3] = -1  # except_class_thresh 미만은 배경
+        return ids, scores, bboxes
+
+    torch.manual_seed(0)
+    ids, scores, bboxes = random_predictions(2, 3000, 5)
+    full = Prediction(num_classes=5, nms_thresh=0.5, nms_topk=-1, nms_chunk=100000)
+    chunked = Prediction(num_classes=5, nms_thresh=0.5, nms_topk=-1, nms_chunk=256)
+    full_ids, _, _ = full._non_maximum_suppression(ids, scores, bboxes)
+    chunked_ids, chunked_scores, chunked_bboxes = chunked._non_maximum_suppression(ids, scores, bboxes)
+    indices = scores.argsort(dim=1, descending=True)
+    sorted_ids, sorted_bboxes = torch.gather(ids, 1, indices), torch.gather(bboxes, 1, indices.repeat(1, 1, 4))
+    reference = full_nms(sorted_ids, torch.gather(scores, 1, indices), sorted_bboxes, 0.5)
+    print(f"same as (batch, N, N) nms : {torch.equal(chunked_ids >= 0, reference) and torch.equal(chunked_ids, full_ids)}")
+
+    # 416 x 416 의 전체 prediction 수(10647 x class, multiperclass) - (batch, N, N) 이면 tensor 하나가 수 GB
+    ids, scores, bboxes = random_predictions(1, 10647 * 5, 5)
+    start = time.time()
+    ids, scores, bboxes = chunked._non_maximum_suppression(ids, scores, bboxes)
+    print(f"nms_topk=-1, {10647 * 5} predictions : {time.time() - start:0.2f}s, (N, N) IOU : {(10647 * 5) ** 2 * 4 / 1024 ** 3:0.1f}GB -> (N, nms_chunk) : {10647 * 5 * 256 * 4 / 1024 ** 2:0.1f}MB, 남은 box : {int((ids >= 0).sum())}")
@@ -8,7 +8,7 @@ from core.utils.dataprocessing.targetFunction.matching import Matcher
 
 class TargetGenerator(Module):
 
-    def __init__(self, ignore_threshold=0.5, dynamic=False, from_sigmoid=False):
+    def __init__(self, ignore_threshold=0.5, dynamic=False, from_sigmoid=False, dynamic_memory_budget=256):
         super(TargetGenerator, self).__init__()
         self._matcher = Matcher()
         self._from_sigmoid = from_sigmoid
@@ -24,7 +24,8 @@ class TargetGenerator(Module):
         '''
         self._dynamic = dynamic
         if dynamic:
-            self._encoder = Encoderdynamic(ignore_threshold=ignore_threshold, from_sigmoid=from_sigmoid)
+            self._encoder = Encoderdynamic(ignore_threshold=ignore_threshold, from_sigmoid=from_sigmoid,
+                                           memory_budget=dynamic_memory_budget)
         else:
             self._encoder = Encoderfix(ignore_threshold=ignore_threshold)
 
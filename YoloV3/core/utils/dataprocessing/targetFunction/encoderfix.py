@@ -24,161 +24,242 @@ class Encoderfix(Module):
         super(Encoderfix, self).__init__()
         self._cornertocenter = BBoxCornerToCenter(axis=-1)
         self._ignore_threshold = ignore_threshold
+        self._table_cache = {}
 
     def forward(self, matches, ious, outputs, anchors, gt_boxes, gt_ids, input_size):
 
         in_height = input_size[0]
         in_width = input_size[1]
+        device = gt_boxes.device
+        dtype = gt_boxes.dtype
         feature_size = []
         anchor_size = []
 
         for out, anchor in zip(outputs, anchors):
             _, h, w, _ = out.shape
             _, _, a, _ = anchor.shape
-            feature_size.append([h, w])
+            feature_size.append((h, w))
             anchor_size.append(a)
 
-        all_anchors = torch.cat([anchor.reshape(-1, 2) for anchor in anchors], dim=0)
-        num_anchors = np.cumsum(anchor_size)  # ex) (3, 6, 9)
+        all_anchors = torch.cat([anchor.reshape(-1, 2) for anchor in anchors], dim=0)  # (9, 2)
         num_offsets = np.cumsum([np.prod(feature) for feature in feature_size])  # ex) (338, 1690, 3549)
+        num_target = int(np.sum([np.prod(feature) * a for feature, a in zip(feature_size, anchor_size)]))  # ex) 10647
+        out_height, out_width, row_begin, row_end, base, layer_anchor, local_anchor, anchor_index = \
+            self._tables(tuple(feature_size), tuple(anchor_size), device)
+
+        '''
+        target 공간 만들어 놓기 - layer 별로 잘라 붙인 최종 형태로 바로 만든다.
+        마지막 한 칸은 쓰지 않는 값들을 모아 놓는 자리이다. (boolean indexing 으로 인한 device sync 를 피하기 위함)
+        '''
+        batch = gt_boxes.shape[0]
+        dummy = batch * num_target
+        xcyc_targets = torch.zeros(dummy + 1, 2, device=device, dtype=dtype)  # (batch x 10647 + 1, 2)가 기본 요소
+        wh_targets = torch.zeros_like(xcyc_targets)
+        weights = torch.zeros_like(xcyc_targets)
+        objectness = torch.zeros(dummy + 1, device=device, dtype=dtype)
+        class_targets = torch.zeros_like(objectness)
+
+        # (batch, object number, 1) -> (batch, 1, object number)
+        gtx, gty, gtw, gth = [x.permute(0, 2, 1) for x in self._cornertocenter(gt_boxes)]
+        gt_ids = gt_ids.permute(0, 2, 1)
+        matches = torch.as_tensor(matches, device=device).to(torch.int64).unsqueeze(1)  # (batch, 1, object number)
+        ious = torch.as_tensor(ious, device=device)  # (batch, 9, object number)
+        objectN = ious.shape[-1]
+
+        '''
+            matching 단계에서 image만 들어온 데이터들도 matching이 되기때문에 아래와 같이 걸러줘야 한다.
+            image만 들어온 데이터 or padding 된것들은 noobject이다.
+        '''
+        padding = (gtx == -1.0) & (gty == -1.0) & (gtw == 0.0) & (gth == 0.0)
+
+        # compute the location of the gt centers / 기존 numpy 구현과 같은 값이 나오도록 float64로 계산한다.
+        grid_x = gtx.to(torch.float64) / in_width * out_width
+        grid_y = gty.to(torch.float64) / in_height * out_height
+        loc_x = torch.trunc(grid_x)
+        loc_y = torch.trunc(grid_y)
+        index = row_begin + loc_y.to(torch.int64) * out_width.to(torch.int64) + loc_x.to(torch.int64)
+        index = torch.where(index < 0, index + int(num_offsets[-1]), index)  # 음수 index는 뒤에서 부터 가리킨다.
+
+        # 자기 layer 밖을 가리키는 위치는 기존 구현의 _slice 과정에서 버려지던 값들이다.
+        valid = (~padding) & (index >= row_begin) & (index < row_end)
+        positive = valid & (anchor_index == matches)  # 최대인 값은 제외
+        ignore = valid & (~positive) & (ious.to(torch.float64) >= self._ignore_threshold)
+
+        batch_index = torch.arange(batch, device=device).reshape(-1, 1, 1)
+        slot = batch_index * num_target + base + (index - row_begin) * layer_anchor + local_anchor
+        order = torch.arange(objectN, device=device).reshape(1, 1, -1).expand_as(slot)
+
+        # target 값 - (batch, 9, object number)
+        xc = (grid_x - loc_x).expand_as(slot)
+        yc = (grid_y - loc_y).expand_as(slot)
+        # max(gtw,1)? gtw, gth가 0일경우가 있다.
+        w = torch.log(torch.clamp(gtw.to(torch.float64), min=1) / all_anchors[:, 0].to(torch.float64).reshape(1, -1, 1))
+        h = torch.log(torch.clamp(gth.to(torch.float64), min=1) / all_anchors[:, 1].to(torch.float64).reshape(1, -1, 1))
+        weight = (2.0 - (gtw * gth).to(torch.float64) / in_width / in_height).expand_as(slot)
+        class_id = torch.trunc(gt_ids).expand_as(slot)
+
+        '''
+        같은 위치에 여러 object가 쓰이는 경우, 기존 구현(object 순서대로 덮어쓰기)과 같도록 마지막에 쓰인 것만 남긴다.
+        objectness는 positive / ignore 모두가, 나머지 target들은 positive만 덮어쓴다.
+        '''
+        write_slot, write_index = self._last_write(slot.masked_fill(~(positive | ignore), dummy), order, objectN, dummy)
+        objectness.index_put_((write_slot,), (positive.to(dtype) * 2 - 1).reshape(-1)[write_index])  # 1 : positive / -1 : ignore
+
+        write_slot, write_index = self._last_write(slot.masked_fill(~positive, dummy), order, objectN, dummy)
+        xcyc_targets.index_put_((write_slot,), torch.stack([xc, yc], dim=-1).reshape(-1, 2)[write_index].to(dtype))
+        wh_targets.index_put_((write_slot,), torch.stack([w, h], dim=-1).reshape(-1, 2)[write_index].to(dtype))
+        weights.index_put_((write_slot,), torch.stack([weight, weight], dim=-1).reshape(-1, 2)[write_index].to(dtype))
+        class_targets.index_put_((write_slot,), class_id.reshape(-1)[write_index].to(dtype))
+
+        xcyc_targets = xcyc_targets[:-1].reshape(batch, num_target, 2)
+        wh_targets = wh_targets[:-1].reshape(batch, num_target, 2)
+        weights = weights[:-1].reshape(batch, num_target, 2)
+        objectness = objectness[:-1].reshape(batch, num_target, 1)
+        class_targets = class_targets[:-1].reshape(batch, num_target)
+
+        # # threshold 바꿔가며 개수 세어보기
+        # print((objectness == 1).sum().item())
+        # print((objectness == 0).sum().item())
+        # print((objectness == -1).sum().item())
+
+        return xcyc_targets, wh_targets, objectness, class_targets, weights
+
+    def _tables(self, feature_size, anchor_size, device):
+
+        '''
+        anchor 별(9개)로 속한 layer의 크기, grid 시작 위치, target 에서의 시작 위치를 (1, 9, 1) 형태로 만들어 놓는다.
+        입력 크기가 바뀔 때만 새로 만들고, host -> device 복사 없이 device 에서 바로 만든다.
+        '''
+        key = (feature_size, anchor_size, str(device))
+        if key not in self._table_cache:
+            tables = [[] for _ in range(7)]
+            row = 0
+            base = 0
+            for (h, w), a in zip(feature_size, anchor_size):
+                values = [h, w, row, row + h * w, base, a]
+                for table, value in zip(tables, values):
+                    table.append(torch.full((a,), value, dtype=torch.int64, device=device))
+                tables[6].append(torch.arange(a, device=device))
+                row += h * w
+                base += h * w * a
+            out_height, out_width, row_begin, row_end, base, layer_anchor, local_anchor = \
+                [torch.cat(table, dim=0).reshape(1, -1, 1) for table in tables]
+            anchor_index = torch.arange(sum(anchor_size), device=device).reshape(1, -1, 1)
+            self._table_cache[key] = (out_height.to(torch.float64), out_width.to(torch.float64),
+                                      row_begin, row_end, base, layer_anchor, local_anchor, anchor_index)
+        return self._table_cache[key]
+
+    def _last_write(self, slot, order, num_order, dummy):
+
+        '''
+        slot이 같은 것들 중 order가 가장 큰 것만 남기고 나머지는 dummy 자리로 보낸다.
+        index_put_은 같은 index에 여러번 쓰는 경우 결과가 보장되지 않기 때문에 미리 하나만 남겨 놓는다.
+        return : 쓰일 위치, 쓰일 값의 index
+        '''
+        slot = slot.reshape(-1)
+        _, sort_index = torch.sort(slot * num_order + order.reshape(-1))
+        slot = slot[sort_index]
+        last = torch.ones_like(slot, dtype=torch.bool)
+        last[:-1] = slot[:-1] != slot[1:]
+        return slot.masked_fill(~last, dummy), sort_index
+
+# test
+if __name__ == "__main__":
+    import time
+
+    def loop_encoder(matches, ious, outputs, anchors, gt_boxes, gt_ids, input_size, ignore_threshold=0.5):
+
+        # batch x 9 anchor x object 를 python으로 도는 예전 구현 - 비교용
+        cornertocenter = BBoxCornerToCenter(axis=-1)
+        in_height, in_width = input_size
+        feature_size = [list(out.shape[1:3]) for out in outputs]
+        anchor_size = [anchor.shape[2] for anchor in anchors]
+        all_anchors = torch.cat([anchor.reshape(-1, 2) for anchor in anchors], dim=0)
+        num_anchors = np.cumsum(anchor_size)
+        num_offsets = np.cumsum([np.prod(feature) for feature in feature_size])
         offsets = [0] + num_offsets.tolist()
 
-        # target 공간 만들어 놓기
-        xcyc_targets = torch.zeros(gt_boxes.shape[0],
-                                   num_offsets[-1],
-                                   num_anchors[-1], 2,
-                                   device=gt_boxes.device,
-                                   dtype=gt_boxes.dtype)  # (batch, 3549, 9, 2)가 기본 요소
+        xcyc_targets = torch.zeros(gt_boxes.shape[0], num_offsets[-1], num_anchors[-1], 2, dtype=gt_boxes.dtype)
         wh_targets = torch.zeros_like(xcyc_targets)
         weights = torch.zeros_like(xcyc_targets)
         objectness = torch.zeros_like(xcyc_targets.split(1, dim=-1)[0])
         class_targets = torch.zeros_like(objectness)
 
-        all_gtx, all_gty, all_gtw, all_gth = self._cornertocenter(gt_boxes)
-
-        np_gtx, np_gty, np_gtw, np_gth = [x.cpu().numpy().copy() for x in [all_gtx, all_gty, all_gtw, all_gth]]
+        np_gtx, np_gty, np_gtw, np_gth = [x.cpu().numpy().copy() for x in cornertocenter(gt_boxes)]
         np_anchors = all_anchors.cpu().numpy().copy().astype(float)
         np_gt_ids = gt_ids.cpu().numpy().copy().astype(int)
 
-        # 가장 큰것에 할당하고, target anchor 비교해서 0.5 이상인것들 무시하기
         batch, anchorN, objectN = ious.shape
-
         for b in range(batch):
             for a in range(anchorN):
                 for o in range(objectN):
                     nlayer = np.where(num_anchors > a)[0][0]
-                    out_height = outputs[nlayer].shape[1]
-                    out_width = outputs[nlayer].shape[2]
-
-                    gtx, gty, gtw, gth = (np_gtx[b, o, 0], np_gty[b, o, 0],
-                                          np_gtw[b, o, 0], np_gth[b, o, 0])
-
-                    ''' 
-                        matching 단계에서 image만 들어온 데이터들도 matching이 되기때문에 아래와 같이 걸러줘야 한다.
-                        image만 들어온 데이터 or padding 된것들은 noobject이다. 
-                    '''
+                    out_height, out_width = feature_size[nlayer]
+                    gtx, gty, gtw, gth = (np_gtx[b, o, 0], np_gty[b, o, 0], np_gtw[b, o, 0], np_gth[b, o, 0])
                     if gtx == -1.0 and gty == -1.0 and gtw == 0.0 and gth == 0.0:
                         continue
-                    # compute the location of the gt centers
                     loc_x = int(gtx / in_width * out_width)
                     loc_y = int(gty / in_height * out_height)
-                    # write back to targets
                     index = offsets[nlayer] + loc_y * out_width + loc_x
-                    if a == matches[b, o]:  # 최대인 값은 제외
+                    if a == matches[b, o]:
                         xcyc_targets[b, index, a, 0] = gtx / in_width * out_width - loc_x
                         xcyc_targets[b, index, a, 1] = gty / in_height * out_height - loc_y
-                        '''
-                        if gtx == -1.0 and gty == -1.0 and gtw == 0.0 and gth == 0.0: 
-                            continue
-                        에서 처리를 해주었으나, 그래도 한번 더 대비 해놓자.
-                        '''
-                        wh_targets[b, index, a, 0] = np.log(
-                            max(gtw, 1) / np_anchors[a, 0])  # max(gtw,1)? gtw, gth가 0일경우가 있다.
+                        wh_targets[b, index, a, 0] = np.log(max(gtw, 1) / np_anchors[a, 0])
                         wh_targets[b, index, a, 1] = np.log(max(gth, 1) / np_anchors[a, 1])
                         weights[b, index, a, :] = 2.0 - gtw * gth / in_width / in_height
                         objectness[b, index, a, 0] = 1
                         class_targets[b, index, a, 0] = np_gt_ids[b, o, 0]
                         continue
-                    if ious[b, a, o] >= self._ignore_threshold:
+                    if ious[b, a, o] >= ignore_threshold:
                         objectness[b, index, a, 0] = -1
 
-        xcyc_targets = self._slice(xcyc_targets, num_anchors, num_offsets)
-        wh_targets = self._slice(wh_targets, num_anchors, num_offsets)
-        weights = self._slice(weights, num_anchors, num_offsets)
-        objectness = self._slice(objectness, num_anchors, num_offsets)
-        class_targets = self._slice(class_targets, num_anchors, num_offsets)
-        class_targets = class_targets.squeeze(-1)
+        def _slice(x):
+            anchor_offsets = [0] + num_anchors.tolist()
+            ret = []
+            for i in range(len(num_anchors)):
+                y = x[:, offsets[i]:offsets[i + 1], anchor_offsets[i]:anchor_offsets[i + 1], :]
+                b, f, a, _ = y.shape
+                ret.append(y.reshape(b, f * a, -1))
+            return torch.cat(ret, dim=1)
 
-        # # threshold 바꿔가며 개수 세어보기
-        # print((objectness == 1).sum().item())
-        # print((objectness == 0).sum().item())
-        # print((objectness == -1).sum().item())
-
-        return xcyc_targets, wh_targets, objectness, class_targets, weights
-
-    def _slice(self, x, num_anchors, num_offsets):
-
-        anchors = [0] + num_anchors.tolist()
-        offsets = [0] + num_offsets.tolist()
-        ret = []
-        for i in range(len(num_anchors)):
-            y = x[:, offsets[i]:offsets[i + 1], anchors[i]:anchors[i + 1], :]
-            b, f, a, _ = y.shape
-            ret.append(y.reshape(b, f*a, -1))
-        return torch.cat(ret, dim=1)
-
-# test
-if __name__ == "__main__":
-    from core import Yolov3, YoloTrainTransform, DetectionDataset
-    import os
+        return _slice(xcyc_targets), _slice(wh_targets), _slice(objectness), \
+               _slice(class_targets).squeeze(-1), _slice(weights)
 
     input_size = (608, 608)
+    batch_size = 16
+    object_number = 30
+    num_classes = 5
     device = torch.device("cpu")
-    root = os.path.dirname(
-        os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
-    transform = YoloTrainTransform(input_size[0], input_size[1])
-    dataset = DetectionDataset(path='/home/jg/Desktop/mountain/valid', transform=transform)
-    num_classes = dataset.num_class
-
-    image, label, _ = dataset[0]
-
-    net = Yolov3(Darknetlayer=53,
-                 input_size=input_size,
-                 anchors={"shallow": [(10, 13), (16, 30), (33, 23)],
-                          "middle": [(30, 61), (62, 45), (59, 119)],
-                          "deep": [(116, 90), (156, 198), (373, 326)]},
-                 num_classes=num_classes,  # foreground만
-                 pretrained=True)
-    net.to(device)
+    torch.manual_seed(0)
+
+    # (1, 1, 3, 2) 형태의 anchor / deep -> middle -> shallow 순
+    anchors = [torch.as_tensor(anchor, dtype=torch.float32).reshape(1, 1, -1, 2) for anchor in
+               [[(116, 90), (156, 198), (373, 326)], [(30, 61), (62, 45), (59, 119)], [(10, 13), (16, 30), (33, 23)]]]
+    outputs = [torch.zeros(batch_size, input_size[0] // stride, input_size[1] // stride, 3 * (5 + num_classes))
+               for stride in [32, 16, 8]]
+
+    # 작은 box 가 많이 모여 있는 경우 + padding(-1)
+    xymin = torch.rand(batch_size, object_number, 2) * input_size[0] * 0.9
+    wh = torch.rand(batch_size, object_number, 2) * input_size[0] * 0.3
+    gt_boxes = torch.round(torch.cat([xymin, torch.clamp(xymin + wh, max=input_size[0] - 1)], dim=-1))
+    gt_ids = torch.randint(0, num_classes, (batch_size, object_number, 1)).to(torch.float32)
+    gt_boxes[::2, object_number // 2:, :] = -1
+    gt_ids[::2, object_number // 2:, :] = -1
+    gt_boxes[:, 1, :] = gt_boxes[:, 0, :]  # 같은 위치에 겹치는 object
 
     matcher = Matcher()
     encoder = Encoderfix(ignore_threshold=0.5)
+    matches, ious = matcher(anchors, gt_boxes)
+
+    start = time.time()
+    reference = loop_encoder(matches.cpu().numpy(), ious.cpu().numpy(), outputs, anchors, gt_boxes, gt_ids, input_size, ignore_threshold=0.5)
+    loop_time = time.time() - start
+
+    start = time.time()
+    result = encoder(matches, ious, [out.to(device) for out in outputs], [an.to(device) for an in anchors],
+                     gt_boxes.to(device), gt_ids.to(device), input_size)
+    vectorized_time = time.time() - start
 
-    # batch 형태로 만들기
-    image = image[None,:,:]
-    label = label[None,:,:]
-
-    gt_boxes = label[:, :, :4]
-    gt_ids = label[:, :, 4:5]
-    output1, output2, output3, anchor1, anchor2, anchor3, _, _, _, _, _, _ = net(image.to(device))
-
-    matches, ious = matcher([anchor1, anchor2, anchor3], gt_boxes.to(device))
-    xcyc_targets, wh_targets, objectness, class_targets, weights = encoder(matches, ious, [output1, output2, output3],
-                                                                           [anchor1, anchor2, anchor3], gt_boxes.to(device),
-                                                                           gt_ids.to(device),
-                                                                           input_size)
-
-    print(f"< input size(height, width) : {input_size} >")
-    print(f"xcyc_targets shape : {xcyc_targets.shape}")
-    print(f"wh_targets shape : {wh_targets.shape}")
-    print(f"objectness shape : {objectness.shape}")
-    print(f"class_targets shape : {class_targets.shape}")
-    print(f"weights shape : {weights.shape}")
-    '''
-    < input size(height, width) : (608, 608) >
-    xcyc_targets shape : torch.Size([1, 22743, 2])
-    wh_targets shape : torch.Size([1, 22743, 2])
-    objectness shape : torch.Size([1, 22743, 1])
-    class_targets shape : torch.Size([1, 22743])
-    weights shape : torch.Size([1, 22743, 2])
-    '''
+    for name, ref, res in zip(["xcyc_targets", "wh_targets", "objectness", "class_targets", "weights"], reference, result):
+        print(f"{name} shape : {res.shape} / identical : {torch.equal(ref, res.cpu())}")
+    print(f"loop encoder : {loop_time * 1000:.1f}ms / vectorized encoder : {vectorized_time * 1000:.1f}ms")
@@ -108,9 +108,8 @@ class Matcher(Module):
         # anchor_boxes : (1, 9, 4) / gt_boxes : (Batch, N, 4) -> (Batch, 9, N)
         ious = self._batchiou(anchor_boxes, shift_gt_boxes)
 
-        # numpy로 바꾸기
-        matches = ious.argmax(axis=1).cpu().numpy().copy().astype(int)  # (Batch, N) / 가장 큰것 하나만 뽑는다.
-        ious = ious.cpu().numpy().copy()
+        # device sync 를 피하기 위해 numpy로 바꾸지 않고 tensor 그대로 넘긴다.
+        matches = ious.argmax(dim=1)  # (Batch, N) / 가장 큰것 하나만 뽑는다.
 
         return matches, ious
 
@@ -155,6 +154,6 @@ if __name__ == "__main__":
     print(f"match shape : {matches.shape}")
     print(f"iou shape : {ious.shape}")
     '''
-    match shape : (1, 1)
-    iou shape : (1, 9, 1)
+    match shape : torch.Size([1, 1])
+    iou shape : torch.Size([1, 9, 1])
     '''
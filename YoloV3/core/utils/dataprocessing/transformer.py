@@ -1,9 +1,11 @@
 import os
+from collections import OrderedDict
 
 import cv2
 import torch
 import torchvision
 
+from core.utils.dataprocessing.target import TargetGenerator
 from core.utils.util.box_utils import *
 from core.utils.util.image_utils import *
 
@@ -11,7 +13,11 @@ from core.utils.util.image_utils import *
 class YoloTrainTransform(object):
 
     def __init__(self, height, width, input_frame_number=1, mean=[0.485, 0.456, 0.406],
-                 std=[0.229, 0.224, 0.225], augmentation=False):
+                 std=[0.229, 0.224, 0.225], augmentation=False, make_target=False,
+                 anchors={"shallow": [(10, 13), (16, 30), (33, 23)],
+                          "middle": [(30, 61), (62, 45), (59, 119)],
+                          "deep": [(116, 90), (156, 198), (373, 326)]},
+                 ignore_threshold=0.5):
 
         self._height = height
         self._width = width
@@ -21,6 +27,21 @@ class YoloTrainTransform(object):
         self._toTensor = torchvision.transforms.ToTensor()
         self._augmentation = augmentation
 
+        '''
+        dynamic=False 인 경우 target은 gt, anchor, feature map 크기에만 의존하기 때문에
+        network 출력 없이 dataloader worker 에서 미리 만들 수 있다.
+        '''
+        self._make_target = make_target
+        if self._make_target:
+            # Yolov3 와 같은 deep -> middle -> shallow 순서
+            anchors = list(OrderedDict(anchors).values())[::-1]
+            self._anchors = [torch.as_tensor(np.reshape(anchor, (1, 1, -1, 2)), dtype=torch.float32) for anchor in anchors]
+            # target 생성에는 feature map 크기만 필요하다. (batch, height, width, 0)
+            self._outputs = [torch.empty(1, height // stride, width // stride, 0) for stride in (32, 16, 8)]
+            self._target_generator = TargetGenerator(ignore_threshold=ignore_threshold, dynamic=False, from_sigmoid=False)
+        else:
+            self._target_generator = None
+
     def __call__(self, img, bbox, name):
 
         if self._augmentation:
@@ -86,7 +107,16 @@ class YoloTrainTransform(object):
         img = torch.div(img, self._std)
         bbox = torch.as_tensor(bbox)
 
-        return img, bbox, name
+        if self._make_target:
+            label = bbox[None, :, :]
+            xcyc_target, wh_target, objectness, class_target, weights = self._target_generator(self._outputs,
+                                                                                             self._anchors,
+                                                                                             label[:, :, :4],
+                                                                                             label[:, :, 4:5],
+                                                                                             (self._height, self._width))
+            return img, bbox, xcyc_target[0], wh_target[0], objectness[0], class_target[0], weights[0], name
+        else:
+            return img, bbox, name
 
 class YoloValidTransform(object):
 
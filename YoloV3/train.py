@@ -1,19 +1,21 @@
+import functools
 import glob
 import logging
 import os
 import platform
 import time
 
-import mlflow as ml
 import numpy as np
 import torch
+import torch.distributed as dist
 import torchvision
 from core import TargetGenerator
 from core import Voc_2007_AP
 from core import Yolov3, Yolov3Loss, Prediction
-from core import plot_bbox, PrePostNet
+from core import plot_bbox, PrePostNet, AsyncLogger, AsyncCheckpointer, all_reduce_mean, gradient_sync, amp_dtype, autocast, grad_scaler
 from core import traindataloader, validdataloader
 from torch.nn import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import Adam, RMSprop, SGD, lr_scheduler
 from torch.utils.tensorboard import SummaryWriter
 from torchsummary import summary as modelsummary
@@ -38,14 +40,21 @@ def run(mean=[0.485, 0.456, 0.406],
         batch_size=16,
         batch_interval=10,
         subdivision=4,
+        precision="fp32",
+        channels_last=False,
+        checkpoint_stages=0,
         train_dataset_path="Dataset/train",
         valid_dataset_path="Dataset/valid",
         multiscale=False,
         factor_scale=[13, 5],
+        progressive_epoch=0,
         ignore_threshold=0.5,
         dynamic=False,
+        dynamic_memory_budget=256,
+        fused_loss=False,
         data_augmentation=True,
         num_workers=4,
+        prefetch_factor=2,
         optimizer="ADAM",
         save_period=5,
         load_period=10,
@@ -67,8 +76,21 @@ def run(mean=[0.485, 0.456, 0.406],
         iou_thresh=0.5,
         except_class_thresh=0.05,
         plot_class_thresh=0.5):
+    # main.py 의 distributed 모드 - process 마다 불리고, process group 은 main.py 에서 만든다.
+    distributed = dist.is_available() and dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    world_size = dist.get_world_size() if distributed else 1
+    # checkpoint / tensorboard / mlflow / valid graph 는 rank 0 만 쓴다.
+    main_process = rank == 0
+    tensorboard = tensorboard and main_process
+    using_mlflow = using_mlflow and main_process
+
     if GPU_COUNT == 0:
         device = torch.device("cpu")
+    elif distributed:
+        # process 마다 gpu 하나
+        device = torch.device(f"cuda:{rank % GPU_COUNT}")
+        torch.cuda.set_device(device)
     elif GPU_COUNT == 1:
         device = torch.device("cuda")
     else:
@@ -97,7 +119,7 @@ def run(mean=[0.485, 0.456, 0.406],
             logging.info(f'{torch.cuda.get_device_name(d)}')
             logging.info(f'Running on {d} / free memory : {free_memory}GB / total memory {total_memory}GB')
     else:
-        if GPU_COUNT == 1:
+        if device.type == "cuda":
             total_memory = torch.cuda.get_device_properties(device).total_memory
             free_memory = total_memory - torch.cuda.max_memory_allocated(device)
             free_memory = round(free_memory / (1024 ** 3), 2)
@@ -112,30 +134,50 @@ def run(mean=[0.485, 0.456, 0.406],
         logging.info("The input size must be a multiple of 32")
         exit(0)
 
-    if GPU_COUNT > 0 and batch_size < GPU_COUNT:
+    if not distributed and GPU_COUNT > 0 and batch_size < GPU_COUNT:
         logging.info("batch size must be greater than gpu number")
         exit(0)
 
+    if batch_size % world_size != 0:
+        logging.info("batch size must be divisible by world size")
+        exit(0)
+    # batch_size 는 모든 process 를 합친 batch 이고, process 하나는 local_batch_size 씩 올린다. (distributed 가 아니면 같다.)
+    local_batch_size = batch_size // world_size
+
     if multiscale:
         logging.info("Using MultiScale")
+        if progressive_epoch > 0:
+            logging.info(f"Using Progressive Resize until epoch {progressive_epoch}")
 
     if data_augmentation:
         logging.info("Using Data Augmentation")
 
+    # dynamic=False 인 경우 target은 network 출력과 상관없으므로 dataloader worker에서 만든다.
+    make_target = not dynamic
+    if make_target:
+        logging.info("Making targets in dataloader")
+
     logging.info("training YoloV3 Detector")
     input_shape = (1, 3*input_frame_number) + tuple(input_size)
 
     train_dataloader, train_dataset = traindataloader(multiscale=multiscale,
                                                       factor_scale=factor_scale,
+                                                      progressive_epoch=progressive_epoch,
                                                       augmentation=data_augmentation,
                                                       path=train_dataset_path,
                                                       input_size=input_size,
                                                       input_frame_number=input_frame_number,
-                                                      batch_size=batch_size,
+                                                      batch_size=local_batch_size,
                                                       pin_memory=True,
                                                       batch_interval=batch_interval,
                                                       num_workers=num_workers,
-                                                      shuffle=True, mean=mean, std=std)
+                                                      prefetch_factor=prefetch_factor,
+                                                      shuffle=True, mean=mean, std=std,
+                                                      make_target=make_target,
+                                                      anchors=anchors,
+                                                      ignore_threshold=ignore_threshold,
+                                                      distributed=distributed,
+                                                      channels_last=channels_last)
 
     train_update_number_per_epoch = len(train_dataloader)
     if train_update_number_per_epoch < 1:
@@ -149,8 +191,11 @@ def run(mean=[0.485, 0.456, 0.406],
                                                           input_frame_number=input_frame_number,
                                                           batch_size=valid_size,
                                                           num_workers=num_workers,
+                                                          prefetch_factor=prefetch_factor,
                                                           pin_memory=True,
-                                                          shuffle=True, mean=mean, std=std)
+                                                          shuffle=True, mean=mean, std=std,
+                                                          distributed=distributed,
+                                                          channels_last=channels_last)
         valid_update_number_per_epoch = len(valid_dataloader)
         if valid_update_number_per_epoch < 1:
             logging.warning("valid batch size가 데이터 수보다 큼")
@@ -170,19 +215,21 @@ def run(mean=[0.485, 0.456, 0.406],
     param_path = os.path.join(weight_path, f'{model}-{load_period:04d}.pt')
 
     start_epoch = 0
-    net = Yolov3(Darknetlayer=Darknetlayer,
-                 input_size=input_size,
-                 anchors=anchors,
-                 num_classes=num_classes,  # foreground만
-                 pretrained=pretrained_base,
-                 pretrained_path=pretrained_path,
-                 alloc_size=offset_alloc_size)
+    build_net = functools.partial(Yolov3, Darknetlayer=Darknetlayer,
+                                  input_size=input_size,
+                                  anchors=anchors,
+                                  num_classes=num_classes,  # foreground만
+                                  pretrained=pretrained_base,
+                                  pretrained_path=pretrained_path,
+                                  alloc_size=offset_alloc_size,
+                                  checkpoint_stages=checkpoint_stages)
+    net = build_net()
 
     # https://github.com/sksq96/pytorch-summary / because of anchor, not working
     try:
-        if GPU_COUNT == 0:
+        if main_process and GPU_COUNT == 0:
             modelsummary(net.to(context), input_shape[1:], device="cpu")
-        elif GPU_COUNT > 0:
+        elif main_process and GPU_COUNT > 0:
             modelsummary(net.to(context), input_shape[1:], device="cuda")
     except Exception:
         logging.info("torchsummary 문제로 인해 summary 불가")
@@ -191,6 +238,9 @@ def run(mean=[0.485, 0.456, 0.406],
         summary = SummaryWriter(log_dir=os.path.join("torchboard", model), max_queue=10, flush_secs=10)
         summary.add_graph(net.to(context), input_to_model=torch.ones(input_shape, device=context), verbose=False)
 
+    # tensorboard / mlflow 기록은 background thread 에서 - 학습 loop 를 기다리게 하지 않는다.
+    logger = AsyncLogger(summary=summary if tensorboard else None, using_mlflow=using_mlflow)
+
     if os.path.exists(param_path):
         start_epoch = load_period
         checkpoint = torch.load(param_path)
@@ -207,6 +257,10 @@ def run(mean=[0.485, 0.456, 0.406],
         exit(0)
 
     net.to(context)
+    # channels_last 이면 conv weight 와 input 을 NHWC 순서로 둔다. - cudnn / oneDNN 이 layout 을 바꾸는 복사 없이 계산한다.
+    memory_format = torch.channels_last if channels_last else torch.preserve_format
+    if channels_last:
+        net.to(memory_format=torch.channels_last)
 
     if optimizer.upper() == "ADAM":
         trainer = Adam(net.parameters(), lr=learning_rate, betas=(0.9, 0.999), weight_decay=weight_decay)
@@ -229,8 +283,14 @@ def run(mean=[0.485, 0.456, 0.406],
             else:
                 logging.info(f"loading optimizer_state_dict")
 
-    if isinstance(device, (list, tuple)):
+    if distributed:
+        # gloo 로 cpu 에서 돌릴 때는 device_ids 없이
+        net = DistributedDataParallel(net, device_ids=[context] if context.type == "cuda" else None)
+    elif isinstance(device, (list, tuple)):
         net = DataParallel(net, device_ids=device, output_device=context, dim=0)
+    module = net.module if isinstance(net, (DataParallel, DistributedDataParallel)) else net
+    # 검증은 process 마다 자기 몫만 - DistributedDataParallel 의 forward 는 buffer 를 broadcast 하므로 rank 0 만 부르면 멈춘다.
+    valid_net = module if distributed else net
 
     # optimizer
     # https://pytorch.org/docs/master/optim.html?highlight=lr%20sche#torch.optim.lr_scheduler.CosineAnnealingLR
@@ -238,12 +298,20 @@ def run(mean=[0.485, 0.456, 0.406],
     step = unit * decay_step
     lr_sch = lr_scheduler.StepLR(trainer, step, gamma=decay_lr, last_epoch=-1)
 
-    targetgenerator = TargetGenerator(ignore_threshold=ignore_threshold, dynamic=dynamic, from_sigmoid=False)
+    # precision 이 fp16 / bf16 이면 forward 와 loss 를 autocast 로 감싼다. - fp16 은 GradScaler 로 loss 를 키워서 backward 한다.
+    amp = amp_dtype(precision, context)
+    scaler = grad_scaler(amp)
+    if amp is not None:
+        logging.info(f"mixed precision : {amp}")
+
+    targetgenerator = TargetGenerator(ignore_threshold=ignore_threshold, dynamic=dynamic, from_sigmoid=False,
+                                      dynamic_memory_budget=dynamic_memory_budget)
 
     loss = Yolov3Loss(sparse_label=True,
                       from_sigmoid=False,
                       num_classes=num_classes,
-                      reduction="sum")
+                      reduction="sum",
+                      fused=fused_loss)
 
     prediction = Prediction(
         from_sigmoid=False,
@@ -256,15 +324,21 @@ def run(mean=[0.485, 0.456, 0.406],
     precision_recall = Voc_2007_AP(iou_thresh=iou_thresh, class_names=name_classes)
 
     # torch split이 numpy, mxnet split과 달라서 아래와 같은 작업을 하는 것
-    if batch_size % subdivision == 0:
-        chunk = int(batch_size) // int(subdivision)
+    if local_batch_size % subdivision == 0:
+        chunk = int(local_batch_size) // int(subdivision)
     else:
         logging.info(f"batch_size / subdivision 이 나누어 떨어지지 않습니다.")
         logging.info(f"subdivision 을 다시 설정하고 학습 진행하세요.")
         exit(0)
 
+    # save_period 마다의 .pt / .jit 저장은 background process 에서 - 학습은 disk 쓰기, script 변환을 기다리지 않는다.
+    if main_process:
+        checkpointer = AsyncCheckpointer(build_net=functools.partial(build_net, pretrained=False),
+                                         build_prepostnet=functools.partial(PrePostNet, auxnet=prediction, input_frame_number=input_frame_number))
+
     start_time = time.time()
-    for i in tqdm(range(start_epoch + 1, epoch + 1, 1), initial=start_epoch + 1, total=epoch):
+    for i in tqdm(range(start_epoch + 1, epoch + 1, 1), initial=start_epoch + 1, total=epoch,
+                  disable=not main_process):
 
         xcyc_loss_sum = 0
         wh_loss_sum = 0
@@ -273,13 +347,15 @@ def run(mean=[0.485, 0.456, 0.406],
         net.train()
         time_stamp = time.time()
 
-        for batch_count, (image, label, _) in enumerate(
+        # multiscale / progressive resize 의 scale 을 epoch 에 맞게 뽑기
+        train_dataloader.batch_sampler.set_epoch(i)
+        for batch_count, (image, label, *targets, _) in enumerate(
                 train_dataloader, start=1):
 
             _, _, height, width = image.shape
 
             trainer.zero_grad()
-            image = image.to(context)
+            image = image.to(context, memory_format=memory_format)
             label = label.to(context)
             '''
             이렇게 하는 이유?
@@ -291,47 +367,58 @@ def run(mean=[0.485, 0.456, 0.406],
             image_split = torch.split(image, chunk, dim=0)
             gt_boxes = torch.split(label[:, :, :4], chunk, dim=0)
             gt_ids = torch.split(label[:, :, 4:5], chunk, dim=0)
+            # make_target=True 인 경우 xcyc_target, wh_target, objectness, class_target, weights 가 같이 들어온다.
+            targets = [torch.split(target.to(context), chunk, dim=0) for target in targets]
 
             xcyc_losses = []
             wh_losses = []
             object_losses = []
             class_losses = []
-            total_loss = 0.0
-
-            for image_part, gt_boxes_part, gt_ids_part in zip(image_split, gt_boxes, gt_ids):
-
-                output1, output2, output3, anchor1, anchor2, anchor3, offset1, offset2, offset3, stride1, stride2, stride3 = net(image_part)
-                xcyc_target, wh_target, objectness, class_target, weights = targetgenerator(
-                    [output1, output2, output3],
-                    [anchor1[0:1,:,:,:], anchor2[0:1,:,:,:], anchor3[0:1,:,:,:]], # because of dataparallel
-                    gt_boxes_part,
-                    gt_ids_part, (height, width))
-
-                xcyc_loss, wh_loss, object_loss, class_loss = loss(output1, output2, output3, xcyc_target,
-                                                                   wh_target, objectness, class_target, weights)
-
-                xcyc_loss = torch.div(xcyc_loss, subdivision)
-                wh_loss = torch.div(wh_loss, subdivision)
-                object_loss = torch.div(object_loss, subdivision)
-                class_loss = torch.div(class_loss, subdivision)
 
-                xcyc_losses.append(xcyc_loss.item())
-                wh_losses.append(wh_loss.item())
-                object_losses.append(object_loss.item())
-                class_losses.append(class_loss.item())
+            for j, (image_part, gt_boxes_part, gt_ids_part) in enumerate(zip(image_split, gt_boxes, gt_ids)):
 
-                total_loss = total_loss + (xcyc_loss + wh_loss + object_loss + class_loss)
-
-            total_loss.backward()
-            trainer.step()
+                # distributed 이면 마지막 chunk 의 backward 에서만 gradient 를 all-reduce 한다.
+                with gradient_sync(net, sync=j == len(image_split) - 1):
+                    with autocast(context, amp):
+                        output1, output2, output3, anchor1, anchor2, anchor3, offset1, offset2, offset3, stride1, stride2, stride3 = net(image_part)
+                        if make_target:
+                            xcyc_target, wh_target, objectness, class_target, weights = [target[j] for target in targets]
+                        else:
+                            xcyc_target, wh_target, objectness, class_target, weights = targetgenerator(
+                                [output1, output2, output3],
+                                [anchor1[0:1,:,:,:], anchor2[0:1,:,:,:], anchor3[0:1,:,:,:]], # because of dataparallel - DistributedDataParallel 은 replica 를 이어 붙이지 않으므로 그대로
+                                gt_boxes_part,
+                                gt_ids_part, (height, width))
+
+                        xcyc_loss, wh_loss, object_loss, class_loss = loss(output1, output2, output3, xcyc_target,
+                                                                           wh_target, objectness, class_target, weights)
+
+                        xcyc_loss = torch.div(xcyc_loss, subdivision)
+                        wh_loss = torch.div(wh_loss, subdivision)
+                        object_loss = torch.div(object_loss, subdivision)
+                        class_loss = torch.div(class_loss, subdivision)
+
+                    xcyc_losses.append(xcyc_loss.detach())
+                    wh_losses.append(wh_loss.detach())
+                    object_losses.append(object_loss.detach())
+                    class_losses.append(class_loss.detach())
+
+                    # chunk 마다 backward - 이 chunk 의 graph 는 여기서 풀리고 gradient 는 parameter 의 .grad 에 누적된다.
+                    # 모든 chunk 의 graph 를 들고 있다가 한번에 backward 하면 subdivision 으로 activation memory 가 줄지 않는다.
+                    scaler.scale(xcyc_loss + wh_loss + object_loss + class_loss).backward()
+
+            scaler.step(trainer)
+            scaler.update()
             lr_sch.step()
 
+            # loss 는 device 에 쌓아두고 batch_log 마다 한번만 가져온다. - chunk / batch 마다 .item() 으로 기다리지 않는다.
             xcyc_loss_sum += sum(xcyc_losses)
             wh_loss_sum += sum(wh_losses)
             object_loss_sum += sum(object_losses)
             class_loss_sum += sum(class_losses)
 
             if batch_count % batch_log == 0:
+                xcyc_losses, wh_losses, object_losses, class_losses = torch.stack([torch.stack(xcyc_losses), torch.stack(wh_losses), torch.stack(object_losses), torch.stack(class_losses)]).tolist()
                 logging.info(f'[Epoch {i}][Batch {batch_count}/{train_update_number_per_epoch}]'
                              f'[Speed {image.shape[0] / (time.time() - time_stamp):.3f} samples/sec]'
                              f'[Lr = {lr_sch.get_last_lr()}]'
@@ -341,6 +428,9 @@ def run(mean=[0.485, 0.456, 0.406],
                              f'[class loss = {sum(class_losses):.3f}]')
             time_stamp = time.time()
 
+        # process 마다 다른 data 를 봤으므로 process 평균 (distributed 가 아니면 그대로)
+        xcyc_loss_sum, wh_loss_sum, object_loss_sum, class_loss_sum = all_reduce_mean([xcyc_loss_sum, wh_loss_sum, object_loss_sum, class_loss_sum])
+
         train_xcyc_loss_mean = np.divide(xcyc_loss_sum, train_update_number_per_epoch)
         train_wh_loss_mean = np.divide(wh_loss_sum, train_update_number_per_epoch)
         train_object_loss_mean = np.divide(object_loss_sum, train_update_number_per_epoch)
@@ -354,43 +444,16 @@ def run(mean=[0.485, 0.456, 0.406],
             f"train total loss : {train_total_loss_mean}"
         )
 
-        if i % save_period == 0:
+        if i % save_period == 0 and main_process:
 
             if not os.path.exists(weight_path):
                 os.makedirs(weight_path)
 
-            module = net.module if isinstance(device, (list, tuple)) else net
-            auxnet = Prediction(
-                from_sigmoid=False,
-                num_classes=num_classes,
-                nms_thresh=nms_thresh,
-                nms_topk=nms_topk,
-                except_class_thresh=except_class_thresh,
-                multiperclass=multiperclass)
-            prepostnet = PrePostNet(net=module, auxnet=auxnet, input_frame_number=input_frame_number)  # 새로운 객체가 생성
-
-            try:
-                torch.save({
-                    'model_state_dict': net.state_dict(),
-                    'optimizer_state_dict': trainer.state_dict()}, os.path.join(weight_path, f'{model}-{i:04d}.pt'))
-
-                # torch.jit.trace() 보다는 control-flow 연산 적용이 가능한 torch.jit.script() 을 사용하자
-                # torch.jit.script
-                script = torch.jit.script(module)
-                script.save(os.path.join(weight_path, f'{model}-{i:04d}.jit'))
-
-                script = torch.jit.script(prepostnet)
-                script.save(os.path.join(weight_path, f'{model}-prepost-{i:04d}.jit'))
-
-                # # torch.jit.trace - 안 써짐
-                # 오류 : Expected object of device type cuda but got device type cpu for argument #2 'other' in call to _th_fmod
-                # trace = torch.jit.trace(prepostnet, torch.rand(input_shape[0], input_shape[1], input_shape[2], input_shape[3], device=context))
-                # trace.save(os.path.join(weight_path, f'{model}-{i:04d}.jit'))
-
-            except Exception as E:
-                logging.error(f"pt, jit export 예외 발생 : {E}")
-            else:
-                logging.info("pt, jit export 성공")
+            # state_dict 를 cpu 로 복사해서 넘기기만 한다. - .pt 저장, torch.jit.script export 는 checkpointer 의 process 에서 (결과는 logging 으로)
+            checkpointer.save(module.state_dict(), trainer.state_dict(),
+                              pt_path=os.path.join(weight_path, f'{model}-{i:04d}.pt'),
+                              jit_path=os.path.join(weight_path, f'{model}-{i:04d}.jit'),
+                              prepost_path=os.path.join(weight_path, f'{model}-prepost-{i:04d}.jit'))
 
         if i % eval_period == 0 and valid_list:
 
@@ -406,13 +469,13 @@ def run(mean=[0.485, 0.456, 0.406],
 
                 _, _, height, width = image.shape
 
-                image = image.to(context)
+                image = image.to(context, memory_format=memory_format)
                 label = label.to(context)
                 gt_box = label[:, :, :4]
                 gt_id = label[:, :, 4:5]
 
                 with torch.no_grad():
-                    output1, output2, output3, anchor1, anchor2, anchor3, offset1, offset2, offset3, stride1, stride2, stride3 = net(
+                    output1, output2, output3, anchor1, anchor2, anchor3, offset1, offset2, offset3, stride1, stride2, stride3 = valid_net(
                         image)
                     xcyc_target, wh_target, objectness, class_target, weights = targetgenerator(
                         [output1, output2, output3],
@@ -438,6 +501,8 @@ def run(mean=[0.485, 0.456, 0.406],
                     object_loss_sum += object_loss.item()
                     class_loss_sum += class_loss.item()
 
+            # process 마다 나눠 본 valid data 의 평균 (distributed 가 아니면 그대로)
+            xcyc_loss_sum, wh_loss_sum, object_loss_sum, class_loss_sum = all_reduce_mean([xcyc_loss_sum, wh_loss_sum, object_loss_sum, class_loss_sum], device=context)
             valid_xcyc_loss_mean = np.divide(xcyc_loss_sum, valid_update_number_per_epoch)
             valid_wh_loss_mean = np.divide(wh_loss_sum, valid_update_number_per_epoch)
             valid_object_loss_mean = np.divide(object_loss_sum, valid_update_number_per_epoch)
@@ -454,6 +519,8 @@ def run(mean=[0.485, 0.456, 0.406],
 
             AP_appender = []
             round_position = 2
+            # process 마다 나눠 본 valid data 의 결과를 모은다.
+            precision_recall.synchronize()
             class_name, precision, recall, true_positive, false_positive, threshold = precision_recall.get_PR_list()
             for j, c, p, r in zip(range(len(recall)), class_name, precision, recall):
                 name, AP = precision_recall.get_AP(c, p, r)
@@ -464,12 +531,13 @@ def run(mean=[0.485, 0.456, 0.406],
             mAP_result = np.mean(AP_appender)
 
             logging.info(f"mAP : {round(mAP_result * 100, round_position)}%")
-            precision_recall.get_PR_curve(name=class_name,
-                                          precision=precision,
-                                          recall=recall,
-                                          threshold=threshold,
-                                          AP=AP_appender, mAP=mAP_result, folder_name=valid_graph_path, epoch=i,
-                                          auto_open=valid_html_auto_open)
+            if main_process:
+                precision_recall.get_PR_curve(name=class_name,
+                                              precision=precision,
+                                              recall=recall,
+                                              threshold=threshold,
+                                              AP=AP_appender, mAP=mAP_result, folder_name=valid_graph_path, epoch=i,
+                                              auto_open=valid_html_auto_open)
             precision_recall.reset()
 
             if tensorboard:
@@ -482,13 +550,13 @@ def run(mean=[0.485, 0.456, 0.406],
                 dataloader_iter = iter(valid_dataloader)
                 image, label, _ = next(dataloader_iter)
 
-                image = image.to(context)
+                image = image.to(context, memory_format=memory_format)
                 label = label.to(context)
                 gt_boxes = label[:, :, :4]
                 gt_ids = label[:, :, 4:5]
 
                 with torch.no_grad():
-                    output1, output2, output3, anchor1, anchor2, anchor3, offset1, offset2, offset3, stride1, stride2, stride3 = net(
+                    output1, output2, output3, anchor1, anchor2, anchor3, offset1, offset2, offset3, stride1, stride2, stride3 = valid_net(
                         image)
                     ids, scores, bboxes = prediction(output1, output2, output3, anchor1[0:1,:,:,:], anchor2[0:1,:,:,:], anchor3[0:1,:,:,:], offset1[0:1,:,:,:],
                                                      offset2[0:1,:,:,:], offset3[0:1,:,:,:], stride1[0:1,:,:,:], stride2[0:1,:,:,:], stride3[0:1,:,:,:])
@@ -530,53 +598,55 @@ def run(mean=[0.485, 0.456, 0.406],
 
                 img_grid = torchvision.utils.make_grid(torch.as_tensor(batch_image), nrow=1)
 
-                summary.add_image(tag="valid_result", img_tensor=img_grid, global_step=i)
-
-                summary.add_scalar(tag="xy_loss/train_xcyc_loss",
-                                   scalar_value=train_xcyc_loss_mean,
-                                   global_step=i)
-                summary.add_scalar(tag="xy_loss/valid_xcyc_loss",
-                                   scalar_value=valid_xcyc_loss_mean,
-                                   global_step=i)
-
-                summary.add_scalar(tag="wh_loss/train_wh_loss",
-                                   scalar_value=train_wh_loss_mean,
-                                   global_step=i)
-                summary.add_scalar(tag="wh_loss/valid_wh_loss",
-                                   scalar_value=valid_wh_loss_mean,
-                                   global_step=i)
-
-                summary.add_scalar(tag="object_loss/train_object_loss",
-                                   scalar_value=train_object_loss_mean,
-                                   global_step=i)
-                summary.add_scalar(tag="object_loss/valid_object_loss",
-                                   scalar_value=valid_object_loss_mean,
-                                   global_step=i)
-
-                summary.add_scalar(tag="class_loss/train_class_loss",
-                                   scalar_value=train_class_loss_mean,
-                                   global_step=i)
-                summary.add_scalar(tag="class_loss/valid_class_loss",
-                                   scalar_value=valid_class_loss_mean,
-                                   global_step=i)
-
-                summary.add_scalar(tag="total_loss/train_total_loss",
-                                   scalar_value = train_total_loss_mean,
-                                   global_step=i)
-                summary.add_scalar(tag="total_loss/valid_total_loss",
-                                   scalar_value = valid_total_loss_mean,
-                                   global_step=i)
-
-                for name, param in net.named_parameters():
-                    summary.add_histogram(tag=name, values=param, global_step=i)
+                logger.add_image(tag="valid_result", img_tensor=img_grid, global_step=i)
+
+                logger.add_scalar(tag="xy_loss/train_xcyc_loss",
+                                  scalar_value=train_xcyc_loss_mean,
+                                  global_step=i)
+                logger.add_scalar(tag="xy_loss/valid_xcyc_loss",
+                                  scalar_value=valid_xcyc_loss_mean,
+                                  global_step=i)
+
+                logger.add_scalar(tag="wh_loss/train_wh_loss",
+                                  scalar_value=train_wh_loss_mean,
+                                  global_step=i)
+                logger.add_scalar(tag="wh_loss/valid_wh_loss",
+                                  scalar_value=valid_wh_loss_mean,
+                                  global_step=i)
+
+                logger.add_scalar(tag="object_loss/train_object_loss",
+                                  scalar_value=train_object_loss_mean,
+                                  global_step=i)
+                logger.add_scalar(tag="object_loss/valid_object_loss",
+                                  scalar_value=valid_object_loss_mean,
+                                  global_step=i)
+
+                logger.add_scalar(tag="class_loss/train_class_loss",
+                                  scalar_value=train_class_loss_mean,
+                                  global_step=i)
+                logger.add_scalar(tag="class_loss/valid_class_loss",
+                                  scalar_value=valid_class_loss_mean,
+                                  global_step=i)
+
+                logger.add_scalar(tag="total_loss/train_total_loss",
+                                  scalar_value = train_total_loss_mean,
+                                  global_step=i)
+                logger.add_scalar(tag="total_loss/valid_total_loss",
+                                  scalar_value = valid_total_loss_mean,
+                                  global_step=i)
+
+                for name, param in module.named_parameters():
+                    logger.add_histogram(tag=name, values=param, global_step=i)
 
     end_time = time.time()
     learning_time = end_time - start_time
     logging.info(f"learning time : 약, {learning_time / 3600:0.2f}H")
     logging.info("optimization completed")
 
-    if using_mlflow:
-        ml.log_metric("learning time", round(learning_time / 3600, 2))
+    logger.log_metric("learning time", round(learning_time / 3600, 2))
+    if main_process:
+        checkpointer.close()
+    logger.close()
 
 
 if __name__ == "__main__":
@@ -593,14 +663,20 @@ if __name__ == "__main__":
         batch_size=16,
         batch_interval=10,
         subdivision=4,
+        precision="fp32",
+        channels_last=False,
+        checkpoint_stages=0,
         train_dataset_path="Dataset/train",
         valid_dataset_path="Dataset/valid",
         multiscale=False,
         factor_scale=[13, 5],
+        progressive_epoch=0,
         ignore_threshold=0.5,
         dynamic=False,
+        dynamic_memory_budget=256,
         data_augmentation=True,
         num_workers=4,
+        prefetch_factor=2,
         optimizer="ADAM",
         save_period=5,
         load_period=10,